@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the webhook and outbound paths of Flask-Twilio.
+
+Run the benchmarks and save the results as JSON::
+
+    $ python benchmarks/bench_flask_twilio.py run -o before.json
+
+Run a subset of the benchmarks, selected by name::
+
+    $ python benchmarks/bench_flask_twilio.py run -o after.json twiml_
+
+Compare two sets of results::
+
+    $ python benchmarks/bench_flask_twilio.py compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from base64 import b64encode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from twilio.request_validator import RequestValidator  # noqa: E402
+from twilio.twiml.voice_response import Say  # noqa: E402
+
+import flask_twilio  # noqa: E402
+from flask_twilio import (  # noqa: E402
+    Response, Twilio, TwiMLTemplate, analyze_sms, optimize_sms, placeholder,
+    write_records)
+from replay_media import replay, synthesize  # noqa: E402
+from stub_api import StubAPI  # noqa: E402
+
+benchmarks = {}
+
+
+def benchmark(func):
+    """Register a benchmark. The function does any setup that should not be
+    timed, and returns a function of no arguments that performs one
+    operation."""
+    benchmarks[func.__name__] = func
+    return func
+
+
+def create_app(**config):
+    app = Flask(__name__)
+    app.config['TWILIO_ACCOUNT_SID'] = 'AC' + '0' * 32
+    app.config['TWILIO_AUTH_TOKEN'] = 'token'
+    app.config['TWILIO_FROM'] = '+15005550006'
+    app.config['SERVER_NAME'] = 'example.com'
+    app.config.update(config)
+    twilio = Twilio(app)
+
+    @app.route('/call')
+    @twilio.twiml
+    def call():
+        resp = Response()
+        resp.append(Say('Testing, 1, 2, 3.'))
+        return resp
+
+    return app, twilio
+
+
+def post_signed(app, headers=None):
+    """Return a function that posts a correctly signed request to the TwiML
+    view."""
+    form = {'CallSid': 'CA' + '0' * 32, 'From': '+15005550006',
+            'To': '+15005550001', 'CallStatus': 'in-progress'}
+    url = 'http://example.com/call'
+    signature = RequestValidator(
+        app.config['TWILIO_AUTH_TOKEN']).compute_signature(url, form)
+    headers = dict(headers or {}, **{'X-Twilio-Signature': signature})
+    test_client = app.test_client()
+
+    def run():
+        resp = test_client.post(url, data=form, headers=headers)
+        assert resp.status_code == 200, resp.status_code
+
+    return run
+
+
+def build_response(n):
+    resp = Response()
+    for i in range(n):
+        resp.append(
+            Say('This is sentence number {}.'.format(i), voice='alice'))
+    return resp
+
+
+@benchmark
+def twiml_unvalidated():
+    """TwiML view dispatch in testing mode, without request validation."""
+    app, _ = create_app(TESTING=True)
+    test_client = app.test_client()
+
+    def run():
+        resp = test_client.post('/call')
+        assert resp.status_code == 200
+
+    return run
+
+
+@benchmark
+def twiml_validated():
+    """TwiML view dispatch with X-Twilio-Signature validation."""
+    app, _ = create_app()
+    return post_signed(app)
+
+
+@benchmark
+def twiml_basic_auth():
+    """TwiML view dispatch with signature and basic auth validation."""
+    app, twilio = create_app(SECRET_KEY='secret')
+    with app.app_context():
+        password = twilio.signer.sign('token').decode()
+    auth = b64encode(('twilio:' + password).encode()).decode()
+    return post_signed(app, {'Authorization': 'Basic ' + auth})
+
+
+@benchmark
+def basic_auth_cold():
+    """Validation of a basic auth password that has not been seen before."""
+    app, twilio = create_app(SECRET_KEY='secret')
+    state = app.extensions['twilio']
+    with app.app_context():
+        password = twilio.signer.sign('token').decode()
+    passwords = state.get_signer()[1]
+
+    def run():
+        passwords.data.clear()
+        assert state.check_password(password)
+
+    return run
+
+
+@benchmark
+def basic_auth_warm():
+    """Validation of a basic auth password that was recently validated."""
+    app, twilio = create_app(SECRET_KEY='secret')
+    state = app.extensions['twilio']
+    with app.app_context():
+        password = twilio.signer.sign('token').decode()
+
+    def run():
+        assert state.check_password(password)
+
+    return run
+
+
+@benchmark
+def response_small():
+    """Building and serializing a document with one verb."""
+    return lambda: build_response(1).get_data()
+
+
+@benchmark
+def response_large():
+    """Building and serializing a document with 1000 verbs."""
+    return lambda: build_response(1000).get_data()
+
+
+@benchmark
+def template_small():
+    """Rendering a compiled template with one verb."""
+    template = TwiMLTemplate(build_response(1))
+    return template.render
+
+
+@benchmark
+def template_large():
+    """Rendering a compiled template with 1000 verbs and one placeholder."""
+    resp = build_response(999)
+    resp.append(Say(placeholder('text')))
+    template = TwiMLTemplate(resp)
+    return lambda: template.render(text='Goodbye.')
+
+
+@benchmark
+def import_cold():
+    """Importing the module in a fresh interpreter, including startup."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable, '-c', 'import flask_twilio']
+
+    def run():
+        subprocess.check_call(command, cwd=root)
+
+    return run
+
+
+@benchmark
+def import_baseline():
+    """Importing Flask and Twilio's TwiML module in a fresh interpreter, for
+    comparison with import_cold."""
+    command = [sys.executable, '-c', 'import flask, twilio.twiml']
+    return lambda: subprocess.check_call(command)
+
+
+@benchmark
+def media_stream():
+    """Replaying one second of a two-track media stream (100 frames)."""
+    messages = synthesize(1.0, ('inbound', 'outbound'))
+    return lambda: replay(messages)
+
+
+@benchmark
+def sms_analyze():
+    """Counting the segments of 1000 message bodies of 140 to 300
+    characters, a tenth of them with a curly quote."""
+    bodies = ['Your code is {}. '.format(i) * (8 + i % 10) +
+              ('It\u2019s valid for 10 minutes.' if i % 10 == 0 else '')
+              for i in range(1000)]
+    return lambda: [analyze_sms(body) for body in bodies]
+
+
+@benchmark
+def sms_optimize():
+    """Replacing lookalike characters in 1000 message bodies."""
+    bodies = ['\u201cHello\u201d \u2014 it\u2019s {}\u2026 '.format(i) * 8
+              for i in range(1000)]
+    return lambda: [optimize_sms(body) for body in bodies]
+
+
+def stub_app(args, **kwargs):
+    stub = StubAPI(latency=args.latency, **kwargs).start()
+    app, twilio = create_app(TWILIO_API_URL=stub.url, SECRET_KEY='secret')
+    return stub, app, twilio
+
+
+@benchmark
+def message_stub(args):
+    """Sending a message to a local stub API."""
+    stub, app, twilio = stub_app(args)
+
+    def run():
+        with app.app_context():
+            twilio.message('Hello', to='+15005550001')
+
+    return run
+
+
+@benchmark
+def call_for_stub(args):
+    """Placing a call through a local stub API."""
+    stub, app, twilio = stub_app(args)
+
+    def run():
+        with app.test_request_context():
+            twilio.call_for('call', to='+15005550001')
+
+    return run
+
+
+@benchmark
+def iter_messages_stub(args):
+    """Reading 5000 messages from a local stub API with iter_messages and
+    writing them to NDJSON."""
+    stub, app, twilio = stub_app(args, log_size=5000, record=False)
+
+    def run():
+        with app.app_context(), open(os.devnull, 'w') as f:
+            write_records(twilio.iter_messages(), f)
+
+    return run
+
+
+@benchmark
+def list_messages_stub(args):
+    """Reading 5000 messages from a local stub API with the Twilio client's
+    own list method and writing them to NDJSON, for comparison with
+    iter_messages_stub."""
+    stub, app, twilio = stub_app(args, log_size=5000, record=False)
+
+    def run():
+        with app.app_context(), open(os.devnull, 'w') as f:
+            for message in twilio.client.messages.stream(page_size=1000):
+                f.write(json.dumps({
+                    'sid': message.sid, 'date_created': str(
+                        message.date_created), 'date_sent': str(
+                        message.date_sent), 'from': message.from_,
+                    'to': message.to, 'direction': message.direction,
+                    'status': message.status,
+                    'num_segments': message.num_segments,
+                    'price': message.price, 'price_unit': message.price_unit,
+                    'error_code': message.error_code, 'body': message.body}))
+                f.write('\n')
+
+    return run
+
+
+def percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def measure(func, duration, min_iterations):
+    """Call `func` repeatedly and return statistics about its latency."""
+    # Warm up.
+    for _ in range(min(min_iterations, 10)):
+        func()
+    timings = []
+    clock = time.perf_counter
+    start = clock()
+    while len(timings) < min_iterations or clock() - start < duration:
+        t0 = clock()
+        func()
+        timings.append(clock() - t0)
+    total = clock() - start
+    timings.sort()
+    return {
+        'iterations': len(timings),
+        'ops_per_sec': len(timings) / total,
+        'mean': sum(timings) / len(timings),
+        'p50': percentile(timings, 0.50),
+        'p90': percentile(timings, 0.90),
+        'p99': percentile(timings, 0.99),
+        'max': timings[-1],
+    }
+
+
+def run(args):
+    names = [name for name in benchmarks
+             if not args.names or any(pattern in name
+                                      for pattern in args.names)]
+    results = {}
+    for name in names:
+        func = benchmarks[name]
+        if func.__code__.co_argcount:
+            op = func(args)
+        else:
+            op = func()
+        results[name] = stats = measure(op, args.duration, args.min_iterations)
+        print('{:<20} {:>12.1f} ops/s  p50 {:>9.1f} us  p99 {:>9.1f} us'
+              .format(name, stats['ops_per_sec'], stats['p50'] * 1e6,
+                      stats['p99'] * 1e6))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'timestamp': time.time(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'flask_twilio': flask_twilio.__version__,
+                    'latency': args.latency,
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)['results']
+    with open(args.after) as f:
+        after = json.load(f)['results']
+    print('{:<20} {:>12} {:>12} {:>8} {:>8} {:>8}'.format(
+        'benchmark', 'before/s', 'after/s', 'speedup', 'p50', 'p99'))
+    for name in sorted(set(before) & set(after)):
+        old, new = before[name], after[name]
+        print('{:<20} {:>12.1f} {:>12.1f} {:>7.2f}x {:>+7.1f}% {:>+7.1f}%'
+              .format(name, old['ops_per_sec'], new['ops_per_sec'],
+                      new['ops_per_sec'] / old['ops_per_sec'],
+                      100 * (new['p50'] / old['p50'] - 1),
+                      100 * (new['p99'] / old['p99'] - 1)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='Run benchmarks.')
+    run_parser.add_argument(
+        'names', nargs='*', help='Only run benchmarks whose names contain '
+        'one of these strings.')
+    run_parser.add_argument(
+        '-o', '--output', help='Save results to this JSON file.')
+    run_parser.add_argument(
+        '--duration', type=float, default=1.0,
+        help='Seconds to run each benchmark (default: %(default)s).')
+    run_parser.add_argument(
+        '--min-iterations', type=int, default=20,
+        help='Minimum number of iterations (default: %(default)s).')
+    run_parser.add_argument(
+        '--latency', type=float, default=0.005,
+        help='Latency of the stub API in seconds (default: %(default)s).')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two sets of results.')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Replay Twilio Media Streams messages offline through
+:py:class:`flask_twilio.MediaStream`, to measure how fast frames are decoded
+and dispatched.
+
+Messages are read from a file with one JSON message per line, as captured
+from a real stream, or synthesized: a ``start`` message, 20 ms frames of a
+sine wave on each track, and a ``stop`` message::
+
+    $ python benchmarks/replay_media.py --seconds 600 --tracks 2
+    $ python benchmarks/replay_media.py --input capture.ndjson --repeat 10
+
+Pass ``--output`` to save the synthesized messages in the same format.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from base64 import b64encode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_twilio import MediaStream  # noqa: E402
+
+__all__ = ('ReplaySocket', 'replay', 'synthesize')
+
+
+def _linear_to_ulaw(sample):
+    """Encode one 16-bit linear sample as G.711 μ-law."""
+    sign = 0x80 if sample < 0 else 0
+    sample = min(abs(sample), 32635) + 0x84
+    exponent = max(0, sample.bit_length() - 8)
+    mantissa = (sample >> (exponent + 3)) & 0x0F
+    return ~(sign | (exponent << 4) | mantissa) & 0xFF
+
+
+def synthesize(seconds=10.0, tracks=('inbound',), frame_ms=20,
+               frequency=440.0):
+    """
+    Make the messages of a stream that carries a sine wave.
+
+    Returns
+    -------
+    messages : `list`
+        The messages, as JSON strings.
+    """
+    rate = MediaStream.sample_rate
+    frame_size = rate * frame_ms // 1000
+    period = [_linear_to_ulaw(int(8000 * math.sin(
+        2 * math.pi * frequency * i / rate))) for i in range(rate)]
+    messages = [json.dumps({'event': 'connected', 'protocol': 'Call',
+                            'version': '1.0.0'}),
+                json.dumps({'event': 'start', 'sequenceNumber': '1',
+                            'streamSid': 'MZ' + '0' * 32, 'start': {
+                                'streamSid': 'MZ' + '0' * 32,
+                                'callSid': 'CA' + '0' * 32,
+                                'accountSid': 'AC' + '0' * 32,
+                                'tracks': [track + '_track'
+                                           for track in tracks],
+                                'customParameters': {},
+                                'mediaFormat': {
+                                    'encoding': 'audio/x-mulaw',
+                                    'sampleRate': rate, 'channels': 1}}})]
+    sequence = 2
+    for chunk in range(int(seconds * 1000 / frame_ms)):
+        offset = chunk * frame_size % rate
+        payload = b64encode(bytes(
+            period[(offset + i) % rate] for i in range(frame_size))).decode()
+        for track in tracks:
+            messages.append(json.dumps({
+                'event': 'media', 'sequenceNumber': str(sequence),
+                'streamSid': 'MZ' + '0' * 32, 'media': {
+                    'track': track, 'chunk': str(chunk + 1),
+                    'timestamp': str(chunk * frame_ms), 'payload': payload}}))
+            sequence += 1
+    messages.append(json.dumps({'event': 'stop', 'sequenceNumber': str(
+        sequence), 'streamSid': 'MZ' + '0' * 32, 'stop': {}}))
+    return messages
+
+
+class ReplaySocket(object):
+    """A stand-in for a WebSocket that plays back a list of messages."""
+
+    def __init__(self, messages):
+        self.messages = iter(messages)
+        self.sent = []
+
+    def receive(self):
+        return next(self.messages, None)
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def close(self):
+        pass
+
+
+def replay(messages, seconds=10.0, callback=None):
+    """
+    Run a :py:class:`flask_twilio.MediaStream` over the messages, and return
+    the stream.
+    """
+    stream = MediaStream(ReplaySocket(messages), seconds)
+    if callback is not None:
+        stream.on('media', callback)
+    stream.run()
+    return stream
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay Twilio Media Streams messages offline.')
+    parser.add_argument('--input', help='Read messages from this file, one '
+                        'JSON message per line.')
+    parser.add_argument('--output', help='Save the synthesized messages to '
+                        'this file.')
+    parser.add_argument('--seconds', type=float, default=60.0,
+                        help='Length of audio to synthesize '
+                        '(default: %(default)s).')
+    parser.add_argument('--tracks', type=int, choices=(1, 2), default=1,
+                        help='Number of tracks to synthesize '
+                        '(default: %(default)s).')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times to replay the messages '
+                        '(default: %(default)s).')
+    parser.add_argument('--callback', action='store_true',
+                        help='Register a media callback that reads each '
+                        'frame as 16-bit linear samples.')
+    args = parser.parse_args(argv)
+
+    if args.input:
+        with open(args.input) as f:
+            messages = [line for line in f if line.strip()]
+    else:
+        messages = synthesize(
+            args.seconds, ('inbound', 'outbound')[:args.tracks])
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.writelines(message + '\n' for message in messages)
+
+    callback = None
+    if args.callback:
+        def callback(stream, track, samples):
+            track.latest(len(samples), pcm=True)
+
+    frames = sum('"media"' in message for message in messages)
+    size = sum(len(message) for message in messages)
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        stream = replay(messages, callback=callback)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    audio = sum(track.written for track in stream.tracks.values()) / (
+        MediaStream.sample_rate)
+    print('{} frames, {:.1f} s of audio, {:.1f} MB of messages'.format(
+        frames, audio, size / 1e6))
+    print('best of {}: {:.3f} s, {:.0f} frames/s, {:.1f} MB/s, {:.0f}x '
+          'real time'.format(args.repeat, best, frames / best,
+                             size / best / 1e6, audio / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the Twilio REST API, for benchmarks, load tests, and
+soak tests.
+
+Only the endpoints that Flask-Twilio uses to create calls and messages, and to
+list them, are implemented. The server can add latency, fail a fraction of
+requests, and throttle requests with ``429 Too Many Requests`` like the real
+API. When a call is created, it requests the TwiML document from the call's URL
+the same way that Twilio does: with the basic auth credentials from the URL and
+a correctly computed ``X-Twilio-Signature`` header.
+
+Point an application at the server by setting ``TWILIO_API_URL`` to
+:py:attr:`StubAPI.url`. Use it in-process::
+
+    with StubAPI(auth_token=app.config['TWILIO_AUTH_TOKEN']) as stub:
+        app.config['TWILIO_API_URL'] = stub.url
+        ...
+
+or run it as a standalone server with several processes for soak runs::
+
+    $ python benchmarks/stub_api.py --port 8080 --processes 4 \\
+        --auth-token $TWILIO_AUTH_TOKEN --latency 0.05 --error-rate 0.01
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import uuid
+from base64 import b64encode
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit, urlunsplit
+
+import requests
+from twilio.request_validator import RequestValidator
+
+__all__ = ('StubAPI',)
+
+
+class _Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+    reuse_port = False
+
+    def server_bind(self):
+        # Let several processes listen on the same port.
+        if self.reuse_port and hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ThreadingHTTPServer.server_bind(self)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # Keep connections alive, like the real API.
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one segment, to avoid delayed ACK stalls.
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.stub.count(status)
+
+    def send_error_json(self, status, code, message, headers=()):
+        self.send_json(status, {
+            'code': code,
+            'message': message,
+            'more_info': 'https://www.twilio.com/docs/errors/{}'.format(code),
+            'status': status
+        }, headers)
+
+    def admit(self, path):
+        """Check the path and simulate latency, throttling, and errors.
+        Return the path components, or ``None`` if an error was sent."""
+        stub = self.server.stub
+        parts = path.split('/')
+        # /2010-04-01/Accounts/{AccountSid}/{Calls,Messages}.json
+        if len(parts) != 5 or parts[4] not in ('Calls.json', 'Messages.json'):
+            self.send_error_json(404, 20404, 'Not found')
+            return None
+        if stub.latency or stub.jitter:
+            time.sleep(stub.latency + random.uniform(0, stub.jitter))
+        if not stub.acquire():
+            self.send_error_json(
+                429, 20429, 'Too Many Requests', [('Retry-After', '1')])
+            return None
+        if stub.error_rate and random.random() < stub.error_rate:
+            self.send_error_json(500, 20500, 'Internal Server Error')
+            return None
+        return parts
+
+    def do_GET(self):
+        stub = self.server.stub
+        urlparts = urlsplit(self.path)
+        parts = self.admit(urlparts.path)
+        if parts is None:
+            return
+        resource = parts[4][:-len('.json')]
+        query = {key: values[0] for key, values in
+                 parse_qs(urlparts.query).items()}
+        page_size = int(query.get('PageSize', 50))
+        page = int(query.get('Page', 0))
+        start = page * page_size
+        stop = min(start + page_size, stub.log_size)
+        stub.record_list(resource, query)
+        if stop < stub.log_size:
+            next_page_uri = urlparts.path + '?' + urlencode(dict(
+                query, Page=page + 1, PageToken='PA{}'.format(stop)))
+        else:
+            next_page_uri = None
+        self.send_json(200, {
+            resource.lower(): [stub.make_record(resource, parts[3], i)
+                               for i in range(start, stop)],
+            'page': page,
+            'page_size': page_size,
+            'start': start,
+            'end': max(start, stop - 1),
+            'uri': self.path,
+            'first_page_uri': urlparts.path + '?' + urlencode(
+                dict(query, Page=0)),
+            'previous_page_uri': None,
+            'next_page_uri': next_page_uri})
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in
+                parse_qs(self.rfile.read(length).decode()).items()}
+        parts = self.admit(self.path)
+        if parts is None:
+            return
+        resource = parts[4][:-len('.json')]
+        prefix = 'CA' if resource == 'Calls' else 'SM'
+        body = {
+            'sid': prefix + uuid.uuid4().hex,
+            'account_sid': parts[3],
+            'to': form.get('To'),
+            'from': form.get('From'),
+            'status': 'queued'
+        }
+        if resource == 'Calls':
+            body['url'] = form.get('Url')
+        else:
+            body['body'] = form.get('Body')
+        stub.record(resource, form)
+        self.send_json(201, body)
+        stub.schedule_callbacks(resource, form, body)
+
+
+class StubAPI(object):
+    """
+    A stand-in for the Twilio REST API that runs in a background thread.
+
+    Parameters
+    ----------
+    latency : `float`
+        Seconds to wait before answering each request.
+    jitter : `float`
+        Maximum random number of seconds to add to the latency.
+    error_rate : `float`
+        Fraction of requests that fail with ``500 Internal Server Error``.
+    rate_limit : `float`, optional
+        Maximum number of requests per second. Requests above this rate fail
+        with ``429 Too Many Requests``.
+    auth_token : `str`, optional
+        The auth token to sign callbacks with. If not given, then no
+        callbacks are made.
+    callback : callable, optional
+        A function that takes a URL without credentials, a dictionary of form
+        data, and a dictionary of headers, and makes a callback request. By
+        default, callbacks are made over HTTP. For in-process tests, pass a
+        function that uses a Flask test client instead.
+    record : `bool`
+        Whether to keep every request and callback in memory. Turn this off
+        for long soak runs.
+    log_size : `int`
+        The number of calls and of messages in the logs that are returned by
+        list requests. The records are made up on the fly.
+    host : `str`
+        The address to listen on.
+    port : `int`
+        The port to listen on, or 0 to pick a free port.
+    reuse_port : `bool`
+        Whether to let other processes listen on the same port.
+
+    Attributes
+    ----------
+    requests : `list`
+        A ``(resource, form)`` tuple for each request that was received,
+        where `resource` is ``'Calls'`` or ``'Messages'``.
+    callbacks : `list`
+        A ``(url, form, status, body)`` tuple for each callback that was made.
+    lists : `list`
+        A ``(resource, query)`` tuple for each list request that was received.
+    counts : :py:class:`collections.Counter`
+        The number of responses by HTTP status code, and the number of
+        callbacks by outcome.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 rate_limit=None, auth_token=None, callback=None, record=True,
+                 log_size=0, host='127.0.0.1', port=0, reuse_port=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit
+        self.timestamp = time.monotonic()
+        self.validator = None if auth_token is None else RequestValidator(
+            auth_token)
+        self.callback = callback or self.http_callback
+        self.record_requests = record
+        self.log_size = log_size
+        self.requests = []
+        self.callbacks = []
+        self.lists = []
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(16)
+        self.pending = set()
+        self.server = _Server((host, port), _Handler, False)
+        self.server.reuse_port = reuse_port
+        self.server.stub = self
+        try:
+            self.server.server_bind()
+            self.server.server_activate()
+        except:  # noqa: E722
+            self.server.server_close()
+            raise
+        self.thread = None
+
+    @property
+    def url(self):
+        """The base URL of the server."""
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def acquire(self):
+        """Take a token from the rate limiter, if there is one."""
+        if self.rate_limit is None:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate_limit,
+                self.tokens + (now - self.timestamp) * self.rate_limit)
+            self.timestamp = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def record(self, resource, form):
+        if self.record_requests:
+            with self.lock:
+                self.requests.append((resource, form))
+
+    def record_list(self, resource, query):
+        if self.record_requests:
+            with self.lock:
+                self.lists.append((resource, query))
+
+    @staticmethod
+    def make_record(resource, account_sid, i):
+        """Make up the `i`'th most recent record of a log."""
+        date = formatdate(1500000000 - i, usegmt=True)
+        to = '+1500555{:04d}'.format(i % 10000)
+        if resource == 'Calls':
+            sid = 'CA{:032x}'.format(i)
+            record = {
+                'start_time': date, 'end_time': date, 'duration': '1',
+                'status': 'completed', 'parent_call_sid': None,
+                'answered_by': None, 'caller_name': None,
+                'forwarded_from': None, 'group_sid': None,
+                'phone_number_sid': None, 'queue_time': '0',
+                'trunk_sid': None}
+        else:
+            sid = 'SM{:032x}'.format(i)
+            record = {
+                'date_sent': date, 'status': 'delivered',
+                'body': 'Message {}'.format(i), 'num_segments': '1',
+                'num_media': '0', 'error_code': None, 'error_message': None,
+                'messaging_service_sid': None}
+        uri = '/2010-04-01/Accounts/{}/{}/{}'.format(
+            account_sid, resource, sid)
+        record.update({
+            'sid': sid, 'account_sid': account_sid, 'api_version':
+            '2010-04-01', 'date_created': date, 'date_updated': date,
+            'direction': 'outbound-api', 'from': '+15005550006', 'to': to,
+            'price': '-0.00750', 'price_unit': 'USD', 'uri': uri + '.json',
+            'subresource_uris': {'notifications': uri + '/Notifications.json'}
+        })
+        return record
+
+    def schedule_callbacks(self, resource, form, body):
+        if self.validator is None:
+            return
+        params = {
+            'AccountSid': body['account_sid'],
+            'From': body['from'],
+            'To': body['to'],
+            'ApiVersion': '2010-04-01',
+        }
+        if resource == 'Calls':
+            params.update(CallSid=body['sid'], CallStatus='in-progress',
+                          Direction='outbound-api')
+            callbacks = [(form.get('Url'), params)]
+            completed = dict(params, CallStatus='completed', CallDuration='1')
+        else:
+            params.update(MessageSid=body['sid'], SmsSid=body['sid'],
+                          MessageStatus='delivered', SmsStatus='delivered')
+            callbacks = []
+            completed = params
+        if form.get('StatusCallback'):
+            callbacks.append((form['StatusCallback'], completed))
+        if callbacks:
+            future = self.executor.submit(self.run_callbacks, callbacks)
+            with self.lock:
+                self.pending.add(future)
+            future.add_done_callback(self.pending.discard)
+
+    def run_callbacks(self, callbacks):
+        for url, params in callbacks:
+            # Twilio sends the credentials in the URL as basic auth, and
+            # signs the URL without them.
+            urlparts = urlsplit(url)
+            headers = {}
+            if urlparts.username is not None:
+                credentials = '{}:{}'.format(
+                    unquote(urlparts.username),
+                    unquote(urlparts.password or ''))
+                headers['Authorization'] = 'Basic ' + b64encode(
+                    credentials.encode()).decode()
+                netloc = urlparts.netloc.rsplit('@', 1)[1]
+                url = urlunsplit(urlparts._replace(netloc=netloc))
+            headers['X-Twilio-Signature'] = self.validator.compute_signature(
+                url, params)
+            try:
+                status, body = self.callback(url, params, headers)
+            except Exception as e:
+                status, body = None, repr(e)
+            self.count('callback {}'.format(status))
+            if self.record_requests:
+                with self.lock:
+                    self.callbacks.append((url, params, status, body))
+
+    def http_callback(self, url, form, headers):
+        response = self.session.post(url, data=form, headers=headers,
+                                     timeout=15)
+        return response.status_code, response.content
+
+    def wait_for_callbacks(self, timeout=10):
+        """Wait until all callbacks that have been scheduled are done."""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a local stand-in for the Twilio REST API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of server processes (default: 1).')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float,
+                        help='Requests per second per process.')
+    parser.add_argument('--log-size', type=int, default=0,
+                        help='Number of calls and of messages to list '
+                        '(default: 0).')
+    parser.add_argument('--auth-token',
+                        help='Sign callbacks with this auth token. If not '
+                        'given, then no callbacks are made.')
+    args = parser.parse_args(argv)
+
+    children = []
+    for _ in range(args.processes - 1):
+        pid = os.fork()
+        if pid == 0:
+            children = None
+            break
+        children.append(pid)
+
+    stub = StubAPI(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        rate_limit=args.rate_limit, auth_token=args.auth_token, record=False,
+        log_size=args.log_size, host=args.host, port=args.port,
+        reuse_port=args.processes > 1)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if children is not None:
+            print('Listening on {} with {} processes'.format(
+                stub.url, args.processes))
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('{}: {}'.format(os.getpid(), dict(stub.counts)))
+        for pid in children or ():
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,3051 @@
 __version__ = '0.0.6'
-__all__ = ('Response', 'Twilio')
+__all__ = ('AudioBuffer', 'CallRecord', 'CircuitBreaker', 'CircuitOpenError',
+           'DialGroup', 'LRUCache', 'MediaStream', 'MessageRecord',
+           'NumberPool', 'Outbox', 'PooledHttpClient', 'PrometheusMetrics',
+           'RateLimiter', 'RedisCache', 'RedisRateLimiter', 'Response',
+           'RetryBudget', 'RetryPolicy', 'SQLiteCache', 'SegmentBudgetError',
+           'SegmentInfo', 'SendResult', 'SharedRateLimiter', 'SignalMetrics',
+           'StatusBuffer', 'TokenBucket', 'Twilio', 'TwiMLTemplate',
+           'UnknownAccountError', 'analyze_sms', 'metric_added',
+           'metric_incremented', 'metric_observed', 'optimize_sms',
+           'placeholder', 'status_received', 'write_records')
 
+import atexit
+import binascii
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+import weakref
+from bisect import bisect_left
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from itertools import islice
 from string import ascii_letters, digits
 from random import SystemRandom
-from functools import wraps
-from six.moves.urllib.parse import urlsplit, urlunsplit
-from twilio.rest import Client
+from functools import partial, wraps
+from inspect import iscoroutinefunction
+from urllib.parse import urlsplit, urlunsplit
+from twilio.base.exceptions import TwilioException, TwilioRestException
 from twilio.request_validator import RequestValidator
 from twilio.twiml import TwiML
 from flask import Response as FlaskResponse
-from flask import abort, current_app, make_response, request, url_for
-from flask import _app_ctx_stack as stack
-from itsdangerous import TimestampSigner
+from flask import (abort, after_this_request, current_app, g, has_app_context,
+                   has_request_context, make_response, request, url_for)
+from flask.signals import Namespace
+from flask.cli import AppGroup
+import click
+from itsdangerous import BadSignature, TimestampSigner
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 rand = SystemRandom()
 letters_and_digits = ascii_letters + digits
 
+_signals = Namespace()
+metric_observed = _signals.signal('twilio-metric-observed')
+metric_incremented = _signals.signal('twilio-metric-incremented')
+metric_added = _signals.signal('twilio-metric-added')
+status_received = _signals.signal('twilio-status-received')
+
 
 class Response(FlaskResponse, TwiML):
     """
     A response class for constructing TwiML documents, providing all of
     the verbs that are available through :py:class:`twilio.twiml.Response`.
     See also https://www.twilio.com/docs/api/twiml.
+
+    The document is serialized whenever the response body is read, so that
+    changes to nested verbs are never missed. A response that is returned
+    from a :py:meth:`Twilio.twiml` view is serialized only once, when the
+    view returns.
+    """
+
+    def __init__(self, *args, **kwargs):
+        TwiML.__init__(self)
+        FlaskResponse.__init__(self, *args, **kwargs)
+
+    @property
+    def response(self):
+        return [self.to_xml().encode('utf-8')]
+
+    @response.setter
+    def response(self, value):
+        pass
+
+    def connect_stream(self, url, parameters=None, **kwargs):
+        """
+        Append a ``<Connect><Stream>`` that sends the call's audio to a
+        WebSocket that is handled by :py:meth:`Twilio.media_stream`.
+
+        Unless the application is in debug or testing mode or has no secret
+        key, a signed token is added to the stream's custom parameters, so
+        that the handler can check that the stream was started by this
+        application. Must be called from within an application context.
+
+        Parameters
+        ----------
+        url : `str`
+            The ``wss://`` URL of the WebSocket.
+        parameters : `dict`, optional
+            Custom parameters to pass to the handler.
+        kwargs : `dict`
+            Additional attributes of the ``<Stream>`` verb.
+
+        Returns
+        -------
+        connect : :py:class:`twilio.twiml.voice_response.Connect`
+            The ``<Connect>`` verb that was appended.
+        """
+        from twilio.twiml.voice_response import Connect
+        parameters = dict(parameters or {})
+        password = _make_password()
+        if password is not None:
+            parameters[MediaStream.token_parameter] = password
+        connect = Connect()
+        stream = connect.stream(url=url, **kwargs)
+        for name, value in parameters.items():
+            stream.parameter(name=name, value=value)
+        self.append(connect)
+        return connect
+
+
+_PLACEHOLDER = re.compile('\ue000([^\ue001]*)\ue001')
+
+
+def placeholder(name):
+    """
+    Create a placeholder for a value that will be filled in when a
+    :py:class:`TwiMLTemplate` is rendered. Placeholders may be used anywhere
+    that a string is accepted when building a TwiML document: as the text of
+    a verb, as part of it, or as the value of an attribute.
+
+    Parameters
+    ----------
+    name : `str`
+        The name of the keyword argument to :py:meth:`TwiMLTemplate.render`
+        that provides the value.
+    """
+    return '\ue000' + name + '\ue001'
+
+
+class TwiMLTemplate(object):
+    """
+    A TwiML document with placeholders, compiled ahead of time so that it can
+    be rendered without building and serializing an element tree.
+
+    The document is serialized once when the template is created, and split
+    into pre-encoded byte strings around each :py:func:`placeholder`. Values
+    are escaped in the same way that ElementTree escapes them, so that the
+    rendered document is byte-for-byte identical to the one that
+    :py:meth:`twilio.twiml.TwiML.to_xml` would produce for the same values.
+
+    Parameters
+    ----------
+    twiml : :py:class:`twilio.twiml.TwiML`
+        The document, containing placeholders.
+
+    Examples
+    --------
+    >>> from twilio.twiml.voice_response import Say
+    >>> greeting = TwiMLTemplate(
+    ...     Response().append(Say(placeholder('text'), voice='alice')))
+    >>> greeting.render(text='Hello & welcome')
+    b'<?xml version="1.0" encoding="UTF-8"?><Response><Say voice="alice">\
+Hello &amp; welcome</Say></Response>'
+    """
+
+    def __init__(self, twiml):
+        parts = _PLACEHOLDER.split(twiml.to_xml())
+        literals = parts[::2]
+        self.fragments = [literal.encode('utf-8') for literal in literals]
+        self.slots = []
+        prefix = ''
+        for i, name in enumerate(parts[1::2]):
+            before, after = literals[i], literals[i + 1]
+            # Values are escaped, so any angle brackets that precede the
+            # placeholder are tag delimiters.
+            prefix += before
+            start = prefix.rfind('<')
+            in_tag = start > prefix.rfind('>')
+            # If the placeholder is the only content of its element, then an
+            # empty value turns it into an empty element, like `<Say />`.
+            collapsible = (
+                not in_tag and before.endswith('>') and
+                not before.endswith('/>') and prefix[start + 1] != '/' and
+                after.startswith('</'))
+            self.slots.append((name, in_tag, collapsible))
+
+    def render(self, **values):
+        """
+        Render the document.
+
+        Parameters
+        ----------
+        values : `dict`
+            A string for each placeholder. Values for attributes may also be
+            booleans.
+
+        Returns
+        -------
+        document : `bytes`
+            The UTF-8 encoded document, which may be returned directly from a
+            view that is decorated with :py:meth:`Twilio.twiml`.
+        """
+        fragments = self.fragments
+        chunks = [fragments[0]]
+        for (name, in_tag, collapsible), fragment in zip(
+                self.slots, fragments[1:]):
+            value = values[name]
+            if in_tag:
+                if isinstance(value, bool):
+                    value = str(value).lower()
+                chunks.append(ET._escape_attrib(value).encode('utf-8'))
+            elif collapsible and not value:
+                chunks[-1] = chunks[-1][:-1] + b' />'
+                fragment = fragment[fragment.index(b'>') + 1:]
+            else:
+                chunks.append(ET._escape_cdata(value).encode('utf-8'))
+            chunks.append(fragment)
+        return b''.join(chunks)
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that holds at most `maxsize` items, discarding the
+    least recently used item when it is full.
+
+    This is the in-process cache backend. Other backends, such as
+    :py:class:`SQLiteCache` and :py:class:`RedisCache`, provide the same
+    :py:meth:`get`, :py:meth:`set`, and :py:meth:`add` methods.
+
+    Parameters
+    ----------
+    maxsize : `int`
+        The maximum number of items.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        """Get an item, or ``None`` if it is not present or has expired."""
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return None
+            expires, value = self.data[key]
+            if expires is not None and expires <= time.monotonic():
+                del self.data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Add an item, evicting the least recently used item if needed.
+
+        Parameters
+        ----------
+        key : hashable
+            The key.
+        value : object
+            The value.
+        ttl : `float`, optional
+            The number of seconds after which the item expires.
+        """
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """
+        Add an item only if it is not already present. Returns ``True`` if
+        the item was added.
+        """
+        with self.lock:
+            now = time.monotonic()
+            entry = self.data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                return False
+            self.data[key] = (None if ttl is None else now + ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+            return True
+
+
+class PrometheusMetrics(object):
+    """
+    A metrics sink that keeps counters and histograms in memory and renders
+    them in the Prometheus text exposition format.
+
+    Metrics sinks provide :py:meth:`observe`, to add a value to a histogram,
+    :py:meth:`increment`, to add to a counter, and :py:meth:`add`, to add to
+    or subtract from a gauge. Any object with these methods may be used as
+    the ``TWILIO_METRICS`` configuration value.
+
+    The metrics are kept separately by each worker process.
+
+    Parameters
+    ----------
+    buckets : `tuple`
+        The upper bounds of the histogram buckets.
+    """
+
+    default_buckets = (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def observe(self, name, value, labels):
+        """
+        Add a value to a histogram.
+
+        Parameters
+        ----------
+        name : `str`
+            The name of the histogram.
+        value : `float`
+            The value.
+        labels : `dict`
+            The labels of the histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (
+                    len(self.buckets) + 2)
+            histogram[bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    def increment(self, name, labels, value=1):
+        """
+        Add to a counter.
+
+        Parameters
+        ----------
+        name : `str`
+            The name of the counter.
+        labels : `dict`
+            The labels of the counter.
+        value : `float`
+            The amount to add.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, labels):
+        """
+        Add to or subtract from a gauge.
+
+        Parameters
+        ----------
+        name : `str`
+            The name of the gauge.
+        value : `float`
+            The amount to add.
+        labels : `dict`
+            The labels of the gauge.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels) + '}'
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        with self.lock:
+            scalars = sorted(
+                [(key, 'counter', value)
+                 for key, value in self.counters.items()] +
+                [(key, 'gauge', value) for key, value in self.gauges.items()])
+            histograms = sorted(
+                (key, list(value)) for key, value in self.histograms.items())
+        lines = []
+        last_name = None
+        for (name, labels), kind, value in scalars:
+            if name != last_name:
+                lines.append('# TYPE {} {}'.format(name, kind))
+                last_name = name
+            lines.append('{}{} {!r}'.format(
+                name, self._format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name != last_name:
+                lines.append('# TYPE {} histogram'.format(name))
+                last_name = name
+            count = 0
+            bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+            for bound, n in zip(bounds, histogram[:-1]):
+                count += n
+                lines.append('{}_bucket{} {}'.format(
+                    name, self._format_labels(labels + (('le', bound),)),
+                    count))
+            lines.append('{}_sum{} {!r}'.format(
+                name, self._format_labels(labels), histogram[-1]))
+            lines.append('{}_count{} {}'.format(
+                name, self._format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class SignalMetrics(object):
+    """
+    A metrics sink that sends each measurement as a Flask signal:
+    :py:data:`metric_observed` for histograms,
+    :py:data:`metric_incremented` for counters, and :py:data:`metric_added`
+    for gauges. The sender is the application, and the keyword arguments are
+    `name`, `value`, and `labels`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def observe(self, name, value, labels):
+        metric_observed.send(self.app, name=name, value=value, labels=labels)
+
+    def increment(self, name, labels, value=1):
+        metric_incremented.send(
+            self.app, name=name, value=value, labels=labels)
+
+    def add(self, name, value, labels):
+        metric_added.send(self.app, name=name, value=value, labels=labels)
+
+
+class _StageTimer(object):
+    """Records how long each stage of handling a TwiML request takes."""
+
+    __slots__ = ('metrics', 'view', 'start', 'last')
+
+    def __init__(self, metrics, view):
+        self.metrics = metrics
+        self.view = view
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.metrics.observe('twilio_twiml_stage_seconds', now - self.last,
+                             {'view': self.view, 'stage': stage})
+        self.last = now
+
+    def finish(self, status):
+        labels = {'view': self.view, 'status': str(status)}
+        self.metrics.observe('twilio_twiml_request_seconds',
+                             time.perf_counter() - self.start, labels)
+        self.metrics.increment('twilio_twiml_requests_total', labels)
+
+
+def _make_twiml_response(rv):
+    resp = make_response(rv)
+    if isinstance(resp, Response):
+        # The view cannot change the document any more, so serialize it once
+        # rather than every time that the body is read.
+        resp = FlaskResponse(resp.to_xml().encode('utf-8'),
+                             status=resp.status, headers=resp.headers)
+    # Adjust MIME type and return.
+    resp.mimetype = 'text/xml'
+    return resp
+
+
+def _parse_request_start(value):
+    """
+    Parse an ``X-Request-Start`` header that was added by a load balancer or
+    web server, and return the time at which the request arrived, in seconds
+    since the epoch, or ``None``.
+
+    The header may be in seconds (``t=1700000000.123``, as from nginx's
+    ``$msec``), milliseconds, or microseconds (``t=1700000000123456``, as
+    from Apache's ``%t``).
+    """
+    if not value:
+        return None
+    try:
+        start = float(value[2:] if value.startswith('t=') else value)
+    except ValueError:
+        return None
+    if start > 1e14:
+        return start / 1e6
+    elif start > 1e11:
+        return start / 1e3
+    return start
+
+
+def _rest_operation(method, url):
+    """
+    Describe a REST API request, such as ``messages.create`` or
+    ``calls.update``.
+    """
+    path = urlsplit(url).path
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+    parts = path.strip('/').split('/')
+    # Paths look like /2010-04-01/Accounts/{AccountSid}/{Resource}[/{Sid}].
+    if len(parts) > 3 and parts[1] == 'Accounts':
+        parts = parts[3:]
+    if len(parts) % 2:
+        resource = parts[-1]
+        action = {'GET': 'list', 'POST': 'create'}.get(method.upper())
+    else:
+        resource = parts[-2]
+        action = {'GET': 'fetch', 'POST': 'update',
+                  'DELETE': 'delete'}.get(method.upper())
+    return '{}.{}'.format(resource.lower(), action or method.lower())
+
+
+def _rest_outcome(status):
+    """Classify the HTTP status code of a REST API response."""
+    if status < 400:
+        return 'success'
+    elif status == 429:
+        return 'throttled'
+    elif status < 500:
+        return 'client_error'
+    else:
+        return 'server_error'
+
+
+def _parse_retry_after(value):
+    """
+    Parse a ``Retry-After`` header, which is either a number of seconds or an
+    HTTP date, and return the number of seconds to wait, or ``None``.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+class CircuitOpenError(TwilioException):
+    """
+    Raised instead of making a REST API request while the circuit breaker is
+    open because the Twilio API appears to be unhealthy.
+
+    Attributes
+    ----------
+    retry_after : `float`
+        The number of seconds until the circuit breaker lets a trial request
+        through.
+    """
+
+    def __init__(self, retry_after):
+        TwilioException.__init__(
+            self, 'Twilio API is unavailable; not retrying for {:.1f} '
+            'seconds'.format(retry_after))
+        self.retry_after = retry_after
+
+
+class RetryBudget(object):
+    """
+    Limit retries to a fraction of requests, so that retries cannot multiply
+    the load on an API that is already overloaded.
+
+    Parameters
+    ----------
+    ratio : `float`
+        The number of retries that each request earns.
+    burst : `int`
+        The number of retries that may be made before any have been earned,
+        and the most that can be saved up.
+    """
+
+    def __init__(self, ratio=0.2, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = float(burst)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        """Earn retries for one request."""
+        with self.lock:
+            self.balance = min(self.burst, self.balance + self.ratio)
+
+    def withdraw(self):
+        """Spend one retry. Returns ``False`` if the budget is exhausted."""
+        with self.lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Decide whether and when to retry a REST API request that failed.
+
+    Parameters
+    ----------
+    max_retries : `int`
+        The maximum number of times to retry each request.
+    backoff : `float`
+        The delay in seconds before the first retry. The delay doubles after
+        each retry, and a random delay between zero and that amount is used
+        ("full jitter") so that clients that failed together do not retry
+        together.
+    max_backoff : `float`
+        The longest delay in seconds. If the API asks for a longer delay with
+        a ``Retry-After`` header, then the request is not retried.
+    statuses : `tuple`
+        The HTTP status codes to retry.
+    budget : :py:class:`RetryBudget`, optional
+        A budget shared by all requests.
+    """
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30.0,
+                 statuses=(429, 503), budget=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.budget = budget
+
+    def get_delay(self, retries, response):
+        """
+        Return the number of seconds to wait before retrying a request that
+        has already been retried `retries` times, or ``None`` to give up.
+        """
+        if (retries >= self.max_retries or
+                response.status_code not in self.statuses):
+            return None
+        delay = _parse_retry_after(response.headers.get('Retry-After'))
+        if delay is None:
+            delay = rand.uniform(
+                0, min(self.max_backoff, self.backoff * 2 ** retries))
+        elif delay > self.max_backoff:
+            return None
+        if self.budget is not None and not self.budget.withdraw():
+            return None
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Stop making requests to an API after several consecutive failures, and
+    let a single trial request through after a cool-down period.
+
+    Parameters
+    ----------
+    threshold : `int`
+        The number of consecutive failures after which the breaker opens.
+    cooldown : `float`
+        The number of seconds to stay open before a trial request.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        """Raise :py:class:`CircuitOpenError` if no request may be made."""
+        with self.lock:
+            if self.opened is None:
+                return
+            remaining = self.opened + self.cooldown - time.monotonic()
+            if remaining <= 0 and not self.trial:
+                self.trial = True
+                return
+        raise CircuitOpenError(max(0.0, remaining))
+
+    def record(self, failed):
+        """Record the outcome of a request."""
+        with self.lock:
+            self.trial = False
+            if not failed:
+                self.failures = 0
+                self.opened = None
+            else:
+                self.failures += 1
+                if self.opened is not None or self.failures >= self.threshold:
+                    self.opened = time.monotonic()
+
+
+class NumberPool(object):
+    """
+    A pool of sending phone numbers.
+
+    Parameters
+    ----------
+    numbers : `list`
+        The phone numbers.
+    strategy : `str`
+        How to choose a number for each recipient:
+
+        ``'sticky'``
+            Always use the same number for the same recipient, so that
+            conversations stay on one number. Recipients are assigned to
+            numbers by consistent hashing, so adding a number to the pool
+            only moves the recipients that the new number takes over.
+        ``'round_robin'``
+            Use each number in turn.
+        ``'least_loaded'``
+            Use the number with the fewest requests in progress.
+
+        Numbers that are unhealthy are skipped, unless all of them are.
+    threshold : `int`
+        The number of consecutive failed requests after which a number is
+        considered unhealthy.
+    cooldown : `float`
+        The number of seconds for which an unhealthy number is skipped.
+    replicas : `int`
+        The number of points on the hash ring for each number.
+    metrics : object, optional
+        A metrics sink. If given, then the counter
+        ``twilio_from_selected_total`` counts how often each number is
+        chosen, and ``twilio_from_unhealthy_total`` counts how often each
+        number is found to be unhealthy.
+    """
+
+    def __init__(self, numbers, strategy='sticky', threshold=3,
+                 cooldown=30.0, replicas=100, metrics=None):
+        if strategy not in ('sticky', 'round_robin', 'least_loaded'):
+            raise ValueError('Unknown strategy: {!r}'.format(strategy))
+        self.numbers = list(numbers)
+        self.strategy = strategy
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.metrics = metrics
+        ring = sorted((_hash64('{}#{}'.format(number, i)), number)
+                      for number in self.numbers for i in range(replicas))
+        self._ring_hashes = [h for h, _ in ring]
+        self._ring_numbers = [number for _, number in ring]
+        self._next = 0
+        self.sent = dict.fromkeys(self.numbers, 0)
+        self.failed = dict.fromkeys(self.numbers, 0)
+        self.in_flight = dict.fromkeys(self.numbers, 0)
+        self.failures = dict.fromkeys(self.numbers, 0)
+        self.unhealthy_until = dict.fromkeys(self.numbers, 0.0)
+        self.lock = threading.Lock()
+
+    def is_healthy(self, number, now=None):
+        now = time.monotonic() if now is None else now
+        return self.unhealthy_until[number] <= now
+
+    def choose(self, to=None):
+        """Choose a number to send to the recipient `to`."""
+        now = time.monotonic()
+        healthy = [number for number in self.numbers
+                   if self.is_healthy(number, now)] or self.numbers
+        if self.strategy == 'sticky' and to is not None:
+            index = bisect_left(self._ring_hashes, _hash64(to))
+            ring = self._ring_numbers
+            for i in range(len(ring)):
+                number = ring[(index + i) % len(ring)]
+                if number in healthy:
+                    break
+        elif self.strategy == 'least_loaded':
+            number = min(healthy, key=self.in_flight.__getitem__)
+        else:
+            with self.lock:
+                number = healthy[self._next % len(healthy)]
+                self._next += 1
+        if self.metrics is not None:
+            self.metrics.increment(
+                'twilio_from_selected_total', {'from': number})
+        return number
+
+    def started(self, number):
+        """Record that a request from `number` is in progress."""
+        if number in self.in_flight:
+            with self.lock:
+                self.in_flight[number] += 1
+
+    def finished(self, number, failed):
+        """Record the outcome of a request from `number`."""
+        if number not in self.in_flight:
+            return
+        with self.lock:
+            self.in_flight[number] -= 1
+            if not failed:
+                self.sent[number] += 1
+                self.failures[number] = 0
+                return
+            self.failed[number] += 1
+            self.failures[number] += 1
+            if self.failures[number] < self.threshold:
+                return
+            self.failures[number] = 0
+            self.unhealthy_until[number] = time.monotonic() + self.cooldown
+        if self.metrics is not None:
+            self.metrics.increment(
+                'twilio_from_unhealthy_total', {'from': number})
+
+    def stats(self):
+        """
+        Get the health and utilisation of each number in this process.
+
+        Returns
+        -------
+        stats : `dict`
+            A dictionary that maps each number to a dictionary with the keys
+            ``healthy``, ``in_flight``, ``sent``, and ``failed``.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return {number: {'healthy': self.is_healthy(number, now),
+                             'in_flight': self.in_flight[number],
+                             'sent': self.sent[number],
+                             'failed': self.failed[number]}
+                    for number in self.numbers}
+
+
+_import_lock = threading.Lock()
+
+
+def _load_http_client():
+    """
+    Define :py:class:`PooledHttpClient`. This is deferred until it is first
+    needed, because importing :py:mod:`requests` and the Twilio HTTP client
+    makes up much of the import time of this module.
+    """
+    global PooledHttpClient
+    with _import_lock:
+        if 'PooledHttpClient' not in globals():
+            PooledHttpClient = _define_http_client()
+    return PooledHttpClient
+
+
+def _define_http_client():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    from twilio.http.http_client import TwilioHttpClient
+
+    class PooledHttpClient(TwilioHttpClient):
+        """
+        A :py:class:`twilio.http.http_client.TwilioHttpClient` that keeps a
+        bounded pool of keep-alive connections to the Twilio API.
+
+        Parameters
+        ----------
+        pool_size : `int`
+            The maximum number of connections to keep open per host. Threads
+            that need a connection while all of them are in use wait for one
+            to be returned to the pool rather than opening a new one.
+        timeout : `float`, optional
+            Socket timeout in seconds for each request.
+        base_url : `str`, optional
+            If given, then send requests to this scheme and host instead of to
+            the Twilio API, for example to a local stand-in server for
+            testing.
+        connect_retries : `int`
+            The number of times to retry a request if a connection to the API
+            cannot be established. This is always safe, because the request
+            has not been sent.
+        metrics : object, optional
+            A metrics sink such as :py:class:`PrometheusMetrics`. If given,
+            then each request is timed and counted by operation, sending
+            number, status code, and outcome, and the number of requests in
+            flight is tracked.
+        retry : :py:class:`RetryPolicy`, optional
+            If given, then requests that fail with one of the policy's status
+            codes are retried after a delay.
+        breaker : :py:class:`CircuitBreaker`, optional
+            If given, then requests fail fast with
+            :py:class:`CircuitOpenError` after repeated server errors,
+            timeouts, or connection errors.
+        limiter : :py:class:`RateLimiter`, optional
+            If given, then requests that create calls and messages wait for a
+            token from the bucket for their sending number.
+        send_rate : `float`
+            The number of calls and messages per second to allow from each
+            sending number.
+        send_burst : `int`
+            The number of calls and messages that may be sent from each number
+            in a burst.
+        numbers : :py:class:`NumberPool`, optional
+            If given, then the pool is told when calls and messages from its
+            numbers start and finish.
+        """
+
+        def __init__(self, pool_size=10, timeout=None, base_url=None,
+                     connect_retries=0, metrics=None, retry=None, breaker=None,
+                     limiter=None, send_rate=None, send_burst=1, numbers=None):
+            TwilioHttpClient.__init__(
+                self, pool_connections=True, timeout=timeout)
+            self.pool_size = pool_size
+            self.base_url = None if base_url is None else urlsplit(base_url)
+            self.metrics = metrics
+            self.retry = retry
+            self.breaker = breaker
+            self.limiter = limiter
+            self.send_rate = send_rate
+            self.send_burst = send_burst
+            self.numbers = numbers
+            self._local = threading.local()
+            self.request_hooks = dict(
+                self.request_hooks, response=[self._count_retries])
+            adapter = HTTPAdapter(
+                pool_maxsize=pool_size, pool_block=True,
+                max_retries=Retry(
+                    total=connect_retries, connect=connect_retries, read=0,
+                    redirect=0, status=0, other=0))
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+        def _count_retries(self, response, *args, **kwargs):
+            retries = response.raw.retries
+            if retries is not None:
+                self._local.retries += len(retries.history)
+
+        def _send(self, method, url, params, data, args, kwargs):
+            retry = self.retry
+            if retry is not None and retry.budget is not None:
+                retry.budget.deposit()
+            retries = 0
+            while True:
+                response = TwilioHttpClient.request(
+                    self, method, url, params, data, *args, **kwargs)
+                delay = None if retry is None else retry.get_delay(
+                    retries, response)
+                if delay is None:
+                    return response
+                time.sleep(delay)
+                retries += 1
+                self._local.retries += 1
+
+        def request(self, method, url, params=None, data=None, *args,
+                    **kwargs):
+            if self.base_url is not None:
+                urlparts = urlsplit(url)
+                url = urlunsplit(self.base_url[:2] + urlparts[2:])
+            metrics = self.metrics
+            breaker = self.breaker
+            limiter = self.limiter
+            numbers = self.numbers
+            labels = None if metrics is None and limiter is None and (
+                numbers is None) else {
+                'operation': _rest_operation(method, url),
+                'from': (data or {}).get('From', '')}
+            if labels is None or labels['operation'] not in (
+                    'calls.create', 'messages.create'):
+                limiter = numbers = None
+            # Wait for the rate limiter first, because once the breaker lets
+            # a trial request through, nothing may fail before the outcome
+            # of the request is recorded.
+            if limiter is not None:
+                delay = limiter.reserve(
+                    labels['from'], self.send_rate, self.send_burst)
+                if delay > 0:
+                    time.sleep(delay)
+            if breaker is not None:
+                try:
+                    breaker.check()
+                except CircuitOpenError:
+                    if metrics is not None:
+                        metrics.increment('twilio_rest_requests_total', dict(
+                            labels, status='', outcome='circuit_open'))
+                    raise
+
+            self._local.retries = 0
+            status = ''
+            outcome = 'error'
+            start = time.perf_counter()
+            try:
+                if metrics is not None:
+                    metrics.add('twilio_rest_in_flight', 1, labels)
+                if numbers is not None:
+                    numbers.started(labels['from'])
+                response = self._send(method, url, params, data, args, kwargs)
+                status = response.status_code
+                outcome = _rest_outcome(status)
+                return response
+            except requests.Timeout:
+                outcome = 'timeout'
+                raise
+            except requests.ConnectionError:
+                outcome = 'connection_error'
+                raise
+            finally:
+                if breaker is not None:
+                    breaker.record(outcome in (
+                        'server_error', 'timeout', 'connection_error',
+                        'error'))
+                if numbers is not None:
+                    numbers.finished(labels['from'], outcome not in (
+                        'success', 'client_error'))
+                if metrics is not None:
+                    duration = time.perf_counter() - start
+                    metrics.add('twilio_rest_in_flight', -1, labels)
+                    result = dict(labels, status=str(status), outcome=outcome)
+                    metrics.observe(
+                        'twilio_rest_request_seconds', duration, result)
+                    metrics.increment('twilio_rest_requests_total', result)
+                    if self._local.retries:
+                        metrics.increment('twilio_rest_retries_total', labels,
+                                          self._local.retries)
+
+        def close(self):
+            """Close all pooled connections."""
+            self.session.close()
+
+    return PooledHttpClient
+
+
+def __getattr__(name):
+    if name == 'PooledHttpClient':
+        return _load_http_client()
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket rate limiter.
+
+    Parameters
+    ----------
+    rate : `float`
+        The number of tokens that are added to the bucket per second.
+    burst : `int`
+        The maximum number of tokens that the bucket can hold.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token from the bucket, and return the number of seconds to wait
+        before using it.
+
+        Tokens are reserved in the order that callers arrive, so the lock is
+        only held long enough to update the counter and never while sleeping.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """Take a token from the bucket, sleeping until one is available."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _hash64(key):
+    """Hash a string to a 64-bit integer that is the same in every
+    process."""
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class RateLimiter(object):
+    """
+    A rate limiter with one :py:class:`TokenBucket` per key, for a single
+    process.
+
+    This is also the interface for rate limiters that are shared between
+    processes, such as :py:class:`SharedRateLimiter` and
+    :py:class:`RedisRateLimiter`.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, key, rate, burst=1):
+        """
+        Take a token from the bucket for `key`, and return the number of
+        seconds to wait before using it.
+
+        Parameters
+        ----------
+        key : `str`
+            The key, such as a sending phone number.
+        rate : `float`
+            The number of tokens that are added to the bucket per second.
+        burst : `int`
+            The maximum number of tokens that the bucket can hold.
+        """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.setdefault(key, TokenBucket(rate, burst))
+        return bucket.reserve()
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    A rate limiter whose state is kept in a memory-mapped file, so that it is
+    shared by all worker processes on a host.
+
+    Each key is stored in a fixed-size slot as its theoretical arrival time:
+    the time at which its bucket will be full again (the generic cell rate
+    algorithm). Reserving a token only reads and writes that one slot while
+    holding an advisory lock on the file, so it costs two system calls and
+    never waits for another process for longer than that.
+
+    Parameters
+    ----------
+    path : `str`
+        The filename of the shared state. It is created if necessary.
+    slots : `int`
+        The maximum number of keys. All processes must use the same value.
+    """
+
+    _slot = struct.Struct('=Qd')
+
+    def __init__(self, path, slots=1024):
+        if fcntl is None:
+            raise RuntimeError(
+                'SharedRateLimiter requires a platform with fcntl')
+        self.path = path
+        self.slots = slots
+        self._pid = None
+        self._guard = threading.Lock()
+
+    def _open(self):
+        # Threads take turns through a lock of their own, because file locks
+        # only exclude other processes. The guard makes sure that threads
+        # that start at the same time open the file, and create that lock,
+        # only once.
+        if self._pid != os.getpid():
+            with self._guard:
+                if self._pid != os.getpid():
+                    size = self.slots * self._slot.size
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    fcntl.lockf(fd, fcntl.LOCK_EX)
+                    try:
+                        if os.fstat(fd).st_size < size:
+                            os.ftruncate(fd, size)
+                    finally:
+                        fcntl.lockf(fd, fcntl.LOCK_UN)
+                    self._map = mmap.mmap(fd, size)
+                    self._fd = fd
+                    self.lock = threading.Lock()
+                    self._pid = os.getpid()
+        return self._fd, self._map
+
+    def reserve(self, key, rate, burst=1):
+        id = _hash64(key) or 1
+        interval = 1.0 / rate
+        fd, buf = self._open()
+        slot = self._slot
+        with self.lock:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                for i in range(self.slots):
+                    offset = (id + i) % self.slots * slot.size
+                    slot_id, tat = slot.unpack_from(buf, offset)
+                    if slot_id == id or slot_id == 0:
+                        break
+                else:
+                    raise RuntimeError(
+                        'All {} rate limiter slots in {} are in use'.format(
+                            self.slots, self.path))
+                now = time.time()
+                tat = max(tat, now) + interval
+                slot.pack_into(buf, offset, id, tat)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+        return max(0.0, tat - burst * interval - now)
+
+
+class RedisRateLimiter(RateLimiter):
+    """
+    A rate limiter whose state is kept in Redis, so that it can be shared by
+    worker processes on many hosts. It uses the same algorithm as
+    :py:class:`SharedRateLimiter` in a Lua script, with the Redis server's
+    clock.
+
+    Parameters
+    ----------
+    redis : :py:class:`redis.Redis`
+        A Redis client.
+    prefix : `str`
+        A prefix for all keys.
+    """
+
+    _script = """
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local interval = 1 / tonumber(ARGV[1])
+        local tat = math.max(tonumber(redis.call('GET', KEYS[1])) or 0, now)
+        tat = tat + interval
+        redis.call('SET', KEYS[1], string.format('%.6f', tat),
+                   'PX', math.ceil((tat - now) * 1000))
+        return string.format(
+            '%.6f', math.max(0, tat - tonumber(ARGV[2]) * interval - now))
+    """
+
+    def __init__(self, redis, prefix='flask-twilio:rate:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def reserve(self, key, rate, burst=1):
+        return float(self.redis.eval(
+            self._script, 1, self.prefix + key, rate, burst))
+
+
+class StatusBuffer(object):
     """
+    Collect status callback events in memory and hand them to a sink in
+    batches, from a background thread.
+
+    Parameters
+    ----------
+    sink : callable
+        A function that takes a list of events. Each event is a dictionary
+        of the form parameters of one status callback request.
+    batch_size : `int`
+        Flush as soon as this many events are waiting.
+    interval : `float`
+        Flush events that have waited for this many seconds.
+    limit : `int`
+        If this many events are waiting because the sink is slow, then the
+        thread that adds an event flushes them itself, so that memory use is
+        bounded and the webhook slows down instead.
+    logger : :py:class:`logging.Logger`, optional
+        Where to log exceptions that are raised by the sink.
+    """
+
+    def __init__(self, sink, batch_size=500, interval=1.0, limit=10000,
+                 logger=None):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.limit = limit
+        self.logger = logger
+        self.events = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(
+            target=self.run, name='flask-twilio-status')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, event):
+        """Add an event."""
+        with self.lock:
+            self.events.append(event)
+            count = len(self.events)
+        if count >= self.limit:
+            self.flush()
+        elif count >= self.batch_size:
+            self.wakeup.set()
+
+    def flush(self):
+        """Hand all waiting events to the sink."""
+        with self.flush_lock:
+            with self.lock:
+                events, self.events = self.events, []
+            if events:
+                try:
+                    self.sink(events)
+                except Exception:
+                    if self.logger is None:
+                        raise
+                    self.logger.exception(
+                        'Failed to flush %d status callbacks', len(events))
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and flush the remaining events."""
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+
+def _ulaw_to_linear(byte):
+    """Decode one G.711 μ-law sample to a 16-bit linear sample."""
+    byte = ~byte & 0xFF
+    exponent = (byte >> 4) & 0x07
+    sample = ((((byte & 0x0F) << 3) + 0x84) << exponent) - 0x84
+    return -sample if byte & 0x80 else sample
+
+
+# Tables for bytes.translate that map μ-law samples to the low and high bytes
+# of little-endian 16-bit linear samples.
+_ULAW_LOW = bytes(_ulaw_to_linear(i) & 0xFF for i in range(256))
+_ULAW_HIGH = bytes((_ulaw_to_linear(i) >> 8) & 0xFF for i in range(256))
+
+
+class AudioBuffer(object):
+    """
+    A preallocated ring buffer of 8-bit μ-law audio, with the same audio
+    decoded to 16-bit little-endian linear PCM.
+
+    Every sample is stored twice, half a buffer apart, so that any window of
+    up to `capacity` samples is contiguous and can be returned as a
+    :py:class:`memoryview` without copying. Samples are decoded to PCM with
+    :py:meth:`bytes.translate` and two lookup tables, which runs at the speed
+    of a memory copy.
+
+    Parameters
+    ----------
+    capacity : `int`
+        The number of samples to keep.
+
+    Attributes
+    ----------
+    written : `int`
+        The number of samples that have been written. Samples are identified
+        by their position in the stream, from 0 to `written`.
+    """
+
+    def __init__(self, capacity=80000):
+        self.capacity = capacity
+        self.written = 0
+        self.ulaw = bytearray(2 * capacity)
+        self.pcm = bytearray(4 * capacity)
+
+    def _put(self, index, samples):
+        n = len(samples)
+        self.ulaw[index:index + n] = samples
+        index *= 2
+        self.pcm[index:index + 2 * n:2] = samples.translate(_ULAW_LOW)
+        self.pcm[index + 1:index + 2 * n:2] = samples.translate(_ULAW_HIGH)
+
+    def write(self, samples):
+        """Append μ-law samples, overwriting the oldest samples."""
+        capacity = self.capacity
+        if len(samples) > capacity:
+            self.written += len(samples) - capacity
+            samples = samples[-capacity:]
+        n = len(samples)
+        index = self.written % capacity
+        self._put(index, samples)
+        if index + n <= capacity:
+            self._put(index + capacity, samples)
+        else:
+            split = capacity - index
+            self._put(index + capacity, samples[:split])
+            self._put(0, samples[split:])
+        self.written += n
+
+    def view(self, start, stop=None, pcm=False):
+        """
+        Get the samples from position `start` to `stop` without copying them.
+        The view is only valid until the samples are overwritten.
+
+        Parameters
+        ----------
+        start : `int`
+            The position of the first sample.
+        stop : `int`, optional
+            The position after the last sample. Defaults to `written`.
+        pcm : `bool`
+            If true, then return 16-bit linear samples (on little-endian
+            hosts) instead of μ-law bytes.
+
+        Returns
+        -------
+        samples : :py:class:`memoryview`
+        """
+        if stop is None:
+            stop = self.written
+        if not (max(0, self.written - self.capacity) <= start <= stop <=
+                self.written):
+            raise IndexError(
+                'Samples {}:{} are not in the buffer'.format(start, stop))
+        end = self.written % self.capacity + self.capacity - (
+            self.written - stop)
+        begin = end - (stop - start)
+        if pcm:
+            return memoryview(self.pcm)[2 * begin:2 * end].cast('h')
+        return memoryview(self.ulaw)[begin:end]
+
+    def latest(self, n, pcm=False):
+        """Get the most recent `n` samples without copying them."""
+        return self.view(self.written - n, pcm=pcm)
+
+    def array(self, start, stop=None, pcm=True):
+        """
+        Get samples as a NumPy array that shares memory with the buffer.
+        Requires NumPy.
+        """
+        import numpy
+        if pcm:
+            return numpy.frombuffer(
+                self.view(start, stop, pcm=True), dtype='<i2')
+        return numpy.frombuffer(self.view(start, stop), dtype='u1')
+
+
+class MediaStream(object):
+    """
+    A Twilio Media Stream, received over a WebSocket. Usually created by
+    :py:meth:`Twilio.media_stream`.
+
+    Each message from Twilio is handled by :py:meth:`handle`. The audio of
+    each track is decoded into an :py:class:`AudioBuffer`, and callbacks
+    that were registered with :py:meth:`on` are called for each event.
+
+    Parameters
+    ----------
+    ws : object
+        The WebSocket, with ``receive()`` and ``send()`` methods such as those
+        of `flask-sock`_ and `simple-websocket`_. ``receive()`` returns each
+        message as a string, or ``None`` when the connection is closed.
+    seconds : `float`
+        The length of audio to keep for each track.
+    authenticate : callable, optional
+        A function that takes the signed token from the stream's custom
+        parameters and returns ``True`` if it is valid. If given, then a
+        stream without a valid token is rejected with
+        :py:class:`PermissionError`.
+
+    Attributes
+    ----------
+    stream_sid, call_sid, account_sid : `str`
+        Identifiers from the ``start`` message.
+    parameters : `dict`
+        The custom parameters of the stream, not including the signed token.
+    tracks : `dict`
+        An :py:class:`AudioBuffer` for each track, such as ``'inbound'``.
+
+    .. _flask-sock: https://flask-sock.readthedocs.io/
+    .. _simple-websocket: https://simple-websocket.readthedocs.io/
+    """
+
+    token_parameter = 'flask_twilio_token'
+    sample_rate = 8000
+
+    def __init__(self, ws, seconds=10.0, authenticate=None):
+        self.ws = ws
+        self.capacity = int(seconds * self.sample_rate)
+        self.authenticate = authenticate
+        self.stream_sid = self.call_sid = self.account_sid = None
+        self.parameters = {}
+        self.tracks = {}
+        self.callbacks = {}
+        self.started = False
+        self.stopped = False
+
+    def on(self, event, func=None):
+        """
+        Register a callback for an event: ``'start'``, ``'media'``,
+        ``'mark'``, ``'dtmf'``, or ``'stop'``. May be used as a decorator.
+
+        Callbacks for ``'media'`` are called with the stream, the
+        :py:class:`AudioBuffer` of the track, and a :py:class:`memoryview`
+        of the new μ-law samples in the buffer. Other callbacks are called
+        with the stream and the message, as a dictionary.
+        """
+        if func is None:
+            return partial(self.on, event)
+        self.callbacks.setdefault(event, []).append(func)
+        return func
+
+    def get_track(self, name):
+        track = self.tracks.get(name)
+        if track is None:
+            track = self.tracks[name] = AudioBuffer(self.capacity)
+        return track
+
+    def handle(self, message):
+        """Handle one message from Twilio, as a string or bytes."""
+        message = json.loads(message)
+        event = message.get('event')
+        if event == 'media':
+            if not self.started:
+                raise PermissionError('Media stream has not started')
+            media = message['media']
+            track = self.get_track(media.get('track', 'inbound'))
+            start = track.written
+            track.write(binascii.a2b_base64(media['payload']))
+            callbacks = self.callbacks.get('media')
+            if callbacks:
+                samples = track.view(
+                    max(start, track.written - track.capacity))
+                for func in callbacks:
+                    func(self, track, samples)
+            return
+        if event == 'start':
+            start = message['start']
+            parameters = dict(start.get('customParameters') or {})
+            token = parameters.pop(self.token_parameter, None)
+            if self.authenticate is not None and not (
+                    token and self.authenticate(token)):
+                raise PermissionError(
+                    'Media stream was not started by this application')
+            self.stream_sid = start.get('streamSid', message.get('streamSid'))
+            self.call_sid = start.get('callSid')
+            self.account_sid = start.get('accountSid')
+            self.parameters = parameters
+            for name in start.get('tracks', ()):
+                self.get_track(name.replace('_track', ''))
+            self.started = True
+        elif event == 'stop':
+            self.stopped = True
+        for func in self.callbacks.get(event, ()):
+            func(self, message)
+
+    def run(self):
+        """
+        Receive and handle messages until the stream stops or the connection
+        is closed. If the stream is rejected, then the connection is closed
+        and :py:class:`PermissionError` is raised.
+        """
+        receive = self.ws.receive
+        handle = self.handle
+        while not self.stopped:
+            message = receive()
+            if message is None:
+                break
+            try:
+                handle(message)
+            except PermissionError:
+                close = getattr(self.ws, 'close', None)
+                if close is not None:
+                    close()
+                raise
+
+    def _send(self, message):
+        message['streamSid'] = self.stream_sid
+        self.ws.send(json.dumps(message))
+
+    def send_audio(self, samples):
+        """Play μ-law samples to the call, on a bidirectional stream."""
+        self._send({'event': 'media', 'media': {
+            'payload': binascii.b2a_base64(samples, newline=False).decode()}})
+
+    def send_mark(self, name):
+        """Ask Twilio to send a ``mark`` event when the audio that was sent
+        before it has been played."""
+        self._send({'event': 'mark', 'mark': {'name': name}})
+
+    def clear(self):
+        """Stop playing the audio that has been sent."""
+        self._send({'event': 'clear'})
+
+
+SendResult = namedtuple('SendResult', 'to result exception')
+SendResult.__doc__ = """
+The outcome of sending to one recipient with :py:meth:`Twilio.message_many`
+or :py:meth:`Twilio.call_for_many`.
+
+Attributes
+----------
+to : `str`
+    The destination phone number.
+result : :py:class:`twilio.rest.resources.SmsMessage`
+    An object representing the message that was sent or the call that was
+    placed, or ``None`` if sending failed.
+exception : `Exception`
+    The exception that was raised if sending failed, or ``None``.
+"""
+
+MessageRecord = namedtuple(
+    'MessageRecord', 'sid date_created date_sent from_ to direction status '
+    'num_segments price price_unit error_code body')
+MessageRecord.__doc__ = """
+A message from :py:meth:`Twilio.iter_messages`. The fields have the same
+names as the fields of the Twilio API's JSON representation of a message,
+except that ``from`` is spelled ``from_``. Values are left as the strings
+and numbers that the API returns.
+"""
+
+CallRecord = namedtuple(
+    'CallRecord', 'sid date_created start_time end_time from_ to direction '
+    'status duration price price_unit parent_call_sid')
+CallRecord.__doc__ = """
+A call from :py:meth:`Twilio.iter_calls`. The fields have the same names as
+the fields of the Twilio API's JSON representation of a call, except that
+``from`` is spelled ``from_``. Values are left as the strings and numbers
+that the API returns.
+"""
+
+
+# Keyword arguments of Twilio.iter_messages and Twilio.iter_calls, and the
+# query parameters of the Twilio API that they stand for.
+_MESSAGE_FILTERS = {
+    'to': 'To', 'from_': 'From', 'date_sent': 'DateSent',
+    'date_sent_before': 'DateSent<', 'date_sent_after': 'DateSent>'}
+_CALL_FILTERS = {
+    'to': 'To', 'from_': 'From', 'parent_call_sid': 'ParentCallSid',
+    'status': 'Status', 'start_time': 'StartTime',
+    'start_time_before': 'StartTime<', 'start_time_after': 'StartTime>',
+    'end_time': 'EndTime', 'end_time_before': 'EndTime<',
+    'end_time_after': 'EndTime>'}
+
+
+def _json_fields(fields):
+    return [field.rstrip('_') for field in fields]
+
+
+def write_records(records, file, format='ndjson'):
+    """
+    Write records from :py:meth:`Twilio.iter_messages` or
+    :py:meth:`Twilio.iter_calls` to a file, one at a time, so that exports of
+    any size take constant memory.
+
+    Parameters
+    ----------
+    records : iterable
+        The records, as named tuples.
+    file : `str` or file object
+        The filename or text file to write to.
+    format : {'ndjson', 'csv'}
+        Write one JSON object per line, or comma-separated values with a
+        header row. Field names are those of the Twilio API, so ``from_`` is
+        written as ``from``.
+
+    Returns
+    -------
+    count : `int`
+        The number of records that were written.
+    """
+    if format not in ('ndjson', 'csv'):
+        raise ValueError('Unknown format: {!r}'.format(format))
+    if isinstance(file, str):
+        with open(file, 'w', newline='', encoding='utf-8') as f:
+            return write_records(records, f, format)
+    count = 0
+    names = None
+    if format == 'csv':
+        import csv
+        writer = csv.writer(file)
+        for record in records:
+            if names is None:
+                names = _json_fields(record._fields)
+                writer.writerow(names)
+            writer.writerow(record)
+            count += 1
+    else:
+        encode = json.JSONEncoder(
+            ensure_ascii=False, separators=(',', ':')).encode
+        write = file.write
+        for record in records:
+            if names is None:
+                names = _json_fields(record._fields)
+            write(encode(dict(zip(names, record))))
+            write('\n')
+            count += 1
+    return count
+
+
+# The GSM 03.38 default alphabet, and the characters of its extension table,
+# which take two septets each because they are preceded by an escape.
+_GSM_BASIC = ('@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789'
+              ':;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿'
+              'abcdefghijklmnopqrstuvwxyzäöñüà')
+_GSM_EXTENDED = '\f^{}\\[~]|€'
+_NON_GSM = re.compile('[^' + re.escape(_GSM_BASIC + _GSM_EXTENDED) + ']')
+_GSM_EXTENDED_CHARS = re.compile('[' + re.escape(_GSM_EXTENDED) + ']')
+
+# Characters that are commonly pasted into messages from word processors and
+# phones, and the GSM-7 characters that look like them.
+_GSM_REPLACEMENTS = str.maketrans({
+    char: replacement for chars, replacement in (
+        ('‘’‚‛′‵´`‹›', "'"),
+        ('“”„‟″‶«»', '"'),
+        ('‐‑‒–—―−•', '-'),
+        ('\u00a0\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008'
+         '\u2009\u200a\u202f\u205f\u3000', ' '),
+        ('\u200b\u200c\u200d\u2060\ufeff\u00ad', ''),
+        ('…', '...'), ('ˆ', '^'), ('˜', '~'), ('⁄∕', '/'), ('，', ','),
+        ('：', ':'), ('；', ';'), ('！', '!'), ('？', '?'))
+    for char in chars})
+
+SegmentInfo = namedtuple('SegmentInfo', 'encoding length segments')
+SegmentInfo.__doc__ = """
+The encoding and length of an SMS message body, as returned by
+:py:func:`analyze_sms`.
+
+Attributes
+----------
+encoding : `str`
+    ``'GSM-7'`` if every character of the body is in the GSM 03.38 alphabet,
+    or else ``'UCS-2'``.
+length : `int`
+    The length of the body in the units of its encoding: septets for GSM-7,
+    counting two for each character of the extension table, or UTF-16 code
+    units for UCS-2.
+segments : `int`
+    The number of segments that the message is sent and billed as.
+"""
+
+
+def _count_segments(body, is_wide, size):
+    """Pack characters into segments of `size` units without splitting the
+    two units of an escaped GSM-7 character or a UTF-16 surrogate pair."""
+    segments = 1
+    used = 0
+    for char in body:
+        n = 2 if is_wide(char) else 1
+        if used + n > size:
+            segments += 1
+            used = 0
+        used += n
+    return segments
+
+
+def analyze_sms(body):
+    """
+    Find the encoding and number of segments of an SMS message body, without
+    making any requests.
+
+    A message that fits in one segment holds 160 GSM-7 septets or 70 UCS-2
+    code units. Longer messages are split into segments of 153 septets or 67
+    code units, to leave room for the header that joins them back together.
+    A single character outside of the GSM 03.38 alphabet makes the whole
+    message UCS-2.
+
+    The check is done with precompiled character tables rather than a loop
+    in Python, so it is cheap enough to run over every body of a large
+    broadcast before sending any of it.
+
+    Parameters
+    ----------
+    body : `str`
+        The body of the text message.
+
+    Returns
+    -------
+    info : :py:class:`SegmentInfo`
+        The encoding, length, and number of segments.
+    """
+    if _NON_GSM.search(body) is None:
+        extended = len(_GSM_EXTENDED_CHARS.findall(body))
+        length = len(body) + extended
+        if length <= 160:
+            segments = 1
+        elif not extended:
+            segments = -(-length // 153)
+        else:
+            segments = _count_segments(
+                body, _GSM_EXTENDED.__contains__, 153)
+        return SegmentInfo('GSM-7', length, segments)
+    length = len(body.encode('utf-16-le')) // 2
+    if length <= 70:
+        segments = 1
+    elif length == len(body):
+        segments = -(-length // 67)
+    else:
+        segments = _count_segments(body, lambda c: c > '\uffff', 67)
+    return SegmentInfo('UCS-2', length, segments)
+
+
+def optimize_sms(body):
+    """
+    Replace characters that are not in the GSM 03.38 alphabet with GSM-7
+    characters that look like them: curly quotes with straight quotes, dashes
+    with hyphens, an ellipsis with three periods, unusual spaces with a
+    space, and so on. Zero-width characters are removed.
+
+    Characters without a lookalike, such as emoji, are left as they are, so
+    the result may still need UCS-2.
+
+    Parameters
+    ----------
+    body : `str`
+        The body of the text message.
+
+    Returns
+    -------
+    body : `str`
+        The body with characters replaced.
+    """
+    return body.translate(_GSM_REPLACEMENTS)
+
+
+class SegmentBudgetError(TwilioException):
+    """
+    Raised instead of sending an SMS message that would be sent as more
+    segments than ``TWILIO_SMS_MAX_SEGMENTS``.
+
+    Attributes
+    ----------
+    info : :py:class:`SegmentInfo`
+        The encoding, length, and number of segments of the message body.
+    max_segments : `int`
+        The maximum number of segments.
+    """
+
+    def __init__(self, info, max_segments):
+        TwilioException.__init__(
+            self, 'Message is {0.segments} {0.encoding} segments; at most '
+            '{1} are allowed'.format(info, max_segments))
+        self.info = info
+        self.max_segments = max_segments
+
+
+class DialGroup(object):
+    """
+    Calls that were placed at the same time by :py:meth:`Twilio.call_for_many`,
+    of which only the first to be answered is kept.
+
+    Attributes
+    ----------
+    id : `str`
+        A unique identifier for the group.
+    results : `list`
+        A :py:class:`SendResult` for each recipient.
+    """
+
+    def __init__(self, id, results, backend):
+        self.id = id
+        self.results = results
+        self.backend = backend
+
+    @property
+    def calls(self):
+        """The calls that were placed successfully."""
+        return [result.result for result in self.results
+                if result.result is not None]
+
+    def answered(self):
+        """
+        Get the SID of the call that was answered first, or ``None`` if no
+        call has been answered yet.
+        """
+        sid = self.backend.get('dial:{}:answered'.format(self.id))
+        if sid is not None:
+            return sid.decode() if isinstance(sid, bytes) else sid
+
+    def wait(self, timeout=None, interval=0.1):
+        """
+        Wait until a call is answered, and return its SID, or ``None`` if
+        the timeout expires first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            sid = self.answered()
+            if sid is not None or (
+                    deadline is not None and time.monotonic() >= deadline):
+                return sid
+            time.sleep(interval)
+
+
+def _imap_unordered(executor, func, iterable, limit):
+    """
+    Apply `func` to each item of `iterable` in `executor`, with at most
+    `limit` calls outstanding at once, and return an iterator of
+    ``(item, future)`` pairs in the order that they finish. The first `limit`
+    calls are submitted right away; the rest are submitted as the iterator is
+    consumed.
+    """
+    iterable = iter(iterable)
+    pending = {}
+    for item in islice(iterable, limit):
+        pending[executor.submit(func, item)] = item
+    return _iter_unordered(executor, func, iterable, pending)
+
+
+def _iter_unordered(executor, func, iterable, pending):
+    from concurrent.futures import FIRST_COMPLETED, wait
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for item in islice(iterable, 1):
+                    pending[executor.submit(func, item)] = item
+                yield pending.pop(future), future
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _prefetch(iterable, lookahead):
+    """
+    Consume `iterable` in a background thread, at most `lookahead` items
+    ahead of the caller, and yield its items. Exceptions are raised in the
+    caller. Closing the generator stops the thread.
+    """
+    from queue import Full, Queue
+    queue = Queue(lookahead)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except BaseException as e:
+            put((False, e))
+        else:
+            put((False, None))
+
+    thread = threading.Thread(target=run, name='flask-twilio-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class _SQLiteDatabase(object):
+    """Base class for objects that are stored in an SQLite database."""
+
+    _schema = ''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript(self._schema)
+
+    def _connect(self):
+        # SQLite connections must not be shared between threads or carried
+        # across a fork, so keep one per thread and process.
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            import sqlite3
+            local.db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None)
+            local.db.execute('PRAGMA journal_mode=WAL')
+            local.db.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.db
+
+
+class Outbox(_SQLiteDatabase):
+    """
+    A durable queue of outgoing calls and messages, stored in an SQLite
+    database in write-ahead logging mode so that writers never wait for
+    readers. It may be shared by any number of threads and processes on the
+    same host.
+
+    Parameters
+    ----------
+    path : `str`
+        The filename of the SQLite database.
+    max_attempts : `int`
+        The number of times to try each request before giving up.
+    retry_delay : `float`
+        The delay in seconds before the first retry. The delay doubles after
+        each failed attempt.
+    lease : `float`
+        The time in seconds that a worker may hold a request before it is
+        considered lost and handed to another worker. The lease of each
+        request is renewed just before it is sent, so this must only be
+        longer than one request may take, including retries.
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created REAL NOT NULL,
+            not_before REAL NOT NULL,
+            sid TEXT,
+            error TEXT,
+            owner TEXT
+        );
+        CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, not_before);
+    """
+
+    def __init__(self, path, max_attempts=5, retry_delay=1.0, lease=300.0):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        _SQLiteDatabase.__init__(self, path)
+        db = self._connect()
+        columns = [row[1] for row in db.execute('PRAGMA table_info(outbox)')]
+        if 'owner' not in columns:
+            # Upgrade an outbox that was created by an older version.
+            import sqlite3
+            try:
+                db.execute('ALTER TABLE outbox ADD COLUMN owner TEXT')
+            except sqlite3.OperationalError:
+                # Another process may have just done it.
+                pass
+
+    def _owner(self):
+        # A token that identifies the claims of this thread and process.
+        local = self._local
+        if getattr(local, 'owner_pid', None) != os.getpid():
+            local.owner = uuid.uuid4().hex
+            local.owner_pid = os.getpid()
+        return local.owner
+
+    def put(self, kind, kwargs, key=None):
+        """
+        Add a request to the queue.
+
+        Parameters
+        ----------
+        kind : `str`
+            Either ``'call'`` or ``'message'``.
+        kwargs : `dict`
+            Keyword arguments for the REST API. Must be serializable as JSON.
+        key : `str`, optional
+            An idempotency key. If a request with the same key has already
+            been queued, then this one is ignored. A random key is generated
+            if none is given.
+
+        Returns
+        -------
+        key : `str`
+            The idempotency key.
+        """
+        if key is None:
+            key = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute(
+            'INSERT OR IGNORE INTO outbox '
+            '(key, kind, payload, created, not_before) VALUES (?, ?, ?, ?, ?)',
+            (key, kind, json.dumps(kwargs), now, now))
+        return key
+
+    def claim(self, limit):
+        """
+        Take up to `limit` requests that are due for delivery. They are
+        hidden from other workers until the lease expires, and then may be
+        claimed again by any worker.
+
+        Returns
+        -------
+        rows : `list`
+            A list of ``(id, kind, kwargs, attempts)`` tuples.
+        """
+        db = self._connect()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = db.execute(
+                "SELECT id, kind, payload, attempts FROM outbox "
+                "WHERE status = 'pending' AND not_before <= ? "
+                "ORDER BY not_before LIMIT ?", (now, limit)).fetchall()
+            owner = self._owner()
+            db.executemany(
+                'UPDATE outbox SET not_before = ?, owner = ? WHERE id = ?',
+                [(now + self.lease, owner, row[0]) for row in rows])
+        except:  # noqa: E722
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return [(id, kind, json.loads(payload), attempts)
+                for id, kind, payload, attempts in rows]
+
+    def renew(self, id):
+        """
+        Extend the lease on a request that was returned by :py:meth:`claim`.
+        Returns ``False`` if the lease has expired and the request has been
+        claimed by another worker, which must then be left to send it.
+        """
+        return self._connect().execute(
+            "UPDATE outbox SET not_before = ? "
+            "WHERE id = ? AND owner = ? AND status = 'pending'",
+            (time.time() + self.lease, id, self._owner())).rowcount == 1
+
+    def complete(self, results):
+        """
+        Record the outcome of requests that were returned by :py:meth:`claim`.
+        Requests that have since been claimed by another worker are left
+        alone.
+
+        Parameters
+        ----------
+        results : `list`
+            A list of ``(id, attempts, sid, exception)`` tuples, where `sid` is
+            the SID of the new call or message, or `exception` is the error
+            that was raised.
+        """
+        now = time.time()
+        updates = []
+        owner = self._owner()
+        for id, attempts, sid, exception in results:
+            if isinstance(exception, CircuitOpenError):
+                # The request was never sent, so do not count the attempt.
+                status, not_before = 'pending', now + exception.retry_after
+                error = str(exception)
+            elif exception is None:
+                attempts += 1
+                status, not_before, error = 'sent', now, None
+            else:
+                attempts += 1
+                error = str(exception)
+                permanent = (
+                    isinstance(exception, TwilioRestException) and
+                    400 <= exception.status < 500 and exception.status != 429)
+                if permanent or attempts >= self.max_attempts:
+                    status, not_before = 'failed', now
+                else:
+                    status = 'pending'
+                    not_before = now + self.retry_delay * 2 ** (attempts - 1)
+            updates.append((status, attempts, not_before, sid, error, id))
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'UPDATE outbox SET status = ?, attempts = ?, not_before = ?, '
+                'sid = ?, error = ? WHERE id = ? AND owner = ?',
+                [update + (owner,) for update in updates])
+        except:  # noqa: E722
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def deliver(self, send, limit=50):
+        """
+        Claim a batch of requests and deliver them one at a time. The lease
+        of each request is renewed just before it is sent, and its outcome is
+        recorded right after.
+
+        Parameters
+        ----------
+        send : callable
+            A function that takes the kind of request and its keyword
+            arguments, sends it, and returns the SID of the new resource.
+        limit : `int`
+            The maximum number of requests to deliver.
+
+        Returns
+        -------
+        count : `int`
+            The number of requests that were attempted.
+        """
+        count = 0
+        for id, kind, kwargs, attempts in self.claim(limit):
+            # If earlier requests in the batch were slow, then the lease may
+            # have run out and the request been claimed by another worker.
+            if not self.renew(id):
+                continue
+            try:
+                result = (id, attempts, send(kind, kwargs), None)
+            except Exception as e:
+                result = (id, attempts, None, e)
+            # Record each outcome right away, before the lease runs out.
+            self.complete([result])
+            count += 1
+        return count
+
+    def counts(self):
+        """Get the number of requests in the queue, by status."""
+        return dict(self._connect().execute(
+            'SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+
+    def purge(self, max_age):
+        """
+        Delete requests that were sent more than `max_age` seconds ago.
+
+        Returns
+        -------
+        count : `int`
+            The number of requests that were deleted.
+        """
+        return self._connect().execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND created < ?",
+            (time.time() - max_age,)).rowcount
+
+
+class SQLiteCache(_SQLiteDatabase):
+    """
+    A cache backend that is stored in an SQLite database, so that it can be
+    shared by all worker processes on the same host.
+
+    Parameters
+    ----------
+    path : `str`
+        The filename of the SQLite database.
+    purge_interval : `int`
+        Delete expired items after every this many calls to :py:meth:`set`.
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            expires REAL
+        );
+    """
+
+    def __init__(self, path, purge_interval=1000):
+        self.purge_interval = purge_interval
+        self._sets = 0
+        _SQLiteDatabase.__init__(self, path)
+
+    def get(self, key):
+        """Get an item, or ``None`` if it is not present or has expired."""
+        row = self._connect().execute(
+            'SELECT value FROM cache WHERE key = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (key, time.time())).fetchone()
+        if row is not None:
+            return row[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Add an item.
+
+        Parameters
+        ----------
+        key : `str`
+            The key.
+        value : `bytes`
+            The value.
+        ttl : `float`, optional
+            The number of seconds after which the item expires.
+        """
+        now = time.time()
+        db = self._connect()
+        expires = None if ttl is None else now + ttl
+        db.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) '
+            'VALUES (?, ?, ?)', (key, value, expires))
+        self._sets += 1
+        if self._sets % self.purge_interval == 0:
+            db.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+
+    def add(self, key, value, ttl=None):
+        """
+        Add an item only if it is not already present. Returns ``True`` if
+        the item was added.
+        """
+        now = time.time()
+        db = self._connect()
+        expires = None if ttl is None else now + ttl
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM cache WHERE key = ? AND expires <= ?',
+                       (key, now))
+            added = db.execute(
+                'INSERT OR IGNORE INTO cache (key, value, expires) '
+                'VALUES (?, ?, ?)', (key, value, expires)).rowcount
+        except:  # noqa: E722
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return bool(added)
+
+
+class RedisCache(object):
+    """
+    A cache backend that is stored in Redis, so that it can be shared by
+    worker processes on many hosts.
+
+    Parameters
+    ----------
+    redis : :py:class:`redis.Redis`
+        A Redis client.
+    prefix : `str`
+        A prefix for all keys.
+    """
+
+    def __init__(self, redis, prefix='flask-twilio:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def get(self, key):
+        """Get an item, or ``None`` if it is not present or has expired."""
+        return self.redis.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        """
+        Add an item.
+
+        Parameters
+        ----------
+        key : `str`
+            The key.
+        value : `bytes`
+            The value.
+        ttl : `float`, optional
+            The number of seconds after which the item expires.
+        """
+        px = None if ttl is None else max(1, int(ttl * 1000))
+        self.redis.set(self.prefix + key, value, px=px)
+
+    def add(self, key, value, ttl=None):
+        """
+        Add an item only if it is not already present. Returns ``True`` if
+        the item was added.
+        """
+        px = None if ttl is None else max(1, int(ttl * 1000))
+        return bool(self.redis.set(self.prefix + key, value, px=px, nx=True))
+
+
+class _CachedKeySigner(TimestampSigner):
+    """
+    A :py:class:`itsdangerous.TimestampSigner` that derives its signing key
+    from the secret key only once, instead of on every call.
+    """
+
+    def __init__(self, *args, **kwargs):
+        TimestampSigner.__init__(self, *args, **kwargs)
+        self._derived_keys = {}
+
+    def derive_key(self, *args):
+        try:
+            return self._derived_keys[args]
+        except KeyError:
+            key = self._derived_keys[args] = TimestampSigner.derive_key(
+                self, *args)
+            return key
+
+
+class UnknownAccountError(TwilioException):
+    """
+    Raised when an account is given explicitly, but
+    ``TWILIO_CREDENTIALS_RESOLVER`` has no credentials for it.
+
+    Attributes
+    ----------
+    account : `str`
+        The account SID.
+    """
+
+    def __init__(self, account):
+        TwilioException.__init__(
+            self, 'No credentials for account {}'.format(account))
+        self.account = account
+
+
+class _Tenant(object):
+    """The credentials, validator, and REST client for one account."""
+
+    __slots__ = ('credentials', 'from_', 'validator', 'client', 'lock')
+
+    def __init__(self, credentials):
+        username = credentials.get('auth_sid') or credentials['account_sid']
+        self.credentials = dict(
+            username=username, password=credentials['auth_token'],
+            account_sid=credentials['account_sid'])
+        self.from_ = credentials.get('from')
+        self.validator = RequestValidator(credentials['auth_token'])
+        self.client = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        client = self.client
+        if client is not None:
+            client.http_client.close()
+
+
+class _TenantCache(LRUCache):
+    """
+    An :py:class:`LRUCache` of :py:class:`_Tenant` objects that also discards
+    tenants that have not been used for `idle_timeout` seconds.
+
+    Discarded tenants are not closed, because other threads may still be
+    sending with their clients. Their connection pools are closed when the
+    last reference to them is dropped.
+    """
+
+    def __init__(self, maxsize=100, idle_timeout=300.0):
+        LRUCache.__init__(self, maxsize)
+        self.idle_timeout = idle_timeout
+
+    def _evict(self, now):
+        # Must be called with the lock held. The least recently used items
+        # come first, so idle items are always at the front.
+        data = self.data
+        while data and (len(data) > self.maxsize or
+                        next(iter(data.values()))[0] <= now):
+            data.popitem(last=False)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self._evict(now)
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            self.data[key] = (now + self.idle_timeout, entry[1])
+            self.data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Add a tenant, unless there already is one for `key`. Returns the
+        tenant that is in the cache.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                value = entry[1]
+            self.data[key] = (now + self.idle_timeout, value)
+            self.data.move_to_end(key)
+            self._evict(now)
+        return value
+
+    def clear(self):
+        """Discard all tenants and close their connection pools."""
+        with self.lock:
+            tenants = [value for _, value in self.data.values()]
+            self.data.clear()
+        for tenant in tenants:
+            tenant.close()
+
+
+_unset = object()
+
+
+def _make_password():
+    """
+    Make a password that proves that a request from Twilio was initiated by
+    this application: a random string that has been signed with
+    `itsdangerous`. Returns ``None`` in debug or testing mode, or if no secret
+    key is set.
+    """
+    if current_app.debug or current_app.testing:
+        return None
+    signer = current_app.extensions['twilio'].get_signer()[0]
+    if signer is not None:
+        token = ''.join(rand.choice(letters_and_digits) for i in range(32))
+        return signer.sign(token).decode()
+
+
+class _TwilioState(object):
+    """
+    Per-application state that is shared by all requests and threads in a
+    worker process.
+    """
+
+    def __init__(self, app, twilio):
+        self.app = app
+        self.twilio = twilio
+        # Reentrant, because clients are made with the lock held, and making
+        # one sets up the metrics, rate limiter, and pool of numbers.
+        self.lock = threading.RLock()
+        self.pid = None
+        self.client = None
+        self.async_clients = {}
+        self.tenants = None
+        self.tenant_misses = None
+        self.executor = None
+        self.outbox = None
+        self.outbox_workers = []
+        self.outbox_stop = threading.Event()
+        self.outbox_wakeup = threading.Event()
+        self.limiter = _unset
+        self.numbers = _unset
+        self.status_buffer = None
+        self.idempotency_cache = None
+        self.validator = (None, None)
+        self.signer = (None, None, None)
+        self.metrics = _unset
+
+    def check_pid(self):
+        """
+        Discard everything that was inherited from the parent process after a
+        fork, so that workers never share sockets. Must be called with
+        :py:attr:`lock` held.
+        """
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid = pid
+            self.client = None
+            self.async_clients = {}
+            self.tenants = None
+            self.executor = None
+            self.numbers = _unset
+            self.status_buffer = None
+            self.outbox = None
+            self.outbox_workers = []
+            self.outbox_stop = threading.Event()
+            self.outbox_wakeup = threading.Event()
+
+    def get_metrics(self):
+        metrics = self.metrics
+        if metrics is _unset:
+            with self.lock:
+                metrics = self.metrics
+                if metrics is _unset:
+                    metrics = self.app.config['TWILIO_METRICS']
+                    if metrics == 'prometheus':
+                        metrics = PrometheusMetrics()
+                    elif metrics == 'signals':
+                        metrics = SignalMetrics(self.app)
+                    self.metrics = metrics
+        return metrics
+
+    def get_account(self, account=None):
+        """
+        Decide which account to use for a request or send: `account` if it is
+        given, or else the ``AccountSid`` of the webhook that is being
+        handled, once :py:meth:`Twilio._authenticate` has accepted it.
+        Returns ``None`` for the account that is configured by
+        ``TWILIO_ACCOUNT_SID``, or if there is no credential resolver.
+        """
+        config = self.app.config
+        if config['TWILIO_CREDENTIALS_RESOLVER'] is None:
+            return None
+        if account is None and has_request_context():
+            # Never trust the AccountSid of a request that has not been
+            # authenticated, or any caller could choose whose credentials
+            # to send with.
+            account = g.get('_twilio_account')
+        if account == config.get('TWILIO_ACCOUNT_SID'):
+            return None
+        return account
+
+    def get_tenants(self):
+        tenants = self.tenants
+        if tenants is not None and self.pid == os.getpid():
+            return tenants
+        with self.lock:
+            self.check_pid()
+            if self.tenants is None:
+                config = self.app.config
+                self.tenant_misses = LRUCache(
+                    config['TWILIO_TENANT_CACHE_SIZE'])
+                self.tenants = _TenantCache(
+                    config['TWILIO_TENANT_CACHE_SIZE'],
+                    config['TWILIO_TENANT_IDLE_TIMEOUT'])
+            return self.tenants
+
+    def get_tenant(self, account, required=True):
+        """
+        Get the credentials, validator, and client for an account, or
+        ``None`` to use the configured account.
+
+        If the credential resolver has no credentials for `account`, then
+        raise :py:class:`UnknownAccountError`, or return ``None`` if
+        `required` is false. Unknown accounts are remembered for
+        ``TWILIO_TENANT_MISS_TTL`` seconds, so that requests for them do not
+        call the resolver every time.
+        """
+        if account is None:
+            return None
+        tenants = self.get_tenants()
+        tenant = tenants.get(account)
+        if tenant is None:
+            config = self.app.config
+            if self.tenant_misses.get(account):
+                credentials = None
+            else:
+                credentials = config['TWILIO_CREDENTIALS_RESOLVER'](account)
+            if credentials is None:
+                ttl = config['TWILIO_TENANT_MISS_TTL']
+                if ttl > 0:
+                    self.tenant_misses.set(account, True, ttl)
+                if required:
+                    raise UnknownAccountError(account)
+                return None
+            tenant = tenants.set(account, _Tenant(credentials))
+        return tenant
+
+    def get_validator(self, account=None):
+        tenant = self.get_tenant(account)
+        if tenant is not None:
+            return tenant.validator
+        auth_token = self.app.config['TWILIO_AUTH_TOKEN']
+        validator, validator_token = self.validator
+        if validator is None or validator_token != auth_token:
+            validator = RequestValidator(auth_token)
+            self.validator = validator, auth_token
+        return validator
+
+    def get_signer(self):
+        """
+        Get the signer for HTTP basic auth passwords, and a cache of
+        passwords that it has already validated.
+        """
+        signer, passwords, secret_key = self.signer
+        if secret_key != self.app.secret_key:
+            secret_key = self.app.secret_key
+            if secret_key is None:
+                signer = passwords = None
+            else:
+                signer = _CachedKeySigner(secret_key, 'twilio')
+                passwords = LRUCache(self.app.config['TWILIO_AUTH_CACHE_SIZE'])
+            self.signer = signer, passwords, secret_key
+        return signer, passwords
+
+    def check_password(self, password):
+        """
+        Check that an HTTP basic auth password was signed by this application
+        less than 10 minutes ago.
+
+        Twilio sends the same credentials with every request during a call,
+        so passwords that have been validated are remembered until they
+        expire.
+        """
+        signer, passwords = self.get_signer()
+        if passwords.get(password):
+            return True
+        try:
+            _, timestamp = signer.unsign(
+                password, max_age=600, return_timestamp=True)
+        except BadSignature:
+            return False
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        ttl = timestamp.timestamp() + 600 - time.time()
+        if ttl > 0:
+            passwords.set(password, True, ttl)
+        return True
+
+    def get_idempotency_cache(self):
+        cache = self.idempotency_cache
+        if cache is None:
+            with self.lock:
+                cache = self.idempotency_cache
+                if cache is None:
+                    cache = self.app.config['TWILIO_IDEMPOTENCY_CACHE']
+                    if cache is None:
+                        cache = LRUCache(
+                            self.app.config['TWILIO_IDEMPOTENCY_CACHE_SIZE'])
+                    elif isinstance(cache, str):
+                        cache = SQLiteCache(cache)
+                    self.idempotency_cache = cache
+        return cache
+
+    def get_credentials(self):
+        config = self.app.config
+        username = config.get('TWILIO_AUTH_SID')
+        account_sid = config.get('TWILIO_ACCOUNT_SID')
+        if username is None:
+            username = account_sid
+        elif account_sid is None:
+            account_sid = username
+        password = config['TWILIO_AUTH_TOKEN']
+        return dict(
+            username=username, password=password, account_sid=account_sid)
+
+    def get_client(self, account=None):
+        tenant = self.get_tenant(account)
+        if tenant is not None:
+            client = tenant.client
+            if client is None:
+                with tenant.lock:
+                    if tenant.client is None:
+                        tenant.client = self.make_client(tenant.credentials)
+                    client = tenant.client
+            return client
+        client = self.client
+        if client is not None and self.pid == os.getpid():
+            return client
+        with self.lock:
+            self.check_pid()
+            if self.client is None:
+                self.client = self.make_client(self.get_credentials())
+            return self.client
+
+    def make_client(self, credentials):
+        config = self.app.config
+        http_client = _load_http_client()(
+            pool_size=config['TWILIO_POOL_SIZE'],
+            timeout=config['TWILIO_TIMEOUT'],
+            base_url=config['TWILIO_API_URL'],
+            connect_retries=config['TWILIO_CONNECT_RETRIES'],
+            metrics=self.get_metrics(),
+            retry=self.make_retry_policy(),
+            breaker=self.make_circuit_breaker(),
+            limiter=self.get_limiter(),
+            send_rate=config['TWILIO_SEND_RATE'],
+            send_burst=config['TWILIO_SEND_BURST'],
+            numbers=self.get_numbers())
+        from twilio.rest import Client
+        return Client(http_client=http_client, **credentials)
+
+    def make_retry_policy(self):
+        config = self.app.config
+        if not config['TWILIO_RETRIES']:
+            return None
+        budget = config['TWILIO_RETRY_BUDGET']
+        return RetryPolicy(
+            max_retries=config['TWILIO_RETRIES'],
+            backoff=config['TWILIO_RETRY_BACKOFF'],
+            max_backoff=config['TWILIO_RETRY_MAX_BACKOFF'],
+            statuses=config['TWILIO_RETRY_STATUSES'],
+            budget=None if budget is None else RetryBudget(budget))
+
+    def make_circuit_breaker(self):
+        config = self.app.config
+        if not config['TWILIO_BREAKER_THRESHOLD']:
+            return None
+        return CircuitBreaker(
+            threshold=config['TWILIO_BREAKER_THRESHOLD'],
+            cooldown=config['TWILIO_BREAKER_COOLDOWN'])
 
-    def __init__(self, *args, **kwargs):
-        TwiML.__init__(self)
-        FlaskResponse.__init__(self, *args, **kwargs)
+    async def get_async_client(self, account=None):
+        """
+        Get a :py:class:`twilio.rest.Client` that uses an asynchronous HTTP
+        transport. Its connections can only be used from the event loop that
+        created them, so there is one client per running event loop and
+        account.
+        """
+        import asyncio
+        from twilio.http.async_http_client import AsyncTwilioHttpClient
+        from twilio.rest import Client
+        tenant = self.get_tenant(account)
+        key = asyncio.get_running_loop(), account
+        with self.lock:
+            self.check_pid()
+            entry = self.async_clients.get(key)
+        if entry is None:
+            http_client = AsyncTwilioHttpClient(
+                timeout=self.app.config['TWILIO_TIMEOUT'])
+            credentials = (self.get_credentials() if tenant is None
+                           else tenant.credentials)
+            client = Client(http_client=http_client, **credentials)
+            # Flask runs each async view in its own short-lived event loop.
+            # Event loops finalize their asynchronous generators before they
+            # close, so a suspended generator is a convenient hook to close
+            # the client's session along with the loop.
+            lifetime = self.async_client_lifetime(key, http_client)
+            await lifetime.__anext__()
+            entry = self.async_clients[key] = (client, lifetime)
+        return entry[0]
 
-    @property
-    def response(self):
-        return [self.to_xml()]
+    async def async_client_lifetime(self, key, http_client):
+        try:
+            yield
+        finally:
+            self.async_clients.pop(key, None)
+            await http_client.close()
 
-    @response.setter
-    def response(self, value):
-        pass
+    def get_executor(self):
+        executor = self.executor
+        if executor is not None and self.pid == os.getpid():
+            return executor
+        with self.lock:
+            self.check_pid()
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(
+                    self.app.config['TWILIO_MAX_WORKERS'])
+            return self.executor
+
+    def send_deferred(self, kind, create, kwargs):
+        """
+        Send a call or message that was deferred until after the response,
+        and hand any exception to ``TWILIO_DEFER_ERROR_HANDLER``.
+        """
+        try:
+            create(**kwargs)
+        except Exception as e:
+            handler = self.app.config['TWILIO_DEFER_ERROR_HANDLER']
+            with self.app.app_context():
+                if handler is None:
+                    self.app.logger.exception(
+                        'Failed to send deferred %s to %s',
+                        kind, kwargs.get('to'))
+                else:
+                    handler(kind, kwargs, e)
+
+    def defer(self, kind, create, kwargs):
+        """
+        Send a call or message after the response to the current request has
+        been sent, or in the thread pool if there is no request.
+        """
+        send = partial(self.send_deferred, kind, create, kwargs)
+        if not has_request_context():
+            self.get_executor().submit(send)
+            return
+
+        @after_this_request
+        def send_after_response(response):
+            response.call_on_close(send)
+            return response
+
+    def enqueue(self, outbox, kind, kwargs, key, account=None):
+        """Queue a call or message in the outbox, and return its key."""
+        if account is not None:
+            kwargs = dict(kwargs, account=account)
+        key = outbox.put(kind, kwargs, key)
+        self.outbox_wakeup.set()
+        return key
+
+    def send_or_enqueue(self, outbox, kind, create, key, account=None,
+                        queued=None):
+        """
+        Wrap `create` so that while the circuit breaker is open, the call or
+        message is queued in the outbox instead, with the keyword arguments
+        `queued` if they are given. For ``TWILIO_OUTBOX_MODE = 'fallback'``.
+        """
+        def send(**kwargs):
+            try:
+                return create(**kwargs)
+            except CircuitOpenError:
+                return self.enqueue(outbox, kind, kwargs if queued is None
+                                    else queued, key, account)
+        return send
+
+    def update_call(self, client, sid, status):
+        """Cancel or hang up a call, and log any failure."""
+        try:
+            client.calls(sid).update(status=status)
+        except Exception:
+            self.app.logger.exception(
+                'Failed to set status of call %s to %s', sid, status)
+
+    def update_calls(self, client, sids, status):
+        """Cancel or hang up calls concurrently."""
+        executor = self.get_executor()
+        for sid in sids:
+            executor.submit(self.update_call, client, sid, status)
+
+    def dial_placed(self, group, sids, account):
+        """
+        Record the calls of a dial group after they have been placed. If one
+        was answered already, then cancel the others now.
+        """
+        backend = self.get_idempotency_cache()
+        ttl = self.app.config['TWILIO_DIAL_TTL']
+        backend.set('dial:{}'.format(group), json.dumps(sids).encode(), ttl)
+        answered = backend.get('dial:{}:answered'.format(group))
+        if answered is not None:
+            if isinstance(answered, bytes):
+                answered = answered.decode()
+            self.update_calls(
+                self.get_client(account),
+                [sid for sid in sids if sid != answered], 'canceled')
+
+    def dial_status(self, group, sid, status, account):
+        """
+        Handle a status callback for one call of a dial group. The first call
+        to be answered cancels the others, and calls that are answered later
+        are hung up.
+        """
+        if status != 'in-progress':
+            return
+        backend = self.get_idempotency_cache()
+        ttl = self.app.config['TWILIO_DIAL_TTL']
+        client = self.get_client(account)
+        if backend.add('dial:{}:answered'.format(group), sid.encode(), ttl):
+            sids = backend.get('dial:{}'.format(group))
+            # If the calls are still being placed, then dial_placed cancels
+            # them instead.
+            if sids is not None:
+                self.update_calls(
+                    client, [other for other in json.loads(sids)
+                             if other != sid], 'canceled')
+        else:
+            self.update_calls(client, [sid], 'completed')
+
+    def get_numbers(self):
+        """Get the pool of sending numbers, if there is more than one."""
+        numbers = self.numbers
+        if numbers is _unset:
+            with self.lock:
+                numbers = self.numbers
+                if numbers is _unset:
+                    config = self.app.config
+                    numbers = config['TWILIO_FROM']
+                    if isinstance(numbers, (list, tuple)):
+                        numbers = NumberPool(
+                            numbers, config['TWILIO_FROM_STRATEGY'],
+                            metrics=self.get_metrics())
+                    else:
+                        numbers = None
+                    self.numbers = numbers
+        return numbers
+
+    def get_limiter(self):
+        """Get the rate limiter for sending numbers, if any."""
+        limiter = self.limiter
+        if limiter is _unset:
+            with self.lock:
+                limiter = self.limiter
+                if limiter is _unset:
+                    config = self.app.config
+                    limiter = config['TWILIO_SEND_LIMITER']
+                    if config['TWILIO_SEND_RATE'] is None:
+                        limiter = None
+                    elif limiter is None:
+                        limiter = RateLimiter()
+                    elif isinstance(limiter, str):
+                        limiter = SharedRateLimiter(limiter)
+                    self.limiter = limiter
+        return limiter
+
+    async def throttle_async(self, from_):
+        """Wait for a token from the rate limiter for a sending number."""
+        limiter = self.get_limiter()
+        if limiter is not None:
+            config = self.app.config
+            delay = limiter.reserve(
+                from_, config['TWILIO_SEND_RATE'], config['TWILIO_SEND_BURST'])
+            if delay > 0:
+                import asyncio
+                await asyncio.sleep(delay)
+
+    def open_outbox(self):
+        """Open the outbox database, if one is configured."""
+        config = self.app.config
+        if config['TWILIO_OUTBOX'] is None:
+            return None
+        return Outbox(
+            config['TWILIO_OUTBOX'],
+            max_attempts=config['TWILIO_OUTBOX_MAX_ATTEMPTS'],
+            retry_delay=config['TWILIO_OUTBOX_RETRY_DELAY'],
+            lease=config['TWILIO_OUTBOX_LEASE'])
+
+    def get_outbox(self, start_workers=True):
+        outbox = self.outbox
+        if outbox is not None and self.pid == os.getpid():
+            return outbox
+        with self.lock:
+            self.check_pid()
+            if self.outbox is None:
+                self.outbox = self.open_outbox()
+            if start_workers and self.outbox is not None:
+                for i in range(len(self.outbox_workers),
+                               self.app.config['TWILIO_OUTBOX_WORKERS']):
+                    thread = threading.Thread(
+                        target=self.run_outbox_worker, args=(self.outbox,),
+                        name='flask-twilio-outbox-{}'.format(i))
+                    thread.daemon = True
+                    thread.start()
+                    self.outbox_workers.append(thread)
+            return self.outbox
+
+    def send_from_outbox(self, kind, kwargs):
+        """Send a request that was stored in the outbox."""
+        client = self.get_client(kwargs.pop('account', None))
+        if kind == 'call':
+            # Sign the callback URL now rather than when the call was queued
+            # so that the credentials have not expired by the time Twilio
+            # requests the TwiML document.
+            with self.app.app_context():
+                kwargs['url'] = self.twilio._sign_url(kwargs['url'])
+            return client.calls.create(**kwargs).sid
+        else:
+            return client.messages.create(**kwargs).sid
+
+    def run_outbox_worker(self, outbox):
+        stop = self.outbox_stop
+        wakeup = self.outbox_wakeup
+        batch_size = self.app.config['TWILIO_OUTBOX_BATCH_SIZE']
+        while not stop.is_set():
+            try:
+                count = outbox.deliver(self.send_from_outbox, batch_size)
+            except Exception:
+                self.app.logger.exception('Failed to deliver from outbox')
+                count = 0
+            if not count:
+                wakeup.wait(self.app.config['TWILIO_OUTBOX_POLL_INTERVAL'])
+                wakeup.clear()
+
+    def get_status_buffer(self):
+        buffer = self.status_buffer
+        if buffer is not None and self.pid == os.getpid():
+            return buffer
+        with self.lock:
+            self.check_pid()
+            if self.status_buffer is None:
+                config = self.app.config
+                self.status_buffer = StatusBuffer(
+                    self.sink_status,
+                    batch_size=config['TWILIO_STATUS_BATCH_SIZE'],
+                    interval=config['TWILIO_STATUS_FLUSH_INTERVAL'],
+                    limit=config['TWILIO_STATUS_BUFFER_LIMIT'],
+                    logger=self.app.logger)
+            return self.status_buffer
+
+    def sink_status(self, events):
+        """Hand a batch of status callback events to the sink."""
+        sink = self.app.config['TWILIO_STATUS_SINK']
+        with self.app.app_context():
+            if sink is None:
+                status_received.send(self.app, events=events)
+            else:
+                sink(events)
+
+    def close(self, wait=True):
+        """
+        Stop outbox workers, shut down the executor, flush status callbacks,
+        and close pooled connections.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            executor, self.executor = self.executor, None
+            client, self.client = self.client, None
+            tenants, self.tenants = self.tenants, None
+            status_buffer, self.status_buffer = self.status_buffer, None
+            workers, self.outbox_workers = self.outbox_workers, []
+            self.outbox = None
+            stop, self.outbox_stop = self.outbox_stop, threading.Event()
+        stop.set()
+        self.outbox_wakeup.set()
+        if wait:
+            for thread in workers:
+                thread.join()
+        if executor is not None:
+            executor.shutdown(wait=wait)
+        if status_buffer is not None:
+            status_buffer.close()
+        if client is not None:
+            client.http_client.close()
+        if tenants is not None:
+            tenants.clear()
+
+
+# The states of all applications, so that they can be closed at exit without
+# keeping applications that have been discarded alive.
+_states = weakref.WeakSet()
+
+
+@atexit.register
+def _close_states():
+    for state in list(_states):
+        state.close()
 
 
 class Twilio(object):
@@ -48,37 +3058,156 @@ class Twilio(object):
 
     def init_app(self, app):
         """Factory method."""
-        app.teardown_appcontext(self.teardown)
+        app.config.setdefault('TWILIO_FROM_STRATEGY', 'sticky')
+        app.config.setdefault('TWILIO_POOL_SIZE', 10)
+        app.config.setdefault('TWILIO_TIMEOUT', None)
+        app.config.setdefault('TWILIO_API_URL', None)
+        app.config.setdefault('TWILIO_CONNECT_RETRIES', 2)
+        app.config.setdefault('TWILIO_RETRIES', 3)
+        app.config.setdefault('TWILIO_RETRY_BACKOFF', 0.5)
+        app.config.setdefault('TWILIO_RETRY_MAX_BACKOFF', 30.0)
+        app.config.setdefault('TWILIO_RETRY_STATUSES', (429, 503))
+        app.config.setdefault('TWILIO_RETRY_BUDGET', 0.2)
+        app.config.setdefault('TWILIO_BREAKER_THRESHOLD', 5)
+        app.config.setdefault('TWILIO_BREAKER_COOLDOWN', 30.0)
+        app.config.setdefault('TWILIO_MAX_WORKERS', 4)
+        app.config.setdefault('TWILIO_DEFER_ERROR_HANDLER', None)
+        app.config.setdefault('TWILIO_SMS_OPTIMIZE', False)
+        app.config.setdefault('TWILIO_SMS_MAX_SEGMENTS', None)
+        app.config.setdefault('TWILIO_SMS_OVER_BUDGET', 'warn')
+        app.config.setdefault('TWILIO_SEND_RATE', None)
+        app.config.setdefault('TWILIO_SEND_BURST', 1)
+        app.config.setdefault('TWILIO_SEND_LIMITER', None)
+        app.config.setdefault('TWILIO_OUTBOX', None)
+        app.config.setdefault('TWILIO_OUTBOX_MODE', 'always')
+        app.config.setdefault('TWILIO_OUTBOX_WORKERS', 1)
+        app.config.setdefault('TWILIO_OUTBOX_BATCH_SIZE', 50)
+        app.config.setdefault('TWILIO_OUTBOX_MAX_ATTEMPTS', 5)
+        app.config.setdefault('TWILIO_OUTBOX_RETRY_DELAY', 1.0)
+        app.config.setdefault('TWILIO_OUTBOX_LEASE', 300.0)
+        app.config.setdefault('TWILIO_OUTBOX_POLL_INTERVAL', 1.0)
+        app.config.setdefault('TWILIO_IDEMPOTENCY_CACHE', None)
+        app.config.setdefault('TWILIO_IDEMPOTENCY_CACHE_SIZE', 1024)
+        app.config.setdefault('TWILIO_IDEMPOTENCY_TTL', 600)
+        app.config.setdefault('TWILIO_DIAL_TTL', 3600)
+        app.config.setdefault('TWILIO_AUTH_CACHE_SIZE', 4096)
+        app.config.setdefault('TWILIO_CREDENTIALS_RESOLVER', None)
+        app.config.setdefault('TWILIO_TENANT_CACHE_SIZE', 100)
+        app.config.setdefault('TWILIO_TENANT_IDLE_TIMEOUT', 300.0)
+        app.config.setdefault('TWILIO_TENANT_MISS_TTL', 60.0)
+        app.config.setdefault('TWILIO_METRICS', None)
+        app.config.setdefault('TWILIO_METRICS_ENDPOINT', None)
+        app.config.setdefault('TWILIO_STATUS_CALLBACK_ENDPOINT', None)
+        app.config.setdefault('TWILIO_STATUS_SINK', None)
+        app.config.setdefault('TWILIO_STATUS_BATCH_SIZE', 500)
+        app.config.setdefault('TWILIO_STATUS_FLUSH_INTERVAL', 1.0)
+        app.config.setdefault('TWILIO_STATUS_BUFFER_LIMIT', 10000)
+        state = app.extensions['twilio'] = _TwilioState(app, self)
+        app.cli.add_command(cli)
+        if app.config['TWILIO_METRICS_ENDPOINT'] is not None:
+            app.add_url_rule(app.config['TWILIO_METRICS_ENDPOINT'],
+                             'twilio_metrics', self._metrics_view)
+        if app.config['TWILIO_STATUS_CALLBACK_ENDPOINT'] is not None:
+            app.add_url_rule(app.config['TWILIO_STATUS_CALLBACK_ENDPOINT'],
+                             'twilio_status_callback', self._status_view,
+                             methods=['POST'])
+        _states.add(state)
+
+    def _get_state(self):
+        if has_app_context():
+            return current_app.extensions['twilio']
+        elif self.app is not None:
+            return self.app.extensions['twilio']
+
+    @property
+    def metrics(self):
+        """
+        The application's metrics sink, or ``None`` if ``TWILIO_METRICS`` is
+        not set.
+        """
+        state = self._get_state()
+        if state is not None:
+            return state.get_metrics()
+
+    def _metrics_view(self):
+        metrics = self.metrics
+        if not isinstance(metrics, PrometheusMetrics):
+            abort(404)
+        return current_app.response_class(
+            metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    def _status_view(self):
+        # Status callbacks may arrive long after the request was made, when
+        # a basic auth password would have expired, so they are not signed.
+        # The X-Twilio-Signature header is still validated.
+        rv = self._authenticate(basic_auth=False)
+        if rv is not None:
+            return rv
+        state = self._get_state()
+        group = request.args.get('dial_group')
+        if group is not None and 'CallSid' in request.form:
+            state.dial_status(
+                group, request.form['CallSid'], request.form.get('CallStatus'),
+                state.get_account())
+        state.get_status_buffer().put(request.form.to_dict())
+        return '', 204
+
+    @property
+    def outbox(self):
+        """
+        The application's :py:class:`Outbox`, or ``None`` if ``TWILIO_OUTBOX``
+        is not set.
+        """
+        state = self._get_state()
+        if state is not None:
+            return state.get_outbox(start_workers=False)
+
+    def shutdown(self, wait=True):
+        """
+        Shut down the thread pool that runs :py:meth:`call_for_async` and
+        :py:meth:`message_async`, stop outbox workers, and close all pooled
+        connections. This is done automatically when the interpreter exits.
 
-    def teardown(self, exception):
-        ctx = stack.top
-        if hasattr(ctx, 'twilio_client'):
-            del ctx.twilio_client
-        if hasattr(ctx, 'twilio_validator'):
-            del ctx.twilio_validator
-        if hasattr(ctx, 'twilio_signer'):
-            del ctx.twilio_signer
+        Parameters
+        ----------
+        wait : `bool`
+            If true, then wait for all queued requests to finish.
+        """
+        state = self._get_state()
+        if state is not None:
+            state.close(wait=wait)
 
     @property
     def client(self):
         """
-        An application-specific intance of
-        :py:class:`twilio.rest.Client`. Primarily for internal use.
-        """
-        ctx = stack.top
-        if ctx is not None:
-            if not hasattr(ctx, 'twilio_client'):
-                username = current_app.config.get('TWILIO_AUTH_SID')
-                account_sid = current_app.config.get('TWILIO_ACCOUNT_SID')
-                if username is None:
-                    username = account_sid
-                elif account_sid is None:
-                    account_sid = username
-                password = current_app.config['TWILIO_AUTH_TOKEN']
-                ctx.twilio_client = Client(
-                    username=username, password=password,
-                    account_sid=account_sid)
-            return ctx.twilio_client
+        An application-specific intance of :py:class:`twilio.rest.Client`.
+        Primarily for internal use.
+
+        The client is created once per application and worker process and is
+        shared by all threads. Its connections to the Twilio API are kept
+        alive between requests in a :py:class:`PooledHttpClient`. If the
+        process forks, then the child creates its own client.
+
+        If ``TWILIO_CREDENTIALS_RESOLVER`` is set, then while handling a
+        webhook this is the client for the webhook's ``AccountSid``.
+        """
+        return self.client_for()
+
+    def client_for(self, account=None):
+        """
+        Get the :py:class:`twilio.rest.Client` for an account.
+
+        Parameters
+        ----------
+        account : `str`, optional
+            The account, which is passed to ``TWILIO_CREDENTIALS_RESOLVER``.
+            Defaults to the ``AccountSid`` of the webhook that is being
+            handled, if any, or else the account that is configured by
+            ``TWILIO_ACCOUNT_SID``.
+        """
+        state = self._get_state()
+        if state is not None:
+            return state.get_client(state.get_account(account))
 
     @property
     def validator(self):
@@ -86,13 +3215,24 @@ class Twilio(object):
         An application-specific instance of
         :py:class:`twilio.request_validator.RequestValidator`.
         Primarily for internal use.
+
+        If ``TWILIO_CREDENTIALS_RESOLVER`` is set, then while handling a
+        webhook this validates signatures with the auth token of the
+        webhook's ``AccountSid``.
+        """
+        state = self._get_state()
+        if state is not None:
+            return state.get_validator(state.get_account())
+
+    @property
+    def numbers(self):
         """
-        ctx = stack.top
-        if ctx is not None:
-            if not hasattr(ctx, 'twilio_validator'):
-                ctx.twilio_validator = RequestValidator(
-                    current_app.config['TWILIO_AUTH_TOKEN'])
-            return ctx.twilio_validator
+        The :py:class:`NumberPool` of sending numbers in this process, or
+        ``None`` if ``TWILIO_FROM`` is a single number.
+        """
+        state = self._get_state()
+        if state is not None:
+            return state.get_numbers()
 
     @property
     def signer(self):
@@ -101,68 +3241,416 @@ class Twilio(object):
         :py:class:`itsdangerous.TimestampSigner`, or ``None`` if no secret key
         is set. Primarily for internal use.
         """
-        ctx = stack.top
-        if ctx is not None:
-            if not hasattr(ctx, 'twilio_signer'):
-                if current_app.secret_key is not None:
-                    ctx.twilio_signer = TimestampSigner(
-                        current_app.secret_key, 'twilio')
-                else:
-                    ctx.twilio_signer = None
-            return ctx.twilio_signer
-
-    def twiml(self, view_func):
-        """Decorator for marking view that will create TwiML documents."""
-        @wraps(view_func)
-        def wrapper(*args, **kwargs):
-            if not(current_app.debug or current_app.testing):
-                if request.method != 'POST':
-                    abort(405)
-
-                # Perform HTTP Basic authentication if a secret key is set.
-                #
-                # The username must be `twilio`, and the password must be a
-                # validly signed string that was generated less than 10 minutes
-                # ago. This guarantees that the Twilio call was initiated by
-                # this application, rather than a malicious agent.
-                #
-                # Note that if we are using HTTP, then a malicious agent can
-                # still snoop on the data that we are sending to and from
-                # Twilio, and can also spoof our reply to Twilio. Both issues
-                # would be addressed by using HTTPS.
-                if self.signer is not None:
-                    auth = request.authorization
-                    authorized = (
-                        auth and
-                        auth.username == 'twilio' and
-                        self.signer.validate(auth.password, max_age=600))
-                    if not authorized:
-                        # If authorization failed, then issue a challenge.
-                        return 'Unauthorized', 401, {
-                            'WWW-Authenticate': 'Basic realm="Login Required"'}
-                # Validate the Twilio request. This guarantees that the request
-                # came from Twilio, rather than some other malicious agent.
-                valid = self.validator.validate(
-                    request.url,
-                    request.form,
-                    request.headers.get('X-Twilio-Signature', ''))
-                if not valid:
-                    # If the request was spoofed, then send '403 Forbidden'.
-                    abort(403)
-            # Call the view itself.
-            rv = view_func(*args, **kwargs)
-            # Adjust MIME type and return.
-            resp = make_response(rv)
-            resp.mimetype = 'text/xml'
+        state = self._get_state()
+        if state is not None:
+            return state.get_signer()[0]
+
+    def _authenticate(self, timer=None, basic_auth=True):
+        """
+        Check that a request to a TwiML view came from Twilio on behalf of
+        this application. Returns ``None`` if the request is valid, or else a
+        response to send instead of calling the view. The ``AccountSid`` of a
+        valid request is used by :py:meth:`_TwilioState.get_account`, unless
+        the credential resolver does not know it, in which case the request is
+        validated with, and handled as, the configured account.
+        """
+        state = current_app.extensions['twilio']
+        account = state.get_account(request.values.get('AccountSid'))
+        if state.get_tenant(account, required=False) is None:
+            account = None
+        if not(current_app.debug or current_app.testing):
+            if request.method != 'POST':
+                abort(405)
+
+            # Perform HTTP Basic authentication if a secret key is set.
+            #
+            # The username must be `twilio`, and the password must be a
+            # validly signed string that was generated less than 10 minutes
+            # ago. This guarantees that the Twilio call was initiated by
+            # this application, rather than a malicious agent.
+            #
+            # Note that if we are using HTTP, then a malicious agent can
+            # still snoop on the data that we are sending to and from
+            # Twilio, and can also spoof our reply to Twilio. Both issues
+            # would be addressed by using HTTPS.
+            if basic_auth and state.get_signer()[0] is not None:
+                auth = request.authorization
+                authorized = (
+                    auth and
+                    auth.username == 'twilio' and
+                    state.check_password(auth.password))
+                if timer is not None:
+                    timer.lap('auth')
+                if not authorized:
+                    # If authorization failed, then issue a challenge.
+                    return 'Unauthorized', 401, {
+                        'WWW-Authenticate': 'Basic realm="Login Required"'}
+            # Validate the Twilio request. This guarantees that the request
+            # came from Twilio, rather than some other malicious agent. The
+            # signature must have been made with the auth token of the
+            # account that the request claims to be for.
+            validator = state.get_validator(account)
+            valid = validator.validate(
+                request.url,
+                request.form,
+                request.headers.get('X-Twilio-Signature', ''))
+            if timer is not None:
+                timer.lap('validate')
+            if not valid:
+                # If the request was spoofed, then send '403 Forbidden'.
+                abort(403)
+        g._twilio_account = account
+
+    def twiml(self, view_func=None, cache=None, vary=(), idempotent=False,
+              max_concurrency=None, deadline=None, fallback=None):
+        """
+        Decorator for marking view that will create TwiML documents.
+
+        The view may be a coroutine function (``async def``). The checks that
+        are done before calling the view only use the CPU, so they run
+        directly in the event loop without blocking on I/O.
+
+        The decorator may be used bare, as ``@twilio.twiml``, or with
+        arguments, as ``@twilio.twiml(cache=128)``.
+
+        Parameters
+        ----------
+        cache : `int` or :py:class:`LRUCache`, optional
+            If given, then cache the serialized documents that the view
+            produces in an LRU cache of this size. Requests are still
+            authenticated, but on a cache hit the view is not called at all.
+            Only responses with status 200 are cached.
+        vary : `tuple`
+            Names of request values (form or query parameters) that the
+            document depends on, in addition to the view's arguments. For
+            example, ``vary=('From',)`` caches a separate document for each
+            caller.
+        idempotent : `bool` or cache backend, optional
+            If true, then remember the response to each request that carries
+            a ``CallSid`` or ``MessageSid`` for ``TWILIO_IDEMPOTENCY_TTL``
+            seconds. When Twilio retries a request after a timeout, the
+            original response is sent again without calling the view. The
+            responses are stored in the backend that is configured by
+            ``TWILIO_IDEMPOTENCY_CACHE``, or in the given backend (such as an
+            :py:class:`LRUCache`, :py:class:`SQLiteCache`, or
+            :py:class:`RedisCache`).
+        max_concurrency : `int`, optional
+            If given, then at most this many requests run the view at once in
+            each worker process. Other requests get the `fallback` document
+            instead of waiting.
+        deadline : `float`, optional
+            If given, then requests that have already waited in a queue for
+            longer than this many seconds get the `fallback` document instead
+            of calling the view. The time at which each request arrived is
+            taken from the ``X-Request-Start`` header, which is added by many
+            load balancers and web servers; requests without the header are
+            never shed.
+        fallback : :py:class:`twilio.twiml.TwiML`, `str`, or `bytes`
+            The document to send instead of calling the view when the view is
+            overloaded, such as a ``<Say>`` asking the caller to hold followed
+            by a ``<Redirect>`` back to the view. It is serialized once, when
+            the view is decorated. Required if `max_concurrency` or
+            `deadline` is given.
+
+        Notes
+        -----
+        Requests that get the fallback document are counted by the counter
+        ``twilio_twiml_shed_total`` of the metrics sink, labeled by view and
+        reason (``'concurrency'`` or ``'deadline'``), and in the decorated
+        view's ``shed_counts`` dictionary.
+        """
+        if view_func is None:
+            return partial(
+                self.twiml, cache=cache, vary=vary, idempotent=idempotent,
+                max_concurrency=max_concurrency, deadline=deadline,
+                fallback=fallback)
+        if cache is not None and not isinstance(cache, LRUCache):
+            cache = LRUCache(cache)
+        if max_concurrency is None and deadline is None:
+            fallback = None
+        elif fallback is None:
+            raise ValueError(
+                'A fallback document is required with max_concurrency or '
+                'deadline')
+        elif isinstance(fallback, TwiML):
+            fallback = fallback.to_xml().encode('utf-8')
+        elif isinstance(fallback, str):
+            fallback = fallback.encode('utf-8')
+        slots = None
+        if max_concurrency is not None:
+            slots = threading.BoundedSemaphore(max_concurrency)
+        shed_counts = {'concurrency': 0, 'deadline': 0}
+        shed_lock = threading.Lock()
+
+        view_name = view_func.__name__
+
+        def before(args, kwargs, timer):
+            # Return a response to send instead of calling the view, if any,
+            # and a list of (backend, key, ttl) in which to store the
+            # response.
+            rv = self._authenticate(timer)
+            if rv is not None:
+                return rv, []
+            stores = []
+            if idempotent:
+                sid = (request.values.get('CallSid') or
+                       request.values.get('MessageSid'))
+                if sid:
+                    if idempotent is True:
+                        backend = current_app.extensions[
+                            'twilio'].get_idempotency_cache()
+                    else:
+                        backend = idempotent
+                    # Several views may answer webhooks for the same call,
+                    # and in debug and testing modes there is no signature,
+                    # so the key must include the URL.
+                    key = 'idempotency:{}:{}:{}'.format(
+                        sid, request.full_path,
+                        request.headers.get('X-Twilio-Signature', ''))
+                    body = backend.get(key)
+                    if body is not None:
+                        return current_app.response_class(body), []
+                    stores.append((
+                        backend, key,
+                        current_app.config['TWILIO_IDEMPOTENCY_TTL']))
+            if cache is not None:
+                key = (args, tuple(sorted(kwargs.items())),
+                       tuple(request.values.get(name) for name in vary))
+                body = cache.get(key)
+                if body is not None:
+                    return current_app.response_class(body), stores
+                stores.append((cache, key, None))
+            return None, stores
+
+        def shed(reason):
+            with shed_lock:
+                shed_counts[reason] += 1
+            metrics = current_app.extensions['twilio'].get_metrics()
+            if metrics is not None:
+                metrics.increment('twilio_twiml_shed_total',
+                                  {'view': view_name, 'reason': reason})
+            return current_app.response_class(fallback)
+
+        def admit():
+            # Return the fallback response if the view is overloaded, or else
+            # take a slot to run the view and return None.
+            if fallback is None:
+                return None
+            if deadline is not None:
+                start = _parse_request_start(
+                    request.headers.get('X-Request-Start'))
+                if start is not None and time.time() - start > deadline:
+                    return shed('deadline')
+            if slots is not None and not slots.acquire(False):
+                return shed('concurrency')
+
+        def release():
+            if slots is not None:
+                slots.release()
+
+        def after(rv, stores, timer):
+            resp = _make_twiml_response(rv)
+            if stores and resp.status_code == 200:
+                body = resp.get_data()
+                for backend, key, ttl in stores:
+                    backend.set(key, body, ttl)
+            if timer is not None:
+                # Serialize now rather than while the response is being sent,
+                # so that the time is attributed to this stage.
+                resp.get_data()
+                timer.lap('serialize')
+                timer.finish(resp.status_code)
             return resp
+
+        def start_timer():
+            metrics = current_app.extensions['twilio'].get_metrics()
+            if metrics is not None:
+                return _StageTimer(metrics, view_name)
+
+        def abort_timer(timer, e):
+            if timer is not None:
+                timer.finish(getattr(e, 'code', 500))
+
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def wrapper(*args, **kwargs):
+                timer = start_timer()
+                try:
+                    rv, stores = before(args, kwargs, timer)
+                    if rv is None:
+                        rv = admit()
+                        if rv is not None:
+                            stores = []
+                    if rv is None:
+                        # Call the view itself.
+                        try:
+                            rv = await view_func(*args, **kwargs)
+                        finally:
+                            release()
+                        if timer is not None:
+                            timer.lap('view')
+                except Exception as e:
+                    abort_timer(timer, e)
+                    raise
+                return after(rv, stores, timer)
+        else:
+            @wraps(view_func)
+            def wrapper(*args, **kwargs):
+                timer = start_timer()
+                try:
+                    rv, stores = before(args, kwargs, timer)
+                    if rv is None:
+                        rv = admit()
+                        if rv is not None:
+                            stores = []
+                    if rv is None:
+                        # Call the view itself.
+                        try:
+                            rv = view_func(*args, **kwargs)
+                        finally:
+                            release()
+                        if timer is not None:
+                            timer.lap('view')
+                except Exception as e:
+                    abort_timer(timer, e)
+                    raise
+                return after(rv, stores, timer)
         wrapper.methods = ('GET', 'POST')
+        wrapper.shed_counts = shed_counts
         # Done!
         return wrapper
 
+    def media_stream(self, ws, seconds=10.0):
+        """
+        Create a :py:class:`MediaStream` for a WebSocket that Twilio has
+        connected to, as requested by :py:meth:`Response.connect_stream`.
+
+        Unless the application is in debug or testing mode or has no secret
+        key, the stream must carry a token that was signed by this
+        application less than 10 minutes before it started.
+
+        Parameters
+        ----------
+        ws : object
+            The WebSocket. See :py:class:`MediaStream`.
+        seconds : `float`
+            The length of audio to keep for each track.
+
+        Examples
+        --------
+        With `flask-sock <https://flask-sock.readthedocs.io/>`_::
+
+            @sock.route('/stream')
+            def stream(ws):
+                media = twilio.media_stream(ws)
+
+                @media.on('media')
+                def on_media(stream, track, samples):
+                    ...
+
+                media.run()
+        """
+        authenticate = None
+        if not (current_app.debug or current_app.testing):
+            state = current_app.extensions['twilio']
+            if state.get_signer()[0] is not None:
+                authenticate = state.check_password
+        return MediaStream(ws, seconds, authenticate)
+
     def call_for(self, endpoint, to, **values):
         """
         Initiate a Twilio call.
 
+        Parameters
+        ----------
+        endpoint : `str`
+            The view endpoint, as would be passed to :py:func:`flask.url_for`.
+        to : `str`
+            The destination phone number.
+        status_callback : `bool` or `str`, optional
+            A URL to notify when the call is completed, or ``True`` for the
+            endpoint at ``TWILIO_STATUS_CALLBACK_ENDPOINT``.
+        account : `str`, optional
+            The account to place the call from. See :py:meth:`client_for`.
+        defer : `bool`, optional
+            If true, then build and sign the URL now, but place the call after
+            the response to the current request has been sent, and return
+            ``None``. Exceptions are passed to
+            ``TWILIO_DEFER_ERROR_HANDLER``. Outside of a request, the call is
+            placed in the thread pool. If ``TWILIO_OUTBOX_MODE`` is
+            ``'always'``, then the call is queued right away and its key is
+            returned, so `defer` has no effect.
+        values : `dict`
+            Additional keyword arguments to pass to :py:func:`flask.url_for`.
+
+        Returns
+        -------
+        call : `twilio.rest.resources.Call`
+            An object representing the call in progress. If ``TWILIO_OUTBOX``
+            is set, then the call is queued instead and its idempotency key is
+            returned. A key may be given with the `idempotency_key` keyword
+            argument. If ``TWILIO_OUTBOX_MODE`` is ``'fallback'``, then the
+            call is only queued while the circuit breaker is open.
+        """
+        state = self._get_state()
+        account = state.get_account(values.pop('account', None))
+        defer = values.pop('defer', False)
+        outbox = state.get_outbox()
+        if outbox is None:
+            create = state.get_client(account).calls.create
+            kwargs = self._prepare_call(endpoint, to, values, account=account)
+            if defer:
+                return state.defer('call', create, kwargs)
+            return create(**kwargs)
+        key = values.pop('idempotency_key', None)
+        kwargs = self._prepare_call(
+            endpoint, to, values, sign=False, account=account)
+        if current_app.config['TWILIO_OUTBOX_MODE'] == 'fallback':
+            # Queue the call with an unsigned URL, to be signed when it is
+            # delivered.
+            create = state.send_or_enqueue(
+                outbox, 'call', state.get_client(account).calls.create, key,
+                account, kwargs)
+            kwargs = dict(kwargs, url=self._sign_url(kwargs['url']))
+            if defer:
+                return state.defer('call', create, kwargs)
+            return create(**kwargs)
+        return state.enqueue(outbox, 'call', kwargs, key, account)
+
+    def call_for_async(self, endpoint, to, **values):
+        """
+        Initiate a Twilio call without waiting for the Twilio API to respond.
+
+        The URL for the endpoint is constructed immediately, so this must be
+        called from within a request or application context just like
+        :py:meth:`call_for`. The REST request itself is made in a thread pool
+        of at most ``TWILIO_MAX_WORKERS`` threads.
+
+        Parameters
+        ----------
+        endpoint : `str`
+            The view endpoint, as would be passed to :py:func:`flask.url_for`.
+        to : `str`
+            The destination phone number.
+        values : `dict`
+            Additional keyword arguments to pass to :py:func:`flask.url_for`.
+
+        Returns
+        -------
+        future : :py:class:`concurrent.futures.Future`
+            A future whose result is the call in progress.
+        """
+        state = self._get_state()
+        account = state.get_account(values.pop('account', None))
+        kwargs = self._prepare_call(endpoint, to, values, account=account)
+        return state.get_executor().submit(
+            state.get_client(account).calls.create, **kwargs)
+
+    async def acall_for(self, endpoint, to, **values):
+        """
+        Initiate a Twilio call from a coroutine, using an asynchronous HTTP
+        transport. Otherwise the same as :py:meth:`call_for`.
+
         Parameters
         ----------
         endpoint : `str`
@@ -177,32 +3665,207 @@ class Twilio(object):
         call : `twilio.rest.resources.Call`
             An object representing the call in progress.
         """
+        state = self._get_state()
+        account = state.get_account(values.pop('account', None))
+        kwargs = self._prepare_call(endpoint, to, values, account=account)
+        await state.throttle_async(kwargs['from_'])
+        client = await state.get_async_client(account)
+        return await client.calls.create_async(**kwargs)
+
+    def call_for_many(self, endpoint, recipients, **values):
+        """
+        Call several people at once, and keep only the call that is answered
+        first.
+
+        All of the calls are placed concurrently in the thread pool that is
+        used by :py:meth:`call_for_async`. They share one signed URL for the
+        endpoint, so the basic auth password is only checked once. Twilio
+        reports when each call is answered to the endpoint at
+        ``TWILIO_STATUS_CALLBACK_ENDPOINT``, which must be set. The first
+        call to be answered cancels the others, and any call that is
+        answered after it is hung up.
+
+        The state of the group is kept in the backend that is configured by
+        ``TWILIO_IDEMPOTENCY_CACHE``. If the application runs in more than one
+        process, then use a backend that is shared between them, such as an
+        :py:class:`SQLiteCache` or a :py:class:`RedisCache`.
+
+        Parameters
+        ----------
+        endpoint : `str`
+            The view endpoint, as would be passed to :py:func:`flask.url_for`.
+        recipients : iterable
+            The destination phone numbers.
+        account : `str`, optional
+            The account to place the calls from. See :py:meth:`client_for`.
+        values : `dict`
+            Additional keyword arguments to pass to :py:func:`flask.url_for`.
+
+        Returns
+        -------
+        group : :py:class:`DialGroup`
+            The calls that were placed.
+        """
+        state = self._get_state()
+        account = state.get_account(values.pop('account', None))
+        recipients = list(recipients)
+        group = uuid.uuid4().hex
+        values['status_callback'] = url_for(
+            'twilio_status_callback', dial_group=group, _external=True)
+        kwargs = self._prepare_call(
+            endpoint, None, values, account=account, choose_from=False)
+        kwargs['status_callback_event'] = ['answered', 'completed']
+        senders = {to: kwargs['from_'] or self._get_from(to, account)
+                   for to in recipients}
+        create = state.get_client(account).calls.create
+
+        def place(to):
+            return create(**dict(kwargs, to=to, from_=senders[to]))
+
+        results = []
+        for to, future in _imap_unordered(
+                state.get_executor(), place, recipients, len(recipients)):
+            exception = future.exception()
+            if exception is None:
+                results.append(SendResult(to, future.result(), None))
+            else:
+                results.append(SendResult(to, None, exception))
+        state.dial_placed(group, [result.result.sid for result in results
+                                  if result.result is not None], account)
+        return DialGroup(group, results, state.get_idempotency_cache())
+
+    def _prepare_call(self, endpoint, to, values, sign=True, account=None,
+                      choose_from=True):
         # Extract keyword arguments that are intended for `calls.create`
         # instead of `url_for`.
         values = dict(values, _external=True)
-        from_ = values.pop('from_', None) or current_app.config['TWILIO_FROM']
+        from_ = values.pop('from_', None)
+        if choose_from and not from_:
+            from_ = self._get_from(to, account)
+        status_callback = self._get_status_callback(
+            values.pop('status_callback', None))
 
         # Construct URL for endpoint.
         url = url_for(endpoint, **values)
+        if sign:
+            url = self._sign_url(url)
+        kwargs = dict(to=to, from_=from_, url=url)
+        if status_callback is not None:
+            kwargs['status_callback'] = status_callback
+        return kwargs
+
+    def _get_status_callback(self, status_callback):
+        # `status_callback=True` means the built-in status callback endpoint.
+        if status_callback is True:
+            return url_for('twilio_status_callback', _external=True)
+        return status_callback or None
 
+    def _sign_url(self, url):
         # If we are not in debug or testing mode and a secret key is set, then
         # add HTTP basic auth information to the URL. The username is `twilio`.
-        # The password is a random string that has been signed with
-        # `itsdangerous`.
-        if not(current_app.debug or current_app.testing or self.signer is None):
+        password = _make_password()
+        if password is not None:
             urlparts = list(urlsplit(url))
-            token = ''.join(rand.choice(letters_and_digits) for i in range(32))
-            password = self.signer.sign(token).decode()
             urlparts[1] = 'twilio:' + password + '@' + urlparts[1]
             url = urlunsplit(urlparts)
-
-        # Issue phone call.
-        return self.client.calls.create(to=to, from_=from_, url=url)
+        return url
 
     def message(self, body, to, **values):
         """
         Send an SMS message with Twilio.
 
+        If ``TWILIO_SMS_OPTIMIZE`` is true, then characters that force the
+        message into UCS-2 are replaced by GSM-7 lookalikes when that makes
+        the message fewer segments. If ``TWILIO_SMS_MAX_SEGMENTS`` is set,
+        then a longer message is logged as a warning, or if
+        ``TWILIO_SMS_OVER_BUDGET`` is ``'reject'``, then
+        :py:class:`SegmentBudgetError` is raised instead of sending it.
+
+        Parameters
+        ----------
+        body : `str`
+            The body of the text message.
+        to : `str`
+            The destination phone number.
+        status_callback : `bool` or `str`, optional
+            A URL to notify when the status of the message changes, or
+            ``True`` for the endpoint at ``TWILIO_STATUS_CALLBACK_ENDPOINT``.
+        account : `str`, optional
+            The account to send the message from. See :py:meth:`client_for`.
+        defer : `bool`, optional
+            If true, then send the message after the response to the current
+            request has been sent, and return ``None``. Exceptions are passed
+            to ``TWILIO_DEFER_ERROR_HANDLER``. Outside of a request, the
+            message is sent in the thread pool. If ``TWILIO_OUTBOX_MODE`` is
+            ``'always'``, then the message is queued right away and its key is
+            returned, so `defer` has no effect.
+        values : `dict`
+            Additional keyword arguments to pass to
+            :py:meth:`twilio.rest.resources.SmsMessages.create`.
+
+        Returns
+        -------
+        message : :py:class:`twilio.rest.resources.SmsMessage`
+            An object representing the message that was sent. If
+            ``TWILIO_OUTBOX`` is set, then the message is queued instead and
+            its idempotency key is returned. A key may be given with the
+            `idempotency_key` keyword argument. If ``TWILIO_OUTBOX_MODE`` is
+            ``'fallback'``, then the message is only queued while the circuit
+            breaker is open.
+        """
+        state = self._get_state()
+        account = state.get_account(values.pop('account', None))
+        defer = values.pop('defer', False)
+        outbox = state.get_outbox()
+        if outbox is None:
+            create = state.get_client(account).messages.create
+            kwargs = self._prepare_message(body, to, values, account=account)
+            if defer:
+                return state.defer('message', create, kwargs)
+            return create(**kwargs)
+        key = values.pop('idempotency_key', None)
+        kwargs = self._prepare_message(body, to, values, account=account)
+        if current_app.config['TWILIO_OUTBOX_MODE'] == 'fallback':
+            create = state.send_or_enqueue(
+                outbox, 'message', state.get_client(account).messages.create,
+                key, account)
+            if defer:
+                return state.defer('message', create, kwargs)
+            return create(**kwargs)
+        return state.enqueue(outbox, 'message', kwargs, key, account)
+
+    def message_async(self, body, to, **values):
+        """
+        Send an SMS message with Twilio without waiting for the Twilio API to
+        respond. The REST request is made in a thread pool of at most
+        ``TWILIO_MAX_WORKERS`` threads.
+
+        Parameters
+        ----------
+        body : `str`
+            The body of the text message.
+        to : `str`
+            The destination phone number.
+        values : `dict`
+            Additional keyword arguments to pass to
+            :py:meth:`twilio.rest.resources.SmsMessages.create`.
+
+        Returns
+        -------
+        future : :py:class:`concurrent.futures.Future`
+            A future whose result is the message that was sent.
+        """
+        state = self._get_state()
+        account = state.get_account(values.pop('account', None))
+        kwargs = self._prepare_message(body, to, values, account=account)
+        return state.get_executor().submit(
+            state.get_client(account).messages.create, **kwargs)
+
+    async def amessage(self, body, to, **values):
+        """
+        Send an SMS message with Twilio from a coroutine, using an
+        asynchronous HTTP transport. Otherwise the same as :py:meth:`message`.
+
         Parameters
         ----------
         body : `str`
@@ -218,7 +3881,325 @@ class Twilio(object):
         message : :py:class:`twilio.rest.resources.SmsMessage`
             An object representing the message that was sent.
         """
+        state = self._get_state()
+        account = state.get_account(values.pop('account', None))
+        kwargs = self._prepare_message(body, to, values, account=account)
+        await state.throttle_async(kwargs['from_'])
+        client = await state.get_async_client(account)
+        return await client.messages.create_async(**kwargs)
+
+    def message_many(self, body, recipients, max_concurrency=None, **values):
+        """
+        Send the same SMS message to many recipients.
+
+        Messages are sent concurrently in the thread pool that is used by
+        :py:meth:`message_async`, with at most `max_concurrency` requests in
+        flight at once. If ``TWILIO_SEND_RATE`` is set, then each sending
+        number is throttled by a :py:class:`TokenBucket` so that large
+        broadcasts stay within Twilio's per-number sending limits.
+
+        The body is checked against ``TWILIO_SMS_OPTIMIZE`` and
+        ``TWILIO_SMS_MAX_SEGMENTS`` once, before anything is sent, as in
+        :py:meth:`message`.
+
+        Parameters
+        ----------
+        body : `str`
+            The body of the text message.
+        recipients : iterable
+            The destination phone numbers. This may be a lazy iterator; it is
+            consumed only as fast as messages are sent.
+        max_concurrency : `int`, optional
+            The maximum number of messages to send at once. Defaults to
+            ``TWILIO_MAX_WORKERS``.
+        account : `str`, optional
+            The account to send the messages from. See :py:meth:`client_for`.
+        values : `dict`
+            Additional keyword arguments to pass to
+            :py:meth:`twilio.rest.resources.SmsMessages.create`.
+
+        Returns
+        -------
+        results : iterator
+            An iterator of :py:class:`SendResult` objects, in the order that
+            the messages finish sending. Failures are reported in the results
+            rather than raised. The first `max_concurrency` messages are sent
+            before this method returns; the rest are sent only as the
+            iterator is consumed, so iterate over it to the end to reach
+            every recipient.
+        """
+        state = self._get_state()
+        account = state.get_account(values.pop('account', None))
+        if max_concurrency is None:
+            max_concurrency = current_app.config['TWILIO_MAX_WORKERS']
+        # With a pool of numbers, choose a number for each recipient.
+        numbers = None if values.get('from_') or (
+            self._get_tenant_from(account)) else state.get_numbers()
+        kwargs = self._prepare_message(
+            body, None, values, choose_from=numbers is None, account=account)
+        create = state.get_client(account).messages.create
+
+        def send(to):
+            if numbers is not None:
+                return create(**dict(kwargs, to=to, from_=numbers.choose(to)))
+            return create(**dict(kwargs, to=to))
+
+        def results(futures):
+            for to, future in futures:
+                exception = future.exception()
+                if exception is None:
+                    yield SendResult(to, future.result(), None)
+                else:
+                    yield SendResult(to, None, exception)
+
+        return results(_imap_unordered(
+            state.get_executor(), send, recipients, max_concurrency))
+
+    def _prepare_message(self, body, to, values, choose_from=True,
+                         account=None):
         values = dict(values)
-        from_ = values.pop('from_', None) or current_app.config['TWILIO_FROM']
-        return self.client.messages.create(
-            body=body, to=to, from_=from_, **values)
+        from_ = values.pop('from_', None)
+        if choose_from and not from_:
+            from_ = self._get_from(to, account)
+        if 'status_callback' in values:
+            values['status_callback'] = self._get_status_callback(
+                values['status_callback'])
+        return dict(body=self._check_segments(body, to), to=to, from_=from_,
+                    **values)
+
+    def _check_segments(self, body, to):
+        config = current_app.config
+        optimize = config['TWILIO_SMS_OPTIMIZE']
+        max_segments = config['TWILIO_SMS_MAX_SEGMENTS']
+        if not body or not optimize and max_segments is None:
+            return body
+        info = analyze_sms(body)
+        if optimize and info.encoding != 'GSM-7':
+            optimized = optimize_sms(body)
+            optimized_info = analyze_sms(optimized)
+            if optimized_info.segments < info.segments:
+                body, info = optimized, optimized_info
+        if max_segments is not None and info.segments > max_segments:
+            if config['TWILIO_SMS_OVER_BUDGET'] == 'reject':
+                raise SegmentBudgetError(info, max_segments)
+            current_app.logger.warning(
+                'Message to %s is %d %s segments; expected at most %d',
+                to or 'many recipients', info.segments, info.encoding,
+                max_segments)
+        return body
+
+    def _get_tenant_from(self, account):
+        tenant = self._get_state().get_tenant(account)
+        if tenant is not None:
+            return tenant.from_
+
+    def _get_from(self, to, account=None):
+        from_ = self._get_tenant_from(account)
+        if from_:
+            return from_
+        numbers = self._get_state().get_numbers()
+        if numbers is None:
+            return current_app.config['TWILIO_FROM']
+        return numbers.choose(to)
+
+    def iter_messages(self, page_size=1000, lookahead=2, limit=None,
+                      account=None, **filters):
+        """
+        Iterate over the message log, newest first.
+
+        Pages are requested in a background thread while the caller works
+        through earlier pages, at most `lookahead` pages ahead, so that a
+        long export is not held up by the latency of each request. The Twilio
+        API links each page to the next, so pages are still requested one at
+        a time. Records are built straight from the JSON of each page as
+        compact :py:class:`MessageRecord` tuples rather than full resource
+        objects.
+
+        Parameters
+        ----------
+        page_size : `int`
+            The number of records to request per page, up to 1000.
+        lookahead : `int`
+            The maximum number of pages to fetch ahead of the caller.
+        limit : `int`, optional
+            The maximum number of records to return.
+        account : `str`, optional
+            The account whose log to read. See :py:meth:`client_for`.
+        to, from_ : `str`, optional
+            Only return messages to or from this phone number.
+        date_sent, date_sent_before, date_sent_after : `datetime`, optional
+            Only return messages sent on, before, or after this date.
+
+        Returns
+        -------
+        records : iterator
+            An iterator of :py:class:`MessageRecord` objects. Close it to stop
+            fetching early. Pass it to :py:func:`write_records` to export it
+            to a file.
+        """
+        return self._iter_log('Messages', MessageRecord, _MESSAGE_FILTERS,
+                              filters, page_size, lookahead, limit, account)
+
+    def iter_calls(self, page_size=1000, lookahead=2, limit=None,
+                   account=None, **filters):
+        """
+        Iterate over the call log, newest first. Otherwise the same as
+        :py:meth:`iter_messages`.
+
+        Parameters
+        ----------
+        page_size : `int`
+            The number of records to request per page, up to 1000.
+        lookahead : `int`
+            The maximum number of pages to fetch ahead of the caller.
+        limit : `int`, optional
+            The maximum number of records to return.
+        account : `str`, optional
+            The account whose log to read. See :py:meth:`client_for`.
+        to, from_, parent_call_sid, status : `str`, optional
+            Only return calls with these values.
+        start_time, start_time_before, start_time_after : `datetime`, optional
+            Only return calls that started on, before, or after this date.
+        end_time, end_time_before, end_time_after : `datetime`, optional
+            Only return calls that ended on, before, or after this date.
+
+        Returns
+        -------
+        records : iterator
+            An iterator of :py:class:`CallRecord` objects.
+        """
+        return self._iter_log('Calls', CallRecord, _CALL_FILTERS, filters,
+                              page_size, lookahead, limit, account)
+
+    def _iter_log(self, resource, record_type, names, filters, page_size,
+                  lookahead, limit, account):
+        from twilio.base.serialize import iso8601_datetime
+        unknown = set(filters) - set(names)
+        if unknown:
+            raise TypeError('Unknown filters: {}'.format(
+                ', '.join(sorted(unknown))))
+        params = {names[key]: iso8601_datetime(value)
+                  for key, value in filters.items()}
+        if limit is not None:
+            page_size = min(page_size, limit)
+        params['PageSize'] = page_size
+        state = self._get_state()
+        client = state.get_client(state.get_account(account))
+        base_url = client.api.base_url
+        url = '{}/2010-04-01/Accounts/{}/{}.json'.format(
+            base_url, client.account_sid, resource)
+        key = resource.lower()
+        fields = _json_fields(record_type._fields)
+        make = record_type._make
+
+        def pages(url, params, remaining):
+            while url and remaining != 0:
+                response = client.request('GET', url, params=params)
+                if response.status_code != 200:
+                    try:
+                        error = json.loads(response.text)
+                    except ValueError:
+                        error = {}
+                    raise TwilioRestException(
+                        response.status_code, url, error.get('message', ''),
+                        error.get('code'))
+                payload = json.loads(response.text)
+                records = payload[key]
+                if remaining is not None:
+                    records = records[:remaining]
+                    remaining -= len(records)
+                yield [make(map(record.get, fields)) for record in records]
+                uri = payload.get('next_page_uri')
+                url = uri and base_url + uri
+                params = None
+
+        def records(prefetched):
+            try:
+                for page in prefetched:
+                    yield from page
+            finally:
+                prefetched.close()
+
+        return records(_prefetch(pages(url, params, limit), lookahead))
+
+
+cli = AppGroup('twilio', help='Commands for Flask-Twilio.')
+outbox_cli = AppGroup('outbox', help='Manage the outbox of queued requests.')
+cli.add_command(outbox_cli)
+
+
+def _get_outbox():
+    outbox = current_app.extensions['twilio'].get_outbox(start_workers=False)
+    if outbox is None:
+        raise click.UsageError('TWILIO_OUTBOX is not set.')
+    return outbox
+
+
+@outbox_cli.command('status')
+def outbox_status():
+    """Show the number of queued, sent, and failed requests."""
+    counts = _get_outbox().counts()
+    for status in ('pending', 'sent', 'failed'):
+        click.echo('{}: {}'.format(status, counts.get(status, 0)))
+
+
+@outbox_cli.command('drain')
+@click.option('--follow', is_flag=True,
+              help='Keep running and deliver new requests as they arrive.')
+def outbox_drain(follow):
+    """Deliver all requests that are due."""
+    state = current_app.extensions['twilio']
+    outbox = _get_outbox()
+    batch_size = current_app.config['TWILIO_OUTBOX_BATCH_SIZE']
+    total = 0
+    while True:
+        count = outbox.deliver(state.send_from_outbox, batch_size)
+        total += count
+        if not count:
+            if not follow:
+                break
+            time.sleep(current_app.config['TWILIO_OUTBOX_POLL_INTERVAL'])
+    click.echo('Attempted {} requests.'.format(total))
+
+
+@outbox_cli.command('purge')
+@click.option('--days', default=7.0, show_default=True,
+              help='Delete requests that were sent more than this long ago.')
+def outbox_purge(days):
+    """Delete old records of sent requests."""
+    count = _get_outbox().purge(days * 86400)
+    click.echo('Deleted {} requests.'.format(count))
+
+
+@cli.command('export')
+@click.argument('log', type=click.Choice(['messages', 'calls']))
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'format', type=click.Choice(['ndjson', 'csv']),
+              help='Output format. Guessed from the extension of OUTPUT if '
+              'not given.')
+@click.option('--after', type=click.DateTime(),
+              help='Only export records from after this time.')
+@click.option('--before', type=click.DateTime(),
+              help='Only export records from before this time.')
+@click.option('--limit', type=int, help='Maximum number of records.')
+@click.option('--account', help='The account whose log to export.')
+def export(log, output, format, after, before, limit, account):
+    """Export the message or call log to a file."""
+    if format is None:
+        format = 'csv' if output.endswith('.csv') else 'ndjson'
+    twilio = current_app.extensions['twilio'].twilio
+    if log == 'messages':
+        iter_log = twilio.iter_messages
+        prefix = 'date_sent'
+    else:
+        iter_log = twilio.iter_calls
+        prefix = 'start_time'
+    filters = {}
+    if after is not None:
+        filters[prefix + '_after'] = after
+    if before is not None:
+        filters[prefix + '_before'] = before
+    records = iter_log(limit=limit, account=account, **filters)
+    count = write_records(records, click.get_text_stream('stdout') if (
+        output == '-') else output, format)
+    click.echo('Exported {} {}.'.format(count, log), err=output == '-')
@@ -30,10 +30,10 @@ setup(
     platforms='any',
     install_requires=[
         'itsdangerous',
-        'flask>=0.9',
-        'six',
-        'twilio>=6.0.0'
+        'flask>=2.0',
+        'twilio>=8.0.0'
     ],
+    python_requires='>=3.7',
     setup_requires=setup_requires,
     tests_require=[
         'pytest',
@@ -45,10 +45,12 @@ setup(
         'Operating System :: OS Independent',
         'Development Status :: 2 - Pre-Alpha',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: Communications :: Telephony'
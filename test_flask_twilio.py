@@ -1,11 +1,34 @@
-from six.moves.urllib.parse import urlsplit
+from urllib.parse import urlsplit
 from base64 import b64encode
+from datetime import datetime
+import asyncio
+import csv
+import gc
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import weakref
+import xml.etree.ElementTree as ET
 import pytest
-from flask import Flask
+import requests
+from flask import Flask, request
+from twilio.base.exceptions import TwilioRestException
 from twilio.request_validator import RequestValidator
 from twilio.rest.api.v2010.account.call import CallList
-from flask_twilio import Twilio, Response
-from twilio.twiml.voice_response import Say
+from twilio.rest.api.v2010.account.message import MessageList
+from benchmarks.stub_api import StubAPI
+import flask_twilio
+from flask_twilio import (
+    AudioBuffer, CircuitBreaker, CircuitOpenError, LRUCache, MediaStream,
+    NumberPool, Outbox, RateLimiter, RedisCache, RetryBudget, SegmentBudgetError,
+    SharedRateLimiter, SQLiteCache, StatusBuffer, Twilio, Response,
+    TokenBucket, TwiMLTemplate, UnknownAccountError, _TenantCache, analyze_sms,
+    metric_incremented, metric_observed, optimize_sms, placeholder,
+    write_records)
+from twilio.twiml.voice_response import Gather, Hangup, Play, Redirect, Say
 
 
 def basic_auth(username, password):
@@ -56,6 +79,18 @@ def mock_create_call(monkeypatch):
     return ret
 
 
+@pytest.fixture
+def mock_create_message(monkeypatch):
+    ret = []
+
+    def store(self, **kwargs):
+        ret.append(kwargs)
+        return kwargs
+
+    monkeypatch.setattr(MessageList, 'create', store)
+    return ret
+
+
 def test_get_denied(twilio):
     """Check that GET requests are denied."""
     app = twilio.app
@@ -138,3 +173,1451 @@ def test_auth_correct(twilio, always_valid, mock_create_call):
     resp = test_client.post(
         urlparts.path, headers=basic_auth(username, password))
     assert resp.status_code == 200
+
+
+def test_client_shared_between_contexts(twilio):
+    """Test that the REST client and its connection pool outlive the app
+    context."""
+    app = twilio.app
+    app.config['TWILIO_POOL_SIZE'] = 3
+    with app.app_context():
+        client = twilio.client
+    with app.app_context():
+        assert twilio.client is client
+    adapter = client.http_client.session.get_adapter('https://api.twilio.com')
+    assert adapter._pool_maxsize == 3
+    assert adapter._pool_block
+
+
+def test_client_recreated_after_fork(twilio, monkeypatch):
+    """Test that a forked worker does not reuse its parent's client."""
+    app = twilio.app
+    with app.app_context():
+        client = twilio.client
+        monkeypatch.setattr('os.getpid', lambda: -1)
+        assert twilio.client is not client
+
+
+def test_discarded_apps_not_kept_alive():
+    """Test that the exit handler does not keep discarded applications and
+    their state alive."""
+    app = Flask(__name__)
+    Twilio(app)
+    state = weakref.ref(app.extensions['twilio'])
+    assert state() in flask_twilio._states
+    del app
+    gc.collect()
+    assert state() is None
+
+
+def test_lazy_imports():
+    """Test that importing the module and serving TwiML views does not load
+    the REST client."""
+    script = '\n'.join([
+        'import sys',
+        'from flask import Flask',
+        'from flask_twilio import Response, Twilio',
+        'app = Flask(__name__)',
+        'app.config["TESTING"] = True',
+        'twilio = Twilio(app)',
+        'app.route("/call")(twilio.twiml(lambda: Response()))',
+        'assert app.test_client().post("/call").status_code == 200',
+        'print(" ".join(sorted(sys.modules)))'])
+    modules = subprocess.check_output(
+        [sys.executable, '-c', script],
+        cwd=os.path.dirname(os.path.abspath(__file__))).decode().split()
+    for name in ('requests', 'twilio.rest', 'twilio.http.http_client',
+                 'sqlite3', 'concurrent.futures'):
+        assert name not in modules
+    assert flask_twilio.PooledHttpClient is flask_twilio._load_http_client()
+
+
+def test_credentials_resolver(twilio, mock_create_message):
+    """Test that each webhook and send uses the credentials of its
+    account."""
+    app = twilio.app
+    resolved = []
+
+    def resolve(account):
+        resolved.append(account)
+        return {'AC1': {'account_sid': 'AC1', 'auth_token': 'token1',
+                        'from': '+15005550001'}}.get(account)
+
+    app.config['TWILIO_CREDENTIALS_RESOLVER'] = resolve
+    app.config['SERVER_NAME'] = 'example.com'
+    clients = []
+
+    @app.route('/whoami', methods=['GET', 'POST'])
+    @twilio.twiml
+    def whoami():
+        clients.append(twilio.client)
+        return Response()
+
+    @app.route('/plain')
+    def plain():
+        clients.append(twilio.client)
+        return ''
+
+    with app.app_context():
+        assert twilio.client.account_sid == 'sid'
+        client = twilio.client_for('AC1')
+        assert client.account_sid == 'AC1'
+        assert client.password == 'token1'
+        with pytest.raises(UnknownAccountError):
+            twilio.client_for('AC2')
+        with pytest.raises(UnknownAccountError):
+            twilio.message('Hello', to='+15005550006', account='AC2')
+        twilio.message('Hello', to='+15005550006', account='AC1')
+    assert mock_create_message[-1]['from_'] == '+15005550001'
+    # Unknown accounts are remembered.
+    assert resolved == ['AC1', 'AC2']
+    form = {'AccountSid': 'AC1', 'CallSid': 'CA1'}
+    url = 'http://example.com/call'
+    test_client = app.test_client()
+    for token, status in (('token1', 200), ('token', 403)):
+        signature = RequestValidator(token).compute_signature(url, form)
+        resp = test_client.post(
+            url, data=form, headers={'X-Twilio-Signature': signature})
+        assert resp.status_code == status
+    # The AccountSid of a request is only trusted once it is authenticated.
+    with app.test_request_context(url, method='POST', data=form):
+        assert twilio.client.account_sid == 'sid'
+    test_client.get('/plain?AccountSid=AC1')
+    # A webhook for an unknown account is handled as the configured account.
+    form2 = {'AccountSid': 'AC2', 'CallSid': 'CA2'}
+    signature = RequestValidator('token').compute_signature(url, form2)
+    resp = test_client.post(
+        url, data=form2, headers={'X-Twilio-Signature': signature})
+    assert resp.status_code == 200
+    assert resolved == ['AC1', 'AC2']
+    url = 'http://example.com/whoami'
+    signature = RequestValidator('token1').compute_signature(url, form)
+    test_client.post(url, data=form, headers={'X-Twilio-Signature': signature})
+    assert [c.account_sid for c in clients] == ['sid', 'AC1']
+    assert clients[1] is client
+    closed = []
+    client.http_client.close = lambda: closed.append(client)
+    twilio.shutdown()
+    assert closed == [client]
+
+
+def test_tenant_cache(monkeypatch):
+    """Test that tenants are discarded when the cache is full or they are
+    idle, that a discarded tenant's client keeps working for threads that
+    still hold it, and that clearing the cache closes connection pools."""
+    closed = []
+
+    class Tenant(object):
+        def __init__(self, name):
+            self.name = name
+
+        def close(self):
+            closed.append(self.name)
+
+    cache = _TenantCache(2, idle_timeout=10)
+    assert cache.set('a', Tenant('a')).name == 'a'
+    b = cache.set('b', Tenant('b'))
+    assert cache.set('a', Tenant('a2')).name == 'a'
+    cache.set('c', Tenant('c'))
+    assert cache.get('b') is None
+    assert closed == []
+    assert b.name == 'b'
+    now = time.monotonic()
+    monkeypatch.setattr('time.monotonic', lambda: now + 11)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+    cache.set('d', Tenant('d'))
+    cache.clear()
+    assert closed == ['d']
+
+
+def test_call_for_async(twilio, mock_create_call):
+    """Test that the URL is built in the request context and the call is
+    placed in the background."""
+    app = twilio.app
+    app.config['SECRET_KEY'] = 'secret'
+    with app.test_request_context():
+        future = twilio.call_for_async('call', to='+15005550006')
+    future.result()
+    assert mock_create_call['to'] == '+15005550006'
+    assert '@' in urlsplit(mock_create_call['url']).netloc
+    twilio.shutdown()
+
+
+def test_message_async(twilio, mock_create_message):
+    """Test that several messages can be queued at once."""
+    app = twilio.app
+    with app.app_context():
+        futures = [twilio.message_async('Hello', to=str(i)) for i in range(5)]
+    assert sorted(f.result()['to'] for f in futures) == list('01234')
+    assert all(m['from_'] == '+15005550006' for m in mock_create_message)
+    twilio.shutdown()
+
+
+def test_deferred_send(twilio, monkeypatch):
+    """Test that deferred messages are sent after the response, and that
+    failures are passed to the error handler."""
+    app = twilio.app
+    sent = []
+    failures = []
+
+    def create(self, **kwargs):
+        if kwargs['to'] == 'bad':
+            raise ValueError(kwargs['to'])
+        sent.append(kwargs['to'])
+
+    monkeypatch.setattr(MessageList, 'create', create)
+    app.config['TWILIO_DEFER_ERROR_HANDLER'] = (
+        lambda kind, kwargs, e: failures.append((kind, kwargs['to'], e)))
+
+    @app.route('/signup')
+    def signup():
+        twilio.message('Welcome', to='+15005550006', defer=True)
+        twilio.message('Welcome', to='bad', defer=True)
+        assert sent == []
+        return 'OK'
+
+    resp = app.test_client().get('/signup')
+    assert sent == []
+    resp.close()
+    assert sent == ['+15005550006']
+    [(kind, to, e)] = failures
+    assert (kind, to) == ('message', 'bad')
+    assert isinstance(e, ValueError)
+
+
+def test_message_many(twilio, monkeypatch):
+    """Test that bulk messages are sent concurrently and failures are
+    reported per recipient."""
+    def create(self, **kwargs):
+        if kwargs['to'] == 'bad':
+            raise ValueError('bad number')
+        return kwargs
+
+    monkeypatch.setattr(MessageList, 'create', create)
+    app = twilio.app
+    recipients = [str(i) for i in range(20)] + ['bad']
+    with app.app_context():
+        results = list(twilio.message_many(
+            'Hello', recipients, max_concurrency=3))
+    twilio.shutdown()
+    assert sorted(r.to for r in results) == sorted(recipients)
+    failed, = [r for r in results if r.exception is not None]
+    assert failed.to == 'bad' and failed.result is None
+    assert all(r.result['from_'] == '+15005550006'
+               for r in results if r is not failed)
+
+
+def test_message_many_starts_eagerly(twilio, monkeypatch):
+    """Test that bulk messages start sending before the results are read,
+    and the rest are sent as the results are consumed."""
+    sent = []
+    started = threading.Semaphore(0)
+
+    def create(self, **kwargs):
+        sent.append(kwargs['to'])
+        started.release()
+        return kwargs
+
+    monkeypatch.setattr(MessageList, 'create', create)
+    app = twilio.app
+    recipients = [str(i) for i in range(10)]
+    with app.app_context():
+        results = twilio.message_many('Hello', recipients, max_concurrency=3)
+        for _ in range(3):
+            assert started.acquire(timeout=5)
+        assert sorted(sent) == ['0', '1', '2']
+        assert sorted(r.to for r in results) == recipients
+    twilio.shutdown()
+    assert sorted(sent) == recipients
+
+
+@pytest.mark.parametrize('body,encoding,length,segments', [
+    ('', 'GSM-7', 0, 1),
+    ('x' * 160, 'GSM-7', 160, 1),
+    ('x' * 161, 'GSM-7', 161, 2),
+    ('x' * 306, 'GSM-7', 306, 2),
+    ('€' * 80, 'GSM-7', 160, 1),
+    # An escaped character is not split between segments.
+    ('x' * 152 + '€' + 'x' * 152, 'GSM-7', 306, 3),
+    ('\u2019' * 70, 'UCS-2', 70, 1),
+    ('\u2019' * 71, 'UCS-2', 71, 2),
+    # Nor is a surrogate pair.
+    ('x' * 66 + '\U0001f600' + 'x' * 66, 'UCS-2', 134, 3),
+])
+def test_analyze_sms(body, encoding, length, segments):
+    assert analyze_sms(body) == (encoding, length, segments)
+
+
+def test_sms_segment_budget(twilio, mock_create_message):
+    """Test that message bodies are optimized and checked against the
+    segment budget before sending."""
+    app = twilio.app
+    body = 'It\u2019s \u201cdone\u201d \u2014 ' + 'x' * 140
+    assert analyze_sms(body).segments == 3
+    assert optimize_sms(body) == 'It\'s "done" - ' + 'x' * 140
+    assert optimize_sms('\U0001f600\u2026') == '\U0001f600...'
+
+    app.config['TWILIO_SMS_OPTIMIZE'] = True
+    with app.app_context():
+        twilio.message(body, '+15005550006')
+    assert mock_create_message[-1]['body'] == optimize_sms(body)
+
+    # Characters are only replaced if that saves segments.
+    with app.app_context():
+        twilio.message('\U0001f600\u2026', '+15005550006')
+    assert mock_create_message[-1]['body'] == '\U0001f600\u2026'
+
+    app.config['TWILIO_SMS_OPTIMIZE'] = False
+    app.config['TWILIO_SMS_MAX_SEGMENTS'] = 2
+    with app.app_context():
+        twilio.message(body, '+15005550006')
+    assert mock_create_message[-1]['body'] == body
+
+    app.config['TWILIO_SMS_OVER_BUDGET'] = 'reject'
+    del mock_create_message[:]
+    with app.app_context():
+        with pytest.raises(SegmentBudgetError) as excinfo:
+            twilio.message_many(body, ['+15005550006'])
+    assert excinfo.value.info.segments == 3
+    assert not mock_create_message
+
+
+def test_token_bucket():
+    """Test that the token bucket enforces its rate after the burst."""
+    bucket = TokenBucket(rate=100, burst=5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_shared_rate_limiter(tmp_path):
+    """Test that processes that share a rate limiter file share one bucket
+    per key."""
+    path = str(tmp_path / 'limiter')
+    limiter = SharedRateLimiter(path, slots=4)
+    pid = os.fork()
+    if pid == 0:
+        # Use up the burst in another process.
+        SharedRateLimiter(path, slots=4).reserve('+15005550006', 10, 2)
+        SharedRateLimiter(path, slots=4).reserve('+15005550006', 10, 2)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert 0.05 < limiter.reserve('+15005550006', 10, 2) <= 0.1
+    assert limiter.reserve('+15005550001', 10, 2) == 0
+
+
+def test_shared_rate_limiter_threads(tmp_path, monkeypatch):
+    """Test that threads that use a new shared rate limiter at the same time
+    open its file only once and share one lock."""
+    path = str(tmp_path / 'limiter')
+    limiter = SharedRateLimiter(path, slots=4)
+    opened = []
+    open_ = os.open
+
+    def slow_open(*args):
+        opened.append(args)
+        time.sleep(0.05)
+        return open_(*args)
+
+    monkeypatch.setattr(os, 'open', slow_open)
+    barrier = threading.Barrier(4)
+    locks = []
+
+    def run():
+        barrier.wait()
+        limiter.reserve('+15005550006', 10, 10)
+        locks.append(limiter.lock)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(opened) == 1
+    assert len(set(map(id, locks))) == 1
+
+
+def test_send_rate(twilio, tmp_path):
+    """Test that every way of sending is throttled per sending number."""
+    app = twilio.app
+    app.config['TWILIO_SEND_RATE'] = 20
+    app.config['TWILIO_SEND_LIMITER'] = str(tmp_path / 'limiter')
+    with StubAPI() as stub, app.test_request_context():
+        app.config['TWILIO_API_URL'] = stub.url
+        start = time.monotonic()
+        twilio.message('Hello', to='+15005550001')
+        twilio.call_for('call', to='+15005550001')
+        twilio.message_async('Hello', to='+15005550001').result()
+        assert time.monotonic() - start >= 0.09
+        start = time.monotonic()
+        twilio.message('Hello', to='+15005550001', from_='+15005550007')
+        assert time.monotonic() - start < 0.05
+    assert stub.counts == {201: 4}
+
+
+@pytest.fixture
+def outbox_twilio(twilio, tmp_path):
+    twilio.app.config['TWILIO_OUTBOX'] = str(tmp_path / 'outbox.sqlite')
+    twilio.app.config['TWILIO_OUTBOX_WORKERS'] = 0
+    yield twilio
+    twilio.shutdown()
+
+
+def test_outbox_drain(outbox_twilio, monkeypatch):
+    """Test that queued messages are deduplicated and delivered by the
+    CLI."""
+    sent = []
+
+    def create(self, **kwargs):
+        sent.append(kwargs)
+        return type('Message', (), {'sid': 'SM' + kwargs['to']})
+
+    monkeypatch.setattr(MessageList, 'create', create)
+    app = outbox_twilio.app
+    with app.app_context():
+        key = outbox_twilio.message('Hello', to='1', idempotency_key='k')
+        assert key == 'k'
+        outbox_twilio.message('Hello', to='1', idempotency_key='k')
+        outbox_twilio.message('Hello', to='2')
+        assert sent == []
+        assert outbox_twilio.outbox.counts() == {'pending': 2}
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['twilio', 'outbox', 'drain'])
+    assert 'Attempted 2 requests.' in result.output
+    assert sorted(m['to'] for m in sent) == ['1', '2']
+    result = runner.invoke(args=['twilio', 'outbox', 'status'])
+    assert 'sent: 2' in result.output
+
+
+def test_outbox_retry(outbox_twilio):
+    """Test that transient failures are retried and permanent ones are
+    not."""
+    app = outbox_twilio.app
+    app.config['TWILIO_OUTBOX_RETRY_DELAY'] = 0
+    with app.app_context():
+        outbox_twilio.message('Hello', to='transient')
+        outbox_twilio.message('Hello', to='permanent')
+        outbox = outbox_twilio.outbox
+
+    def send(kind, kwargs):
+        if kwargs['to'] == 'transient':
+            raise IOError('connection reset')
+        raise TwilioRestException(400, 'uri', 'invalid number')
+
+    assert outbox.deliver(send) == 2
+    assert outbox.counts() == {'pending': 1, 'failed': 1}
+    assert outbox.deliver(lambda kind, kwargs: 'SM1') == 1
+    assert outbox.counts() == {'sent': 1, 'failed': 1}
+
+
+def test_outbox_lease(tmp_path, monkeypatch):
+    """Test that a slow batch does not let another worker send the same
+    request twice."""
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    outbox = Outbox(str(tmp_path / 'outbox.db'), lease=0.3)
+    for to in '123':
+        outbox.put('message', {'to': to})
+    sent = []
+    claimed = []
+
+    def claim_elsewhere():
+        claimed.extend(kwargs['to'] for _, _, kwargs, _ in outbox.claim(10))
+
+    def send(kind, kwargs):
+        sent.append(kwargs['to'])
+        clock[0] += 0.2
+        if kwargs['to'] == '2':
+            # Another worker in another thread claims what it can.
+            thread = threading.Thread(target=claim_elsewhere)
+            thread.start()
+            thread.join()
+        return 'SM' + kwargs['to']
+
+    assert outbox.deliver(send) == 2
+    assert sent == ['1', '2']
+    assert claimed == ['3']
+    assert outbox.counts() == {'sent': 2, 'pending': 1}
+
+
+def test_outbox_worker(outbox_twilio, mock_create_call):
+    """Test that background workers deliver queued calls with fresh
+    credentials."""
+    app = outbox_twilio.app
+    app.config['TWILIO_OUTBOX_WORKERS'] = 1
+    app.config['SECRET_KEY'] = 'secret'
+    with app.test_request_context():
+        outbox_twilio.call_for('call', to='+15005550006')
+    for _ in range(100):
+        if mock_create_call:
+            break
+        time.sleep(0.01)
+    assert '@' in urlsplit(mock_create_call['url']).netloc
+
+
+def test_async_view(twilio, always_invalid):
+    """Test that coroutine views are validated like normal views."""
+    app = twilio.app
+
+    @app.route('/async_call')
+    @twilio.twiml
+    async def async_call():
+        await asyncio.sleep(0)
+        resp = Response()
+        resp.append(Say('Testing, 1, 2, 3.'))
+        return resp
+
+    test_client = app.test_client()
+    assert test_client.get('/async_call').status_code == 405
+    assert test_client.post('/async_call').status_code == 403
+    app.config['TESTING'] = True
+    resp = test_client.post('/async_call')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/xml'
+    assert b'<Say>Testing, 1, 2, 3.</Say>' in resp.data
+
+
+def test_amessage(twilio, monkeypatch):
+    """Test that awaitable sends share a client per event loop and close it
+    with the loop."""
+    sent = []
+
+    async def create_async(self, **kwargs):
+        sent.append(self._version.domain.twilio.http_client)
+        return kwargs
+
+    monkeypatch.setattr(MessageList, 'create_async', create_async)
+    app = twilio.app
+    state = app.extensions['twilio']
+
+    async def send():
+        results = [await twilio.amessage('Hello', to=str(i))
+                   for i in range(2)]
+        assert len(state.async_clients) == 1
+        return results
+
+    with app.app_context():
+        results = asyncio.run(send())
+    assert [r['to'] for r in results] == ['0', '1']
+    assert sent[0] is sent[1]
+    assert sent[0].session.closed
+    assert state.async_clients == {}
+
+
+def test_response_serialized_once(twilio, monkeypatch):
+    """Test that a response from a TwiML view is serialized only once, and
+    that changes to nested verbs are never hidden by a stale document."""
+    resp = Response()
+    gather = Gather()
+    resp.append(gather)
+    assert b'Hello' not in resp.get_data()
+    gather.append(Say('Hello'))
+    assert b'Hello' in resp.get_data()
+
+    app = twilio.app
+    app.config['TESTING'] = True
+    calls = []
+    to_xml = Response.to_xml
+    monkeypatch.setattr(
+        Response, 'to_xml', lambda self: calls.append(1) or to_xml(self))
+
+    @app.route('/serialized', methods=['POST'])
+    @twilio.twiml
+    def serialized():
+        resp = Response()
+        resp.append(Say('Hello'))
+        resp.set_cookie('visited', 'yes')
+        return resp
+
+    with app.test_client() as test_client:
+        resp = test_client.post('/serialized')
+    assert resp.data == resp.get_data()
+    assert b'<Say>Hello</Say>' in resp.data
+    assert resp.mimetype == 'text/xml'
+    assert 'visited=yes' in resp.headers['Set-Cookie']
+    assert len(calls) == 1
+
+
+def test_twiml_cache(twilio):
+    """Test that cached views are only called once per distinct request."""
+    app = twilio.app
+    app.config['TESTING'] = True
+    calls = []
+
+    @app.route('/cached/<name>')
+    @twilio.twiml(cache=2, vary=('From',))
+    def cached(name):
+        calls.append(name)
+        resp = Response()
+        resp.append(Say('Hello ' + name + ' from ' + request.values['From']))
+        return resp
+
+    test_client = app.test_client()
+    for _ in range(3):
+        resp = test_client.post('/cached/alice', data={'From': '1'})
+        assert resp.mimetype == 'text/xml'
+        assert b'Hello alice from 1' in resp.data
+    assert calls == ['alice']
+    test_client.post('/cached/alice', data={'From': '2'})
+    test_client.post('/cached/bob', data={'From': '1'})
+    assert calls == ['alice', 'alice', 'bob']
+    # The first entry was evicted.
+    test_client.post('/cached/alice', data={'From': '1'})
+    assert calls == ['alice', 'alice', 'bob', 'alice']
+
+
+def build_document(text, voice, url, digits):
+    resp = Response()
+    resp.append(Say(text, voice=voice, loop=1))
+    gather = Gather(action=url, num_digits=2)
+    gather.append(Say('Press ' + digits + ' now.'))
+    gather.append(Play(url))
+    resp.append(gather)
+    resp.append('Tail ' + digits)
+    resp.append(Redirect(url, method='POST'))
+    resp.append(Hangup())
+    return resp
+
+
+@pytest.mark.parametrize('text,voice,url,digits', [
+    ('Hello', 'alice', 'https://example.com/a', '1'),
+    ('', '', '', ''),
+    ('<&> "quoted" \'single\'', 'a"b<c>&d', 'http://x/?a=1&b=2', '<>&'),
+    ('Line\nbreak\ttab\rreturn', 'new\nline\ttab\rcr', ' ', '\n'),
+    ('Unicode: é中\U0001f4de', 'é', '/é', '中'),
+])
+def test_template_matches_to_xml(text, voice, url, digits):
+    """Test that rendered templates are identical to serialized trees."""
+    template = TwiMLTemplate(build_document(
+        placeholder('text'), placeholder('voice'), placeholder('url'),
+        placeholder('digits')))
+    expected = build_document(text, voice, url, digits).to_xml()
+    actual = template.render(text=text, voice=voice, url=url, digits=digits)
+    assert actual == expected.encode('utf-8')
+
+
+def test_template_in_view(twilio):
+    """Test that a rendered template can be returned from a TwiML view."""
+    app = twilio.app
+    app.config['TESTING'] = True
+    template = TwiMLTemplate(Response().append(Say(placeholder('name'))))
+
+    @app.route('/template')
+    @twilio.twiml
+    def template_view():
+        return template.render(name=request.values['name'])
+
+    resp = app.test_client().post('/template', data={'name': 'Bob & Alice'})
+    assert resp.mimetype == 'text/xml'
+    assert resp.data.endswith(
+        b'<Response><Say>Bob &amp; Alice</Say></Response>')
+
+
+def test_idempotent_view(twilio, always_valid):
+    """Test that retried webhooks get the original response."""
+    app = twilio.app
+    calls = []
+
+    @app.route('/idempotent', methods=['POST'])
+    @twilio.twiml(idempotent=True)
+    def idempotent():
+        calls.append(request.values.get('CallSid'))
+        resp = Response()
+        resp.append(Say('Call number {}'.format(len(calls))))
+        return resp
+
+    test_client = app.test_client()
+    first = test_client.post('/idempotent', data={'CallSid': 'CA1'})
+    retry = test_client.post('/idempotent', data={'CallSid': 'CA1'})
+    assert retry.data == first.data
+    assert retry.mimetype == 'text/xml'
+    test_client.post('/idempotent', data={'CallSid': 'CA2'})
+    test_client.post('/idempotent')
+    test_client.post('/idempotent')
+    assert calls == ['CA1', 'CA2', None, None]
+
+
+def test_idempotent_views_on_one_call(twilio, always_valid):
+    """Test that two idempotent views that answer webhooks for the same call
+    do not replay each other's responses."""
+    app = twilio.app
+
+    @app.route('/gather', methods=['POST'])
+    @twilio.twiml(idempotent=True)
+    def gather():
+        resp = Response()
+        resp.append(Gather(action='/gather-result'))
+        return resp
+
+    @app.route('/gather-result', methods=['POST'])
+    @twilio.twiml(idempotent=True)
+    def gather_result():
+        resp = Response()
+        resp.append(Say('You pressed {}'.format(request.values['Digits'])))
+        return resp
+
+    test_client = app.test_client()
+    first = test_client.post('/gather', data={'CallSid': 'CA1'})
+    second = test_client.post(
+        '/gather-result', data={'CallSid': 'CA1', 'Digits': '5'})
+    assert b'<Gather' in first.data
+    assert b'You pressed 5' in second.data
+    assert test_client.post('/gather', data={'CallSid': 'CA1'}).data == (
+        first.data)
+
+
+def test_load_shedding(twilio, always_valid):
+    """Test that overloaded views get the fallback document without being
+    called."""
+    app = twilio.app
+    app.config['TWILIO_METRICS'] = 'prometheus'
+    calls = []
+    hold = Response()
+    hold.append(Say('Please hold.'))
+    hold.append(Redirect('/busy'))
+
+    @app.route('/busy', methods=['POST'])
+    @twilio.twiml(max_concurrency=1, deadline=2, fallback=hold)
+    def busy():
+        calls.append(request.path)
+        if len(calls) == 1:
+            resp = test_client.post('/busy')
+            assert resp.data == hold.to_xml().encode()
+        return Response()
+
+    test_client = app.test_client()
+    assert test_client.post('/busy').data == Response().to_xml().encode()
+    assert calls == ['/busy']
+    resp = test_client.post('/busy', headers={
+        'X-Request-Start': 't={}'.format(int((time.time() - 5) * 1e6))})
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/xml'
+    assert resp.data == hold.to_xml().encode()
+    assert calls == ['/busy']
+    assert busy.shed_counts == {'concurrency': 1, 'deadline': 1}
+    metrics = app.extensions['twilio'].get_metrics().render()
+    assert ('twilio_twiml_shed_total{reason="deadline",view="busy"} 1'
+            in metrics)
+    with pytest.raises(ValueError):
+        twilio.twiml(max_concurrency=1)(lambda: None)
+
+
+def test_lru_cache_ttl(monkeypatch):
+    """Test that items in the in-process cache expire."""
+    cache = LRUCache(2)
+    cache.set('a', b'1', ttl=10)
+    cache.set('b', b'2')
+    assert cache.get('a') == b'1'
+    assert not cache.add('a', b'3')
+    now = time.monotonic()
+    monkeypatch.setattr('time.monotonic', lambda: now + 11)
+    assert cache.get('a') is None
+    assert cache.get('b') == b'2'
+    assert cache.add('a', b'3')
+
+
+def test_sqlite_cache(tmp_path):
+    """Test that the SQLite cache is shared between instances."""
+    path = str(tmp_path / 'cache.sqlite')
+    SQLiteCache(path).set('a', b'1', ttl=60)
+    SQLiteCache(path).set('b', b'2', ttl=-1)
+    cache = SQLiteCache(path)
+    assert cache.get('a') == b'1'
+    assert cache.get('b') is None
+    assert not cache.add('a', b'3')
+    assert cache.add('b', b'3')
+    assert cache.get('b') == b'3'
+
+
+def test_redis_cache():
+    """Test that the Redis cache prefixes keys and sets expiry times."""
+    class FakeRedis(dict):
+        def set(self, key, value, px=None, nx=False):
+            if nx and key in self:
+                return None
+            self[key] = (value, px)
+            return True
+
+    redis = FakeRedis()
+    cache = RedisCache(redis, prefix='test:')
+    cache.set('a', b'1', ttl=1.5)
+    assert redis == {'test:a': (b'1', 1500)}
+    assert not cache.add('a', b'2')
+    assert cache.add('b', b'2')
+
+
+def test_validated_passwords_cached(twilio, always_valid, mock_create_call,
+                                    monkeypatch):
+    """Test that a password is only checked cryptographically once, and that
+    the signer and validator are shared between requests."""
+    app = twilio.app
+    app.config['SECRET_KEY'] = 'secret'
+    with app.test_request_context():
+        twilio.call_for('call', to='+15005550006')
+        signer = twilio.signer
+        validator = twilio.validator
+    with app.app_context():
+        assert twilio.signer is signer
+        assert twilio.validator is validator
+    urlparts = urlsplit(mock_create_call['url'])
+    username, password = urlparts.netloc.split('@')[0].split(':')
+    unsign = type(signer).unsign
+    calls = []
+    monkeypatch.setattr(
+        type(signer), 'unsign',
+        lambda *args, **kwargs: calls.append(1) or unsign(*args, **kwargs))
+    test_client = app.test_client()
+    for _ in range(3):
+        resp = test_client.post(
+            urlparts.path, headers=basic_auth(username, password))
+        assert resp.status_code == 200
+    assert len(calls) == 1
+    # The cache expires along with the password.
+    now = time.monotonic()
+    monkeypatch.setattr('time.monotonic', lambda: now + 601)
+    resp = test_client.post(
+        urlparts.path, headers=basic_auth(username, password))
+    assert len(calls) == 2
+
+
+def test_signer_follows_secret_key(twilio):
+    """Test that changing the secret key invalidates the signer."""
+    app = twilio.app
+    with app.app_context():
+        assert twilio.signer is None
+        app.config['SECRET_KEY'] = 'secret'
+        signer = twilio.signer
+        assert signer is not None
+        app.config['SECRET_KEY'] = 'other'
+        assert twilio.signer is not signer
+
+
+def test_api_url(twilio):
+    """Test that requests can be sent to a stand-in for the Twilio API."""
+    app = twilio.app
+    with StubAPI() as stub:
+        app.config['TWILIO_API_URL'] = stub.url
+        with app.app_context():
+            message = twilio.message('Hello', to='+15005550001')
+    assert message.sid.startswith('SM')
+    assert message.body == 'Hello'
+    assert stub.requests == [('Messages', {
+        'To': '+15005550001', 'From': '+15005550006', 'Body': 'Hello'})]
+
+
+def test_stub_api_round_trip(twilio, mock_create_message):
+    """Test a full round trip through the stand-in API: the call is placed,
+    and the stand-in requests the TwiML document with valid credentials and
+    signature."""
+    app = twilio.app
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['SERVER_NAME'] = 'example.com'
+    test_client = app.test_client()
+
+    def callback(url, form, headers):
+        resp = test_client.post(url, data=form, headers=headers)
+        return resp.status_code, resp.data
+
+    with StubAPI(auth_token='token', callback=callback) as stub:
+        app.config['TWILIO_API_URL'] = stub.url
+        with app.app_context():
+            twilio.call_for('call', to='+15005550001')
+        stub.wait_for_callbacks()
+    (url, form, status, body), = stub.callbacks
+    assert url == 'http://example.com/call'
+    assert form['CallSid'].startswith('CA')
+    assert status == 200
+    assert b'<Say>Testing, 1, 2, 3.</Say>' in body
+
+
+def test_stub_api_errors(twilio):
+    """Test that the stand-in API can throttle and fail requests."""
+    app = twilio.app
+    app.config['TWILIO_RETRIES'] = 0
+    with StubAPI(rate_limit=1) as stub, app.app_context():
+        app.config['TWILIO_API_URL'] = stub.url
+        twilio.message('Hello', to='+15005550001')
+        with pytest.raises(TwilioRestException) as excinfo:
+            twilio.message('Hello', to='+15005550001')
+        assert excinfo.value.status == 429
+        stub.rate_limit = None
+        stub.error_rate = 1
+        with pytest.raises(TwilioRestException) as excinfo:
+            twilio.message('Hello', to='+15005550001')
+        assert excinfo.value.status == 500
+    assert stub.counts == {201: 1, 429: 1, 500: 1}
+
+
+def test_iter_log(twilio, tmp_path):
+    """Test that logs are paged through in order, with filters and limits,
+    and that an iterator that is closed early stops fetching."""
+    app = twilio.app
+    with StubAPI(log_size=250) as stub, app.app_context():
+        app.config['TWILIO_API_URL'] = stub.url
+        records = list(twilio.iter_messages(page_size=100))
+        assert [r.sid for r in records] == [
+            'SM{:032x}'.format(i) for i in range(250)]
+        assert records[0].from_ == '+15005550006'
+        assert records[0].body == 'Message 0'
+        assert len(stub.lists) == 3
+
+        calls = list(twilio.iter_calls(
+            page_size=100, limit=150, status='completed',
+            start_time_after=datetime(2017, 1, 1)))
+        assert len(calls) == 150 and calls[-1].status == 'completed'
+        assert stub.lists[3] == ('Calls', {
+            'PageSize': '100', 'Status': 'completed',
+            'StartTime>': '2017-01-01T00:00:00Z'})
+        assert len(stub.lists) == 5
+
+        del stub.lists[:]
+        records = twilio.iter_messages(page_size=10, lookahead=1)
+        next(records)
+        records.close()
+        time.sleep(0.3)
+        assert len(stub.lists) <= 3
+
+        with pytest.raises(TypeError):
+            twilio.iter_messages(status='sent')
+        stub.error_rate = 1
+        with pytest.raises(TwilioRestException) as excinfo:
+            list(twilio.iter_calls())
+        assert excinfo.value.status == 500
+        stub.error_rate = 0
+
+        path = str(tmp_path / 'messages.ndjson')
+        assert write_records(twilio.iter_messages(limit=5), path) == 5
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        assert lines[4]['sid'] == 'SM{:032x}'.format(4)
+        assert lines[4]['from'] == '+15005550006'
+
+        path = str(tmp_path / 'calls.csv')
+        assert write_records(twilio.iter_calls(limit=5), path, 'csv') == 5
+        with open(path) as f:
+            rows = list(csv.reader(f))
+        assert rows[0][:5] == [
+            'sid', 'date_created', 'start_time', 'end_time', 'from']
+        assert len(rows) == 6
+
+        path = str(tmp_path / 'export.csv')
+        result = app.test_cli_runner().invoke(args=[
+            'twilio', 'export', 'messages', path, '--limit', '120',
+            '--after', '2017-01-01'])
+        assert result.output == 'Exported 120 messages.\n'
+        assert stub.lists[-1][1]['DateSent>'] == '2017-01-01T00:00:00Z'
+        with open(path) as f:
+            assert len(list(csv.reader(f))) == 121
+
+
+def test_prometheus_metrics(always_valid):
+    """Test that TwiML requests are timed by stage and counted by
+    outcome."""
+    app = Flask(__name__)
+    app.config['TWILIO_AUTH_TOKEN'] = 'token'
+    app.config['TWILIO_METRICS'] = 'prometheus'
+    app.config['TWILIO_METRICS_ENDPOINT'] = '/metrics'
+    twilio = Twilio(app)
+
+    @app.route('/call')
+    @twilio.twiml
+    def call():
+        return Response()
+
+    test_client = app.test_client()
+    assert test_client.get('/call').status_code == 405
+    assert test_client.post('/call').status_code == 200
+    app.config['SECRET_KEY'] = 'secret'
+    assert test_client.post('/call').status_code == 401
+    resp = test_client.get('/metrics')
+    assert resp.mimetype == 'text/plain'
+    text = resp.get_data(as_text=True)
+    for status in ('200', '401', '405'):
+        assert ('twilio_twiml_requests_total{status="%s",view="call"} 1'
+                % status) in text
+    for stage, count in [
+            ('auth', 1), ('validate', 1), ('view', 1), ('serialize', 2)]:
+        assert ('twilio_twiml_stage_seconds_count{stage="%s",view="call"} %d'
+                % (stage, count)) in text
+    assert ('twilio_twiml_request_seconds_bucket'
+            '{status="200",view="call",le="+Inf"} 1') in text
+
+
+def test_signal_metrics(twilio):
+    """Test that metrics can be sent as Flask signals."""
+    app = twilio.app
+    app.config['TESTING'] = True
+    app.config['TWILIO_METRICS'] = 'signals'
+    observed = []
+    counted = []
+
+    def on_observed(sender, name, value, labels):
+        observed.append((name, labels.get('stage')))
+
+    def on_incremented(sender, name, value, labels):
+        counted.append((name, labels, value))
+
+    with metric_observed.connected_to(on_observed, app), \
+            metric_incremented.connected_to(on_incremented, app):
+        app.test_client().post('/call')
+    assert observed == [
+        ('twilio_twiml_stage_seconds', 'view'),
+        ('twilio_twiml_stage_seconds', 'serialize'),
+        ('twilio_twiml_request_seconds', None)]
+    assert counted == [('twilio_twiml_requests_total',
+                        {'view': 'call', 'status': '200'}, 1)]
+
+
+def test_rest_metrics(twilio):
+    """Test that REST API requests are timed and counted by outcome."""
+    app = twilio.app
+    app.config['TWILIO_METRICS'] = 'prometheus'
+    app.config['TWILIO_RETRIES'] = 0
+    with StubAPI(rate_limit=1) as stub, app.app_context():
+        app.config['TWILIO_API_URL'] = stub.url
+        twilio.message('Hello', to='+15005550001')
+        with pytest.raises(TwilioRestException):
+            twilio.message('Hello', to='+15005550001')
+    text = twilio.metrics.render()
+    labels = 'from="+15005550006",operation="messages.create"'
+    assert 'twilio_rest_in_flight{%s} 0' % labels in text
+    assert ('twilio_rest_requests_total{%s,outcome="success",status="201"} 1'
+            % labels) in text
+    assert ('twilio_rest_requests_total{%s,outcome="throttled",status="429"} 1'
+            % labels) in text
+    assert ('twilio_rest_request_seconds_count'
+            '{%s,outcome="success",status="201"} 1' % labels) in text
+
+
+def test_rest_connection_error_metrics(twilio):
+    """Test that connection errors are counted."""
+    app = twilio.app
+    app.config['TWILIO_METRICS'] = 'prometheus'
+    app.config['TWILIO_CONNECT_RETRIES'] = 0
+    stub = StubAPI()
+    app.config['TWILIO_API_URL'] = stub.url
+    stub.server.server_close()
+    with app.app_context(), pytest.raises(requests.ConnectionError):
+        twilio.client.calls('CA123').update(status='canceled')
+    assert ('twilio_rest_requests_total{from="",operation="calls.update",'
+            'outcome="connection_error",status=""} 1'
+            ) in twilio.metrics.render()
+
+
+def test_retry_backoff(twilio):
+    """Test that failed requests are retried within the retry budget, and
+    that a long Retry-After is respected by giving up."""
+    app = twilio.app
+    app.config['TWILIO_METRICS'] = 'prometheus'
+    app.config['TWILIO_RETRY_STATUSES'] = (429, 500)
+    app.config['TWILIO_RETRY_BACKOFF'] = 0.01
+    app.config['TWILIO_RETRY_MAX_BACKOFF'] = 0.5
+    app.config['TWILIO_BREAKER_THRESHOLD'] = None
+    with StubAPI(error_rate=1) as stub, app.app_context():
+        app.config['TWILIO_API_URL'] = stub.url
+        with pytest.raises(TwilioRestException) as excinfo:
+            twilio.message('Hello', to='+15005550001')
+        assert excinfo.value.status == 500
+        assert stub.counts == {500: 4}
+        # The stub asks for a one second delay, which is too long.
+        stub.error_rate = 0
+        stub.rate_limit = stub.tokens = 1
+        twilio.message('Hello', to='+15005550001')
+        with pytest.raises(TwilioRestException) as excinfo:
+            twilio.message('Hello', to='+15005550001')
+        assert excinfo.value.status == 429
+    assert stub.counts == {500: 4, 201: 1, 429: 1}
+    assert ('twilio_rest_retries_total{from="+15005550006",'
+            'operation="messages.create"} 3') in twilio.metrics.render()
+
+    budget = RetryBudget(ratio=0.5, burst=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_circuit_breaker_fallback(outbox_twilio):
+    """Test that the circuit breaker fails fast after repeated errors, and
+    that messages fall back to the outbox while it is open."""
+    app = outbox_twilio.app
+    app.config['TWILIO_OUTBOX_MODE'] = 'fallback'
+    app.config['TWILIO_RETRIES'] = 0
+    app.config['TWILIO_BREAKER_THRESHOLD'] = 2
+    app.config['TWILIO_BREAKER_COOLDOWN'] = 0.1
+    state = app.extensions['twilio']
+    with StubAPI(error_rate=1) as stub, app.app_context():
+        app.config['TWILIO_API_URL'] = stub.url
+        for _ in range(2):
+            with pytest.raises(TwilioRestException):
+                outbox_twilio.message('Hello', to='+15005550001')
+        with pytest.raises(CircuitOpenError):
+            outbox_twilio.client.messages.create(
+                body='Hello', to='+15005550001', from_='+15005550006')
+        key = outbox_twilio.message('Hello', to='+15005550001',
+                                    idempotency_key='k')
+        assert key == 'k'
+        assert stub.counts == {500: 2}
+
+        # Delivering while the breaker is open does not use up attempts.
+        outbox = state.get_outbox(start_workers=False)
+        assert outbox.deliver(state.send_from_outbox) == 1
+        assert outbox.counts() == {'pending': 1}
+
+        # After the cool-down, a trial request closes the breaker.
+        stub.error_rate = 0
+        time.sleep(0.1)
+        message = outbox_twilio.message('Hello', to='+15005550001')
+        assert message.sid.startswith('SM')
+        time.sleep(0.1)
+        assert outbox.deliver(state.send_from_outbox) == 1
+        assert outbox.counts() == {'sent': 1}
+
+
+def test_deferred_fallback(outbox_twilio):
+    """Test that in fallback mode, deferred messages are sent after the
+    response, or queued if the circuit breaker is open by then."""
+    app = outbox_twilio.app
+    app.config['TWILIO_OUTBOX_MODE'] = 'fallback'
+    app.config['TWILIO_RETRIES'] = 0
+    app.config['TWILIO_BREAKER_THRESHOLD'] = 1
+    app.config['TWILIO_BREAKER_COOLDOWN'] = 60
+    state = app.extensions['twilio']
+    results = []
+
+    @app.route('/notify')
+    def notify():
+        results.append(outbox_twilio.message(
+            'Hello', to='+15005550001', defer=True))
+        return 'OK'
+
+    with StubAPI() as stub:
+        app.config['TWILIO_API_URL'] = stub.url
+        test_client = app.test_client()
+        resp = test_client.get('/notify')
+        assert stub.counts == {}
+        resp.close()
+        assert stub.counts == {201: 1}
+
+        stub.error_rate = 1
+        with app.app_context(), pytest.raises(TwilioRestException):
+            outbox_twilio.message('Hello', to='+15005550001')
+        test_client.get('/notify').close()
+        assert stub.counts == {201: 1, 500: 1}
+    assert results == [None, None]
+    outbox = state.get_outbox(start_workers=False)
+    assert outbox.counts() == {'pending': 1}
+
+
+def test_circuit_breaker_trial_outcome(monkeypatch):
+    """Test that the trial request of a half-open breaker is never lost, and
+    that unexpected exceptions count as failures."""
+    class FlakyLimiter(RateLimiter):
+        down = True
+
+        def reserve(self, key, rate, burst=1):
+            if self.down:
+                raise RuntimeError('limiter is down')
+            return 0.0
+
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+    breaker.record(True)
+    limiter = FlakyLimiter()
+    http_client = flask_twilio.PooledHttpClient(
+        breaker=breaker, limiter=limiter, send_rate=1)
+    data = {'From': '+15005550006', 'To': '+15005550001', 'Body': 'Hello'}
+    with StubAPI() as stub:
+        url = stub.url + '/2010-04-01/Accounts/AC1/Messages.json'
+        with pytest.raises(RuntimeError):
+            http_client.request('POST', url, data=data, auth=('AC1', 'x'))
+        limiter.down = False
+        response = http_client.request(
+            'POST', url, data=data, auth=('AC1', 'x'))
+        assert response.status_code == 201
+        assert breaker.opened is None
+
+        def fail(*args):
+            raise ValueError('unexpected')
+
+        monkeypatch.setattr(http_client, '_send', fail)
+        with pytest.raises(ValueError):
+            http_client.request('POST', url, data=data, auth=('AC1', 'x'))
+        assert breaker.opened is not None
+    http_client.close()
+
+
+def test_number_pool():
+    """Test that numbers are chosen by strategy and that unhealthy numbers
+    are skipped."""
+    numbers = ['+15005550006', '+15005550007', '+15005550008']
+    recipients = ['+1500555{:04d}'.format(i) for i in range(300)]
+    pool = NumberPool(numbers)
+    assigned = {to: pool.choose(to) for to in recipients}
+    assert all(pool.choose(to) == assigned[to] for to in recipients)
+    assert set(assigned.values()) == set(numbers)
+    # Adding a number only moves recipients to the new number.
+    bigger = NumberPool(numbers + ['+15005550009'])
+    moved = [to for to in recipients if bigger.choose(to) != assigned[to]]
+    assert 0 < len(moved) < 150
+    assert {bigger.choose(to) for to in moved} == {'+15005550009'}
+
+    pool = NumberPool(numbers, 'round_robin', threshold=2)
+    assert [pool.choose() for _ in range(4)] == numbers + numbers[:1]
+    pool.started(numbers[1])
+    pool.finished(numbers[1], True)
+    pool.started(numbers[1])
+    pool.finished(numbers[1], True)
+    assert [pool.choose() for _ in range(4)] == [numbers[0], numbers[2]] * 2
+    assert pool.stats()[numbers[1]] == {
+        'healthy': False, 'in_flight': 0, 'sent': 0, 'failed': 2}
+
+    pool = NumberPool(numbers, 'least_loaded')
+    pool.started(numbers[0])
+    pool.started(numbers[1])
+    assert pool.choose() == numbers[2]
+
+
+def test_number_pool_sends(twilio):
+    """Test that messages and calls from a pool are sticky per recipient."""
+    app = twilio.app
+    app.config['TWILIO_FROM'] = ['+15005550006', '+15005550007']
+    with StubAPI() as stub, app.test_request_context():
+        app.config['TWILIO_API_URL'] = stub.url
+        for to in ['+15005550001', '+15005550002'] * 2:
+            twilio.message('Hello', to=to)
+            twilio.call_for('call', to=to)
+        results = list(twilio.message_many(
+            'Hello', ['+15005550001', '+15005550002']))
+        assert all(result.exception is None for result in results)
+    senders = {}
+    for resource, form in stub.requests:
+        senders.setdefault(form['To'], set()).add(form['From'])
+    assert all(len(numbers) == 1 for numbers in senders.values())
+    stats = twilio.numbers.stats()
+    assert sum(number['sent'] for number in stats.values()) == 10
+
+
+def test_number_pool_threads(twilio, monkeypatch):
+    """Test that threads that need the pool of numbers, the rate limiter, and
+    the metrics at the same time all get the same ones."""
+    app = twilio.app
+    app.config['TWILIO_FROM'] = ['+15005550006', '+15005550007']
+    app.config['TWILIO_SEND_RATE'] = 10
+    app.config['TWILIO_METRICS'] = 'signals'
+    state = app.extensions['twilio']
+    init = flask_twilio.NumberPool.__init__
+
+    def slow_init(self, *args, **kwargs):
+        time.sleep(0.05)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(flask_twilio.NumberPool, '__init__', slow_init)
+    barrier = threading.Barrier(4)
+    results = []
+
+    def run():
+        barrier.wait()
+        results.append(
+            (state.get_numbers(), state.get_limiter(), state.get_metrics()))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4
+    assert all(result == results[0] for result in results)
+    assert all(results[0])
+
+
+def test_status_callbacks():
+    """Test that validated status callbacks are batched to the sink, and that
+    sends can be pointed at the status callback endpoint."""
+    app = Flask(__name__)
+    app.config['TWILIO_ACCOUNT_SID'] = 'sid'
+    app.config['TWILIO_AUTH_TOKEN'] = 'token'
+    app.config['TWILIO_FROM'] = '+15005550006'
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['SERVER_NAME'] = 'example.com'
+    app.config['TWILIO_STATUS_CALLBACK_ENDPOINT'] = '/twilio/status'
+    app.config['TWILIO_STATUS_BATCH_SIZE'] = 3
+    app.config['TWILIO_STATUS_FLUSH_INTERVAL'] = 60
+    batches = []
+    app.config['TWILIO_STATUS_SINK'] = batches.append
+    twilio = Twilio(app)
+
+    @app.route('/call')
+    @twilio.twiml
+    def call():
+        return Response()
+
+    test_client = app.test_client()
+
+    def callback(url, form, headers):
+        resp = test_client.post(url, data=form, headers=headers)
+        return resp.status_code, resp.data
+
+    with StubAPI(auth_token='token', callback=callback) as stub:
+        app.config['TWILIO_API_URL'] = stub.url
+        with app.app_context():
+            twilio.message('Hello', to='+15005550001', status_callback=True)
+            twilio.message('Hello', to='+15005550002', status_callback=True)
+            twilio.call_for('call', to='+15005550003', status_callback=True)
+        stub.wait_for_callbacks()
+    deadline = time.monotonic() + 5
+    while not batches and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [form.get('StatusCallback') for _, form in stub.requests] == [
+        'http://example.com/twilio/status'] * 3
+    assert stub.counts['callback 204'] == 3
+    batch, = batches
+    assert sorted(event['To'] for event in batch) == [
+        '+15005550001', '+15005550002', '+15005550003']
+    # Forged callbacks are rejected.
+    assert test_client.post('/twilio/status', data={}).status_code == 403
+    twilio.shutdown()
+
+
+def test_call_for_many(twilio, monkeypatch):
+    """Test that the first call to be answered cancels the others, and that
+    later answers are hung up."""
+    from twilio.rest.api.v2010.account.call import CallContext
+    app = twilio.app
+    app.config['TESTING'] = True
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['SERVER_NAME'] = 'example.com'
+    app.config['TWILIO_STATUS_CALLBACK_ENDPOINT'] = '/twilio/status'
+    app.config['TWILIO_STATUS_SINK'] = lambda events: None
+    twilio.init_app(app)
+    created = []
+    updated = []
+
+    def create(self, **kwargs):
+        created.append(kwargs)
+        return type('Call', (), {'sid': 'CA' + kwargs['to']})
+
+    def update(self, status):
+        updated.append((self._solution['sid'], status))
+
+    monkeypatch.setattr(CallList, 'create', create)
+    monkeypatch.setattr(CallContext, 'update', update)
+    with app.app_context():
+        group = twilio.call_for_many('call', ['1', '2', '3'])
+    assert sorted(call.sid for call in group.calls) == ['CA1', 'CA2', 'CA3']
+    assert len({kwargs['url'] for kwargs in created}) == 1
+    status_callback = urlsplit(created[0]['status_callback'])
+    assert status_callback.query == 'dial_group=' + group.id
+    assert group.answered() is None
+
+    test_client = app.test_client()
+    for sid in ('CA2', 'CA3'):
+        resp = test_client.post(
+            status_callback.path + '?' + status_callback.query,
+            data={'CallSid': sid, 'CallStatus': 'in-progress'})
+        assert resp.status_code == 204
+    assert group.wait(timeout=1) == 'CA2'
+    twilio.shutdown()
+    assert sorted(updated) == [('CA1', 'canceled'), ('CA3', 'canceled'),
+                               ('CA3', 'completed')]
+
+
+def test_audio_buffer():
+    """Test that windows of the ring buffer are contiguous across the
+    wraparound, and that samples are decoded from μ-law."""
+    buffer = AudioBuffer(5)
+    buffer.write(b'\xff\x00\x80')
+    assert buffer.latest(3, pcm=True).tolist() == [0, -32124, 32124]
+    buffer.write(bytes(range(1, 5)))
+    assert buffer.written == 7
+    assert bytes(buffer.view(2)) == b'\x80\x01\x02\x03\x04'
+    assert bytes(buffer.latest(2)) == b'\x03\x04'
+    buffer.write(bytes(range(10, 22)))
+    assert bytes(buffer.view(14, 18)) == bytes(range(17, 21))
+    with pytest.raises(IndexError):
+        buffer.view(13)
+    numpy = pytest.importorskip('numpy')
+    array = buffer.array(16)
+    assert array.dtype == numpy.dtype('<i2')
+    buffer.write(b'\xff' * 5)
+    assert not array.any()
+
+
+def test_media_stream(twilio):
+    """Test that streams must carry a signed token, and that frames are
+    decoded into the track buffers."""
+    import json
+    app = twilio.app
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['SERVER_NAME'] = 'example.com'
+    with app.app_context():
+        resp = Response()
+        resp.connect_stream('wss://example.com/stream', {'user': '42'})
+    root = ET.fromstring(resp.get_data())
+    stream = root.find('Connect/Stream')
+    assert stream.get('url') == 'wss://example.com/stream'
+    parameters = {parameter.get('name'): parameter.get('value')
+                  for parameter in stream.findall('Parameter')}
+    token = parameters.pop(MediaStream.token_parameter)
+    assert parameters == {'user': '42'}
+
+    class Socket(object):
+        def __init__(self, messages):
+            self.messages = [json.dumps(message) for message in messages]
+            self.sent = []
+            self.closed = False
+
+        def receive(self):
+            return self.messages.pop(0) if self.messages else None
+
+        def send(self, message):
+            self.sent.append(json.loads(message))
+
+        def close(self):
+            self.closed = True
+
+    def start(token):
+        return {'event': 'start', 'start': {
+            'streamSid': 'MZ1', 'callSid': 'CA1', 'tracks': ['inbound'],
+            'customParameters': dict(
+                parameters, **{MediaStream.token_parameter: token})}}
+
+    media = {'event': 'media', 'media': {
+        'track': 'inbound', 'payload': b64encode(b'\xff\x00').decode()}}
+    for messages in ([start('forged'), media], [media]):
+        ws = Socket(messages)
+        with app.app_context():
+            with pytest.raises(PermissionError):
+                twilio.media_stream(ws).run()
+        assert ws.closed
+
+    frames = []
+    ws = Socket([start(token), media, media, {'event': 'stop'}, media])
+    with app.app_context():
+        stream = twilio.media_stream(ws)
+    stream.on('media', lambda stream, track, samples: frames.append(
+        bytes(samples)))
+    stream.run()
+    assert stream.call_sid == 'CA1'
+    assert stream.parameters == {'user': '42'}
+    assert frames == [b'\xff\x00'] * 2
+    assert stream.tracks['inbound'].latest(4, pcm=True).tolist() == [
+        0, -32124, 0, -32124]
+    stream.send_mark('done')
+    assert ws.sent == [{'event': 'mark', 'mark': {'name': 'done'},
+                        'streamSid': 'MZ1'}]
+
+
+def test_status_buffer():
+    """Test that the status buffer flushes by time and when closed."""
+    batches = []
+    buffer = StatusBuffer(batches.append, batch_size=100, interval=0.05)
+    buffer.put({'MessageSid': 'SM1'})
+    time.sleep(0.2)
+    assert batches == [[{'MessageSid': 'SM1'}]]
+    buffer.put({'MessageSid': 'SM2'})
+    buffer.close()
+    assert batches[-1] == [{'MessageSid': 'SM2'}]
+    assert not buffer.thread.is_alive()